@@ -0,0 +1,252 @@
+# Local stand-ins for the Telegram Bot API and Horizon, shared by the benchmarks.
+
+import asyncio
+import json
+import time
+from datetime import datetime, timedelta, timezone
+
+from aiohttp import web
+
+XAI_ISSUER = "GDW4UCJVOUIRLXVY4FWSXQJBCIA3QZPFMVRL3KMAIMTCXASWGBJFRXAI"
+
+
+# Minimal Bot API: getMe, getUpdates (long polling), set/deleteWebhook, sendMessage and
+# editMessageText. Every message the bot sends is also put on the inbox of its chat.
+class FakeTelegram:
+    def __init__(self):
+        self.updates = []  # updates waiting for getUpdates
+        self.new_update = asyncio.Event()
+        self.sent_at = {}  # chat_id -> time the bot answered
+        self.replied = asyncio.Event()
+        self.waiting_for = set()  # chat ids that have not been answered yet
+        self.inboxes = {}  # chat_id -> asyncio.Queue of (time, text)
+        self.message_id = 0
+        self.update_id = 0
+
+    async def read_params(self, request):
+        if request.content_type == "application/json":
+            return await request.json()
+        params = {}
+        for key, value in (await request.post()).items():
+            try:
+                params[key] = json.loads(value)
+            except (TypeError, ValueError):
+                params[key] = value
+        return params
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        params = await self.read_params(request)
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "DiviBot", "username": "divibot"}
+        elif method == "getUpdates":
+            offset = params.get("offset") or 0
+            self.updates = [update for update in self.updates if update["update_id"] >= offset]
+            if not self.updates:
+                self.new_update.clear()
+                try:
+                    await asyncio.wait_for(self.new_update.wait(), float(params.get("timeout") or 0) or 0.01)
+                except asyncio.TimeoutError:
+                    pass
+            result = self.updates[:100]
+        elif method in ("sendMessage", "editMessageText"):
+            chat_id = int(params["chat_id"])
+            now = time.perf_counter()
+            if method == "sendMessage":
+                self.sent_at[chat_id] = now
+                self.waiting_for.discard(chat_id)
+                if not self.waiting_for:
+                    self.replied.set()
+                self.inbox(chat_id).put_nowait((now, params.get("text", "")))
+            self.message_id += 1
+            result = {"message_id": self.message_id, "date": int(time.time()),
+                      "chat": {"id": chat_id, "type": "private"}, "text": params.get("text", "")}
+        else:
+            result = True
+
+        return web.json_response({"ok": True, "result": result})
+
+    def inbox(self, chat_id):
+        if chat_id not in self.inboxes:
+            self.inboxes[chat_id] = asyncio.Queue()
+        return self.inboxes[chat_id]
+
+    def publish(self, update):
+        self.updates.append(update)
+        self.new_update.set()
+
+    # Function to publish a text message from a user (in their private chat)
+    def send_text(self, user_id, text):
+        self.update_id += 1
+        self.publish(make_update(self.update_id, user_id, text))
+
+    def app(self):
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self.handle)
+        return app
+
+
+def make_update(update_id, user_id, text):
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+
+# Horizon with generated data: every account has history_length payments and trades, the
+# first XAI payment at three quarters of the history (no XAI trades), an XAI balance set with
+# set_balance (0 by default), and every priced asset trades at 1 XLM. Each request waits
+# latency seconds. The /trades stream (server-sent events, for one asset pair like Horizon)
+# sends history_length trades between the accounts with a balance, then closes.
+class FakeHorizon:
+    def __init__(self, history_length=1000, latency=0.0):
+        self.history_length = history_length
+        self.latency = latency
+        self.balances = {}  # account -> XAI balance
+        self.requests = 0
+        self.started = datetime(2023, 1, 1, tzinfo=timezone.utc)
+
+    def set_balance(self, account, xai_balance):
+        self.balances[account] = xai_balance
+
+    def account_balances(self, account):
+        return [
+            {"asset_type": "credit_alphanum4", "asset_code": "XAI", "asset_issuer": XAI_ISSUER,
+             "balance": f"{self.balances.get(account, 0):.7f}"},
+            {"asset_type": "native", "balance": "100.0000000"},
+        ]
+
+    def history_record(self, kind, index):
+        at = (self.started + timedelta(minutes=index)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        record = {"paging_token": str(index), "type": "payment", "created_at": at, "ledger_close_time": at}
+        if kind == "payments":
+            record.update({"asset_type": "credit_alphanum4", "asset_code": "USD", "asset_issuer": "GUSD"})
+            if index == self.history_length * 3 // 4:
+                record.update({"asset_code": "XAI", "asset_issuer": XAI_ISSUER})
+        else:
+            record.update({"base_asset_code": "USD", "base_asset_issuer": "GUSD", "counter_asset_type": "native"})
+        return record
+
+    @staticmethod
+    def page(request, size):
+        limit = int(request.query.get("limit", "10"))
+        cursor = request.query.get("cursor")
+        start = int(cursor) + 1 if cursor and cursor != "now" else 0
+        if request.query.get("order") == "desc":
+            return range(size - 1, -1, -1)[:limit]
+        return range(start, min(start + limit, size))
+
+    async def handle_history(self, request):
+        await self.wait()
+        kind = request.match_info["kind"]
+        records = [self.history_record(kind, index) for index in self.page(request, self.history_length)]
+        return web.json_response({"_embedded": {"records": records}})
+
+    async def handle_account(self, request):
+        await self.wait()
+        account = request.match_info["account"]
+        return web.json_response({"account_id": account, "balances": self.account_balances(account)})
+
+    async def handle_accounts(self, request):
+        await self.wait()
+        holders = sorted(self.balances)
+        records = [
+            {"account_id": account, "paging_token": str(index), "balances": self.account_balances(account)}
+            for index, account in ((index, holders[index]) for index in self.page(request, len(holders)))
+        ]
+        return web.json_response({"_embedded": {"records": records}})
+
+    async def handle_trades_stream(self, request):
+        await self.wait()
+        query = request.query
+        # Horizon only filters trades by a full pair
+        if ("base_asset_type" in query) != ("counter_asset_type" in query):
+            return web.json_response(
+                {"status": 400, "title": "Bad Request", "detail": "this endpoint supports asset pairs but only one asset supplied"},
+                status=400,
+            )
+        pair = {
+            f"{side}_{field}": query[f"{side}_{field}"]
+            for side in ("base", "counter") for field in ("asset_type", "asset_code", "asset_issuer")
+            if f"{side}_{field}" in query
+        }
+        accounts = sorted(self.balances)
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        await response.write(b'retry: 1000\nevent: open\ndata: "hello"\n\n')
+        cursor = query.get("cursor", "now")
+        for index in range(int(cursor) + 1 if cursor != "now" else 0, self.history_length if accounts else 0):
+            at = (self.started + timedelta(minutes=index)).strftime("%Y-%m-%dT%H:%M:%SZ")
+            record = {
+                "id": f"{index}-0", "paging_token": str(index), "ledger_close_time": at,
+                "base_account": accounts[index % len(accounts)], "counter_account": accounts[(index + 1) % len(accounts)],
+                "base_amount": "1.0000000", "counter_amount": "1.0000000", **pair,
+            }
+            await response.write(f"id: {index}\ndata: {json.dumps(record)}\n\n".encode())
+        return response
+
+    async def handle_order_book(self, request):
+        await self.wait()
+        return web.json_response({"bids": [{"price": "0.9"}], "asks": [{"price": "1.1"}]})
+
+    async def handle_trade_aggregations(self, request):
+        await self.wait()
+        return web.json_response({"_embedded": {"records": [{"close": "1.0"}]}})
+
+    async def wait(self):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get("/accounts", self.handle_accounts)
+        app.router.add_get("/accounts/{account}", self.handle_account)
+        app.router.add_get("/accounts/{account}/{kind:payments|trades}", self.handle_history)
+        app.router.add_get("/trades", self.handle_trades_stream)
+        app.router.add_get("/order_book", self.handle_order_book)
+        app.router.add_get("/trade_aggregations", self.handle_trade_aggregations)
+        return app
+
+
+# Function to serve an aiohttp app on 127.0.0.1:port (0 for any free port), returns the
+# runner (call cleanup() to stop); serve_port(runner) is the port it listens on
+async def serve(app, port=0):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+
+def serve_port(runner):
+    return runner.addresses[0][1]
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * p / 100), len(ordered) - 1)]
+
+
+# Function to compare results with a budget file section ({"name": {"max": x} or {"min": x}}).
+# Returns the list of violations.
+def check_budget(results, budget_path, section):
+    with open(budget_path) as budget_file:
+        budget = json.load(budget_file)[section]
+    violations = []
+    for name, limits in budget.items():
+        value = results.get(name)
+        if value is None:
+            continue
+        if "max" in limits and value > limits["max"]:
+            violations.append(f"{name} = {value:.3f}, budget max {limits['max']}")
+        if "min" in limits and value < limits["min"]:
+            violations.append(f"{name} = {value:.3f}, budget min {limits['min']}")
+    return violations
@@ -0,0 +1,182 @@
+# Load test: simulated users driving bot.py end to end.
+#
+# Runs bot.py (long polling) against local stand-ins for the Telegram Bot API and Horizon.
+# Each simulated user first adds its wallets (waiting for the scan result), then presses
+# /start, WALLET, DIVIDENDS and WITHDRAW in random order for --duration seconds, always
+# waiting for the answer before the next press. Reports p50/p99 latency from an update
+# becoming available to the bot's reply, per action and overall, and updates/s.
+#
+#   python benchmarks/load_test.py [--users 50] [--duration 30] [--history 1000]
+#   python benchmarks/load_test.py --quick --budget benchmarks/budget.json
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+from stellar_sdk import Keypair
+
+from fakes import FakeHorizon, FakeTelegram, check_budget, percentile, serve, serve_port
+
+BOT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot.py")
+TOKEN = "123456:benchmark"
+
+# Message each action sends, and the reply that answers it
+ACTIONS = {
+    "start": ("/start", re.compile("Welcome")),
+    "wallet": ("💼 WALLET", re.compile("Here are your wallets|There is no wallet")),
+    "dividends": ("🚀 DIVIDENDS", re.compile("XAi Balance|Please add a wallet|Error fetching")),
+    "withdraw": ("💸WITHDRAW", re.compile("Withdrawal option|No accumulated|Please add a wallet")),
+}
+WALLET_ADDED = re.compile("added successfully")
+WALLET_ACK = re.compile("Fetching your wallet info")
+
+
+# Function to send a message as a user and wait for the reply matching pattern.
+# Returns the latency in seconds.
+async def press(telegram, user_id, text, pattern, timeout):
+    inbox = telegram.inbox(user_id)
+    sent_at = time.perf_counter()
+    telegram.send_text(user_id, text)
+    deadline = sent_at + timeout
+    while True:
+        replied_at, reply = await asyncio.wait_for(inbox.get(), max(deadline - time.perf_counter(), 0.001))
+        # Skip the other messages of earlier answers
+        if replied_at >= sent_at and pattern.search(reply):
+            return replied_at - sent_at
+
+
+async def simulate_user(telegram, user_id, wallets, stop_at, latencies, args):
+    for wallet_address in wallets:
+        latencies["add_wallet"].append(await press(telegram, user_id, wallet_address, WALLET_ACK, args.timeout))
+        # The scan result is pushed in a second message
+        started = time.perf_counter()
+        while True:
+            replied_at, reply = await asyncio.wait_for(telegram.inbox(user_id).get(), args.timeout)
+            if WALLET_ADDED.search(reply):
+                latencies["wallet_scan"].append(replied_at - started)
+                break
+
+    names = list(ACTIONS)
+    while time.perf_counter() < stop_at:
+        name = random.choice(names)
+        text, pattern = ACTIONS[name]
+        latencies[name].append(await press(telegram, user_id, text, pattern, args.timeout))
+
+
+async def run(args):
+    telegram = FakeTelegram()
+    horizon = FakeHorizon(history_length=args.history, latency=args.horizon_latency)
+    users = {
+        user_id: [Keypair.random().public_key for _ in range(args.wallets)]
+        for user_id in range(1, args.users + 1)
+    }
+    for wallets in users.values():
+        for wallet_address in wallets:
+            horizon.set_balance(wallet_address, random.choice([50, 500, 5000, 50000, 500000]))
+
+    telegram_runner = await serve(telegram.app(), args.api_port)
+    horizon_runner = await serve(horizon.app(), args.horizon_port)
+    api_port, horizon_port = serve_port(telegram_runner), serve_port(horizon_runner)
+    workdir = tempfile.mkdtemp(prefix="divibot-load-")
+    env = dict(
+        os.environ,
+        BOT_TOKEN=TOKEN,
+        TELEGRAM_API_URL=f"http://127.0.0.1:{api_port}/bot",
+        HORIZON_URL=f"http://127.0.0.1:{horizon_port}",
+        DATABASE_PATH=os.path.join(workdir, "user_data.db"),
+        HORIZON_STREAMING="0",
+        # The stand-ins have no rate limits: measure the bot, not the limiters
+        HORIZON_RATE_LIMIT="100000",
+        HORIZON_BURST="100000",
+        TELEGRAM_GLOBAL_RATE="100000",
+        TELEGRAM_CHAT_RATE="100000",
+    )
+    for name in ("DATABASE_URL", "WEBHOOK_URL", "WORKER_PROCESSES"):
+        env.pop(name, None)
+
+    bot = subprocess.Popen([sys.executable, BOT_PATH], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    latencies = {name: [] for name in ["add_wallet", "wallet_scan", *ACTIONS]}
+    try:
+        # Wait until the bot answers
+        deadline = time.perf_counter() + 30
+        while True:
+            try:
+                await press(telegram, 0, "/start", ACTIONS["start"][1], 1)
+                break
+            except asyncio.TimeoutError:
+                if time.perf_counter() > deadline:
+                    raise SystemExit("bot did not start")
+
+        started = time.perf_counter()
+        stop_at = started + args.duration
+        await asyncio.gather(*(
+            simulate_user(telegram, user_id, wallets, stop_at, latencies, args)
+            for user_id, wallets in users.items()
+        ))
+        elapsed = time.perf_counter() - started
+    finally:
+        bot.terminate()
+        bot.wait()
+        await telegram_runner.cleanup()
+        await horizon_runner.cleanup()
+
+    # Wallet scans run in the background and are reported separately
+    handled = [latency for name, values in latencies.items() if name != "wallet_scan" for latency in values]
+    results = {
+        "updates": len(handled),
+        "updates_per_sec": len(handled) / elapsed,
+        "p50_ms": percentile(handled, 50) * 1000,
+        "p99_ms": percentile(handled, 99) * 1000,
+        "horizon_requests": horizon.requests,
+    }
+    for name, values in latencies.items():
+        if values:
+            results[f"{name}_p50_ms"] = percentile(values, 50) * 1000
+            results[f"{name}_p99_ms"] = percentile(values, 99) * 1000
+    return results, latencies
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Load test bot.py with simulated users")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--wallets", type=int, default=2, help="wallets added by every user")
+    parser.add_argument("--duration", type=float, default=30, help="seconds of button presses after the wallets are added")
+    parser.add_argument("--history", type=int, default=1000, help="payments and trades per account")
+    parser.add_argument("--horizon-latency", type=float, default=0.02, help="seconds per Horizon request")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for a reply")
+    parser.add_argument("--api-port", type=int, default=0, help="port of the fake Bot API (default: any free port)")
+    parser.add_argument("--horizon-port", type=int, default=0, help="port of the fake Horizon (default: any free port)")
+    parser.add_argument("--quick", action="store_true", help="small run for CI (10 users, 10 s)")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--budget", help="fail if the results exceed the 'load' budget in this file")
+    args = parser.parse_args()
+    if args.quick:
+        args.users, args.duration = 10, 10
+
+    results, latencies = await run(args)
+    print(f"{results['updates']} updates, {results['updates_per_sec']:.0f} updates/s, "
+          f"p50 {results['p50_ms']:.1f} ms, p99 {results['p99_ms']:.1f} ms, {results['horizon_requests']} Horizon requests")
+    for name, values in latencies.items():
+        if values:
+            print(f"  {name:>11}: {len(values):6} x, p50 {results[f'{name}_p50_ms']:8.1f} ms, p99 {results[f'{name}_p99_ms']:8.1f} ms")
+
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(results, output, indent=2)
+    if args.budget:
+        violations = check_budget(results, args.budget, "load")
+        for violation in violations:
+            print(f"Over budget: {violation}")
+        if violations:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,197 @@
+# Micro-benchmarks of the hot functions in bot.py: dividend calculation, the first XAI
+# transaction scan and the trade streams (against an in-process fake Horizon) and the
+# message formatters, and the memory the wallet registry takes.
+#
+#   python benchmarks/micro.py [--history 1000] [--json results.json] [--budget benchmarks/budget.json]
+
+import argparse
+import asyncio
+import gc
+import json
+import os
+import random
+import string
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from stellar_sdk import Keypair
+
+from fakes import FakeHorizon, check_budget, serve, serve_port
+
+parser = argparse.ArgumentParser(description="Micro-benchmarks of bot.py")
+parser.add_argument("--history", type=int, default=1000, help="payments and trades per account for the scan benchmark")
+parser.add_argument("--scans", type=int, default=20, help="wallets scanned by the scan benchmark")
+parser.add_argument("--horizon-port", type=int, default=0, help="port of the fake Horizon (default: any free port)")
+parser.add_argument("--quick", action="store_true", help="fewer iterations, for CI")
+parser.add_argument("--json", help="write the results to this file")
+parser.add_argument("--budget", help="fail if the results exceed the 'micro' budget in this file")
+args = parser.parse_args()
+
+# bot.py reads its settings when imported
+workdir = tempfile.mkdtemp(prefix="divibot-micro-")
+os.environ.update(
+    DATABASE_PATH=os.path.join(workdir, "user_data.db"),
+    HORIZON_RATE_LIMIT="100000",
+    HORIZON_BURST="100000",
+    HORIZON_STREAMING="1",
+    HORIZON_PAYMENTS_STREAM="0",
+)
+os.environ.pop("DATABASE_URL", None)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import bot  # noqa: E402
+
+SCALE = 0.1 if args.quick else 1
+
+
+# Function to time a function over a number of calls, returns microseconds per call
+def time_calls(function, calls):
+    calls = max(int(calls * SCALE), 1)
+    started = time.perf_counter()
+    for _ in range(calls):
+        function()
+    return (time.perf_counter() - started) / calls * 1e6
+
+
+async def time_async_calls(function, calls):
+    calls = max(int(calls * SCALE), 1)
+    started = time.perf_counter()
+    for _ in range(calls):
+        await function()
+    return (time.perf_counter() - started) / calls * 1e6
+
+
+# Function to measure the memory (MB) the wallet registry takes for 100k users with
+# wallets_per_user wallets each (built from fresh rows, like WalletRegistry.load; not
+# scaled down by --quick, fewer users give misleading per-user figures)
+def measure_registry_mb(wallets_per_user):
+    users = 100000
+    alphabet = string.ascii_uppercase + "234567"
+    registry = bot.WalletRegistry()
+    gc.collect()
+    tracemalloc.start()
+    rows = [
+        (user_id, "G" + "".join(random.choices(alphabet, k=55)), 1672531200)
+        for user_id in range(users) for _ in range(wallets_per_user)
+    ]
+    registry.apply_rows(set(range(users)), rows)
+    del rows
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return used / 1e6
+
+
+async def run():
+    horizon = FakeHorizon(history_length=args.history)
+    runner = await serve(horizon.app(), args.horizon_port)
+    bot.HORIZON_URL = f"http://127.0.0.1:{serve_port(runner)}"
+    results = {}
+    try:
+        await bot.price_service.refresh()
+        balances = [random.uniform(0, 400000) for _ in range(10000)]
+
+        results["calculate_payment_us"] = time_calls(lambda: bot.calculate_payment(random.choice(balances)), 20000)
+        batch_us = time_calls(lambda: bot.calculate_payments_batch(balances), 50)
+        results["calculate_payments_batch_10k_ms"] = batch_us / 1000
+        results["weekly_dividends_message_us"] = time_calls(lambda: bot.message_cache.weekly_dividends(random.choice(balances)), 20000)
+
+        # Dividends message of a wallet with a fresh holder snapshot (no Horizon request)
+        wallet_address = Keypair.random().public_key
+        snapshot = json.dumps(horizon.account_balances(wallet_address))
+        row = (wallet_address, 1672531200, snapshot, int(time.time()))
+        results["wallet_dividends_message_us"] = await time_async_calls(lambda: bot.get_wallet_dividends_message(row), 5000)
+
+        totals = {asset: (random.uniform(0, 100), 10) for name, asset, decimals in bot.DIVIDEND_ASSETS}
+        results["withdraw_info_us"] = time_calls(lambda: bot.format_wallet_withdraw_info(wallet_address, totals), 20000)
+
+        blocks = [await bot.get_wallet_dividends_message(row) for _ in range(50)]
+        results["pack_50_blocks_us"] = time_calls(lambda: bot.pack_message_blocks(blocks, "HTML"), 2000)
+
+        # One record of the unfiltered payments stream: SSE line decode, JSON parse and the
+        # indexer check (a payment of some other asset between unregistered accounts)
+        payment_line = ("data: " + json.dumps({
+            "id": "225688248000622593", "paging_token": "225688248000622593", "transaction_successful": True,
+            "source_account": Keypair.random().public_key, "type": "payment", "type_i": 1,
+            "created_at": "2024-06-01T12:00:00Z", "transaction_hash": "ab" * 32,
+            "asset_type": "credit_alphanum4", "asset_code": "USDC", "asset_issuer": Keypair.random().public_key,
+            "from": Keypair.random().public_key, "to": Keypair.random().public_key, "amount": "12.5000000",
+            "_links": {name: {"href": f"https://horizon.stellar.org/{name}/225688248000622593"}
+                       for name in ("self", "transaction", "effects", "succeeds", "precedes")},
+        }) + "\n").encode()
+
+        async def handle_payment_line():
+            record = json.loads(payment_line.decode().rstrip("\r\n")[5:].strip())
+            await bot.wallet_activity_indexer.handle(record, "created_at", bot.is_xai_payment)
+        results["stream_payment_record_us"] = await time_async_calls(handle_payment_line, 20000)
+
+        # First XAI transaction scans of new wallets (every page from the fake Horizon), then
+        # the same wallets again with their pages in the page cache
+        wallets = [Keypair.random().public_key for _ in range(max(int(args.scans * SCALE), 1))]
+        requests = horizon.requests
+        started = time.perf_counter()
+        for wallet_address in wallets:
+            await bot.get_first_xai_transaction_date(wallet_address)
+        results["first_xai_scan_cold_ms"] = (time.perf_counter() - started) / len(wallets) * 1000
+        results["first_xai_scan_cold_requests"] = (horizon.requests - requests) / len(wallets)
+
+        requests = horizon.requests
+        started = time.perf_counter()
+        for wallet_address in wallets:
+            await bot.get_first_xai_transaction_date(wallet_address)
+        results["first_xai_scan_cached_ms"] = (time.perf_counter() - started) / len(wallets) * 1000
+        results["first_xai_scan_cached_requests"] = (horizon.requests - requests) / len(wallets)
+
+        # Trade streams end to end: the streams the leader starts (one per priced asset) read the
+        # fake's /trades stream, whose trades are between registered wallets
+        traders = [Keypair.random().public_key for _ in range(20)]
+        for trader in traders:
+            horizon.set_balance(trader, 5000)
+        await bot.wallet_registry.load()
+        await bot.wallet_registry.add([(1, trader, None) for trader in traders])
+        bot.leader_lease.valid_until = float("inf")
+        handled = bot.wallet_activity_indexer.records
+        expected = args.history * len(bot.PRICE_ASSETS)
+        started = time.perf_counter()
+        bot.start_horizon_streams()
+        while bot.wallet_activity_indexer.records - handled < expected:
+            if time.perf_counter() - started > 60:
+                raise SystemExit(f"Trade streams handled {bot.wallet_activity_indexer.records - handled} of {expected} records")
+            await asyncio.sleep(0.01)
+        results["stream_trade_record_us"] = (time.perf_counter() - started) / expected * 1e6
+        if any(bot.wallet_registry.get_first_xai_at(trader) is None for trader in traders):
+            raise SystemExit("Trade streams did not record the first XAI trade of every wallet")
+
+        results["wallet_registry_100k_users_mb"] = measure_registry_mb(1)
+        results["wallet_registry_100k_users_2_wallets_mb"] = measure_registry_mb(2)
+    finally:
+        for task in bot.background_tasks:
+            task.cancel()
+        await asyncio.gather(*bot.background_tasks, return_exceptions=True)
+        await bot.close_http_session(None)
+        await runner.cleanup()
+        bot.db.close()
+        bot.page_cache_db.close()
+    return results
+
+
+def main():
+    results = asyncio.run(run())
+    width = max(len(name) for name in results)
+    for name, value in results.items():
+        print(f"{name:>{width}}: {value:10.2f}")
+
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(results, output, indent=2)
+    if args.budget:
+        violations = check_budget(results, args.budget, "micro")
+        for violation in violations:
+            print(f"Over budget: {violation}")
+        if violations:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
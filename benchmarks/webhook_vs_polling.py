@@ -0,0 +1,127 @@
+# Compares update latency and throughput of polling and webhook mode.
+#
+# Runs bot.py against a local stand-in for the Telegram Bot API (and a Horizon stub that
+# answers every request with 404), feeds it /start updates from many users and measures
+# the time from an update becoming available to the bot's sendMessage reply.
+#
+#   python benchmarks/webhook_vs_polling.py [--updates 2000] [--rate 200]
+
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from aiohttp import web
+import aiohttp
+
+from fakes import FakeTelegram, make_update, percentile, serve, serve_port
+
+BOT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot.py")
+TOKEN = "123456:benchmark"
+SECRET = "benchmark-secret"
+USER_ID_OFFSET = 5000
+
+
+async def run_mode(mode, args):
+    telegram = FakeTelegram()
+    app = web.Application()
+    app.router.add_route("*", "/bot{token}/{method}", telegram.handle)
+    app.router.add_route("*", "/{tail:.*}", lambda request: web.Response(status=404))
+    runner = await serve(app, args.api_port)
+    api_port = serve_port(runner)
+
+    workdir = tempfile.mkdtemp(prefix="divibot-bench-")
+    env = dict(
+        os.environ,
+        BOT_TOKEN=TOKEN,
+        TELEGRAM_API_URL=f"http://127.0.0.1:{api_port}/bot",
+        HORIZON_URL=f"http://127.0.0.1:{api_port}",
+        DATABASE_PATH=os.path.join(workdir, "user_data.db"),
+        WEBHOOK_SECRET=SECRET,
+        PORT=str(args.webhook_port),
+        # The fake API has no flood limits; measure update handling, not the send rate limiter
+        TELEGRAM_GLOBAL_RATE="100000",
+    )
+    env.pop("DATABASE_URL", None)
+    if mode == "webhook":
+        env["WEBHOOK_URL"] = f"http://127.0.0.1:{args.webhook_port}"
+    else:
+        env.pop("WEBHOOK_URL", None)
+
+    bot = subprocess.Popen([sys.executable, BOT_PATH], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    published_at = {}
+    try:
+        async with aiohttp.ClientSession() as session:
+            # Wait until the bot is up: one warm-up update must be answered
+            warmup = make_update(10**9, 10**9, "/start")
+            # FakeTelegram tracks replies per chat
+            telegram.waiting_for = {warmup["message"]["chat"]["id"]}
+            deadline = time.perf_counter() + 30
+            while not telegram.replied.is_set():
+                if time.perf_counter() > deadline:
+                    raise SystemExit(f"{mode}: bot did not start")
+                if mode == "webhook":
+                    try:
+                        await session.post(f"http://127.0.0.1:{args.webhook_port}/telegram", json=warmup,
+                                           headers={"X-Telegram-Bot-Api-Secret-Token": SECRET})
+                    except aiohttp.ClientError:
+                        pass
+                elif not telegram.updates:
+                    telegram.publish(warmup)
+                await asyncio.sleep(0.2)
+            telegram.sent_at.clear()
+            telegram.replied.clear()
+            # One update per user, from user ids that differ from the update ids
+            updates = [make_update(update_id, USER_ID_OFFSET + update_id, "/start") for update_id in range(1, args.updates + 1)]
+            telegram.waiting_for = {update["message"]["chat"]["id"] for update in updates}
+
+            async def deliver(update):
+                published_at[update["message"]["chat"]["id"]] = time.perf_counter()
+                if mode == "webhook":
+                    await session.post(f"http://127.0.0.1:{args.webhook_port}/telegram", json=update,
+                                       headers={"X-Telegram-Bot-Api-Secret-Token": SECRET})
+                else:
+                    telegram.publish(update)
+
+            started = time.perf_counter()
+            deliveries = []
+            for update in updates:
+                deliveries.append(asyncio.create_task(deliver(update)))
+                await asyncio.sleep(1 / args.rate)
+            await asyncio.gather(*deliveries)
+            await asyncio.wait_for(telegram.replied.wait(), 60)
+            elapsed = time.perf_counter() - started
+    finally:
+        bot.terminate()
+        bot.wait()
+        await runner.cleanup()
+
+    latencies = [telegram.sent_at[chat_id] - published_at[chat_id] for chat_id in published_at]
+    return {
+        "mode": mode,
+        "updates": len(latencies),
+        "updates_per_sec": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--rate", type=float, default=200, help="updates offered per second")
+    parser.add_argument("--api-port", type=int, default=0, help="port of the fake Bot API (default: any free port)")
+    parser.add_argument("--webhook-port", type=int, default=8182)
+    args = parser.parse_args()
+
+    for mode in ("polling", "webhook"):
+        result = await run_mode(mode, args)
+        print(f"{result['mode']:>8}: {result['updates']} updates, {result['updates_per_sec']:.0f} updates/s, "
+              f"p50 {result['p50_ms']:.1f} ms, p99 {result['p99_ms']:.1f} ms")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,37 +1,562 @@
 import sqlite3
-from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Bot, Update, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
+    Application,
     ApplicationBuilder,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
     ContextTypes,
+    AIORateLimiter,
     filters,
 )
-from stellar_sdk import Server, Asset
+from aiolimiter import AsyncLimiter
+from telegram.error import TelegramError
+from stellar_sdk import Asset, StrKey
 from datetime import datetime
 from datetime import timezone
+from datetime import time as clock_time
 import re
+import html
 import asyncio
+from bisect import bisect_left
+import heapq
+import random
+import numpy as np
 import aiohttp
+from aiohttp import web
 import certifi
 import ssl
-
-# Initialize SQLite database
-conn = sqlite3.connect('user_data.db', check_same_thread=False)
-cursor = conn.cursor()
-
-# Create the necessary table for storing wallets if it doesn't exist
-cursor.execute('''CREATE TABLE IF NOT EXISTS user_wallets (
-                    user_id INTEGER,
+import os
+import sys
+import argparse
+import signal
+import socket
+import subprocess
+import hmac
+import secrets
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import json
+import csv
+import zlib
+from collections import OrderedDict, deque
+from contextlib import aclosing
+from urllib.parse import urlencode
+
+# Database file locations (the Horizon page cache lives next to the user database)
+DATABASE_PATH = os.environ.get("DATABASE_PATH", "user_data.db")
+PAGE_CACHE_PATH = os.path.join(os.path.dirname(DATABASE_PATH), "horizon_pages.db")
+
+# Storage backend for the user database: "sqlite" (the local DATABASE_PATH file) or
+# "postgres" (DATABASE_URL). Defaults to postgres when DATABASE_URL is set, as on Heroku.
+DATABASE_URL = os.environ.get("DATABASE_URL")
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "postgres" if DATABASE_URL else "sqlite")
+
+# Database tuning: reader threads (and Postgres pool size), and how long a write waits for
+# others to share its transaction
+DB_READ_THREADS = int(os.environ.get("DB_READ_THREADS", "4"))
+DB_WRITE_BATCH_DELAY = float(os.environ.get("DB_WRITE_BATCH_DELAY", "0.005"))
+DB_WRITE_BATCH_SIZE = int(os.environ.get("DB_WRITE_BATCH_SIZE", "500"))
+
+# Async database access shared by the storage backends.
+# Queries run on worker threads with a fresh cursor per operation, so the event loop never
+# blocks on the database and handlers never share cursor state. Writes are queued and
+# committed together: everything submitted within DB_WRITE_BATCH_DELAY shares one
+# transaction (and one fsync) on a single writer thread.
+# SQL is written with "?" placeholders in the subset understood by SQLite and PostgreSQL
+# (ON CONFLICT upserts, RETURNING); backends translate placeholders where needed.
+class Database:
+    def __init__(self):
+        self.read_executor = ThreadPoolExecutor(max_workers=DB_READ_THREADS, thread_name_prefix="db-read")
+        self.write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
+        self.pending_writes = []  # (statements, future) waiting for the next transaction
+        self.flush_task = None
+
+    # Backend specific: run one query and return its rows
+    def _fetchall(self, sql, params):
+        raise NotImplementedError
+
+    # Backend specific: run all statement groups in one transaction, return the rows of each statement
+    def _write_batch(self, groups):
+        raise NotImplementedError
+
+    async def fetchall(self, sql, params=()):
+        return await asyncio.get_running_loop().run_in_executor(self.read_executor, self._fetchall, sql, params)
+
+    async def fetchone(self, sql, params=()):
+        rows = await self.fetchall(sql, params)
+        return rows[0] if rows else None
+
+    # Queue a single write statement. Returns the rows it produced (for RETURNING clauses).
+    async def execute(self, sql, params=()):
+        results = await self.execute_many([(sql, params)])
+        return results[0]
+
+    # Queue several write statements that must be applied together, in order.
+    # Returns the rows produced by each statement.
+    async def execute_many(self, statements):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending_writes.append((statements, future))
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = loop.create_task(self._flush_writes())
+        return await future
+
+    # Bulk insert/update of many rows with the same statement
+    async def executemany(self, sql, rows):
+        if not rows:
+            return
+        await self.execute_many([(sql, row) for row in rows])
+
+    async def _flush_writes(self):
+        loop = asyncio.get_running_loop()
+        # Give other writes a moment to join this transaction
+        await asyncio.sleep(DB_WRITE_BATCH_DELAY)
+        while self.pending_writes:
+            batch = self.pending_writes[:DB_WRITE_BATCH_SIZE]
+            del self.pending_writes[:DB_WRITE_BATCH_SIZE]
+            try:
+                results = await loop.run_in_executor(self.write_executor, self._write_batch, [statements for statements, future in batch])
+            except Exception:
+                # One bad write would roll back the whole batch: retry each group on its
+                # own so only the failing caller gets the error
+                for statements, future in batch:
+                    try:
+                        result = await loop.run_in_executor(self.write_executor, self._write_batch, [statements])
+                        if not future.done():
+                            future.set_result(result[0])
+                    except Exception as e:
+                        if not future.done():
+                            future.set_exception(e)
+                continue
+            for (statements, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def close(self):
+        self.read_executor.shutdown(wait=False)
+        self.write_executor.shutdown(wait=True)
+
+# SQLite backend: one connection per worker thread, WAL mode
+class SQLiteDatabase(Database):
+    def __init__(self, path, schema=()):
+        super().__init__()
+        self.path = path
+        self.local = threading.local()
+
+        # Create the tables up front, before the event loop starts
+        connection = self.connect()
+        with connection:
+            for statement in schema:
+                connection.execute(statement)
+        connection.close()
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")  # safe with WAL, no fsync per commit
+        connection.execute("PRAGMA cache_size=-16000")  # 16 MB page cache
+        connection.execute("PRAGMA temp_store=MEMORY")
+        connection.execute("PRAGMA busy_timeout=5000")
+        return connection
+
+    # Per-thread connection, each worker thread keeps its own
+    def connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = self.local.connection = self.connect()
+        return connection
+
+    def _fetchall(self, sql, params):
+        return self.connection().execute(sql, params).fetchall()
+
+    def _write_batch(self, groups):
+        connection = self.connection()
+        results = []
+        with connection:
+            for statements in groups:
+                results.append([connection.execute(sql, params).fetchall() for sql, params in statements])
+        return results
+
+# PostgreSQL backend: connections come from a thread-safe pool shared by the worker threads
+class PostgresDatabase(Database):
+    def __init__(self, dsn, schema=()):
+        super().__init__()
+        import psycopg2.pool  # only needed when the Postgres backend is used
+
+        self.pool = psycopg2.pool.ThreadedConnectionPool(1, DB_READ_THREADS + 1, dsn)
+        connection = self.pool.getconn()
+        try:
+            with connection, connection.cursor() as cursor:
+                for statement in schema:
+                    cursor.execute(statement)
+        finally:
+            self.pool.putconn(connection)
+
+    @staticmethod
+    def translate(sql):
+        return sql.replace("?", "%s")
+
+    @staticmethod
+    def fetch_rows(cursor):
+        return cursor.fetchall() if cursor.description is not None else []
+
+    def _fetchall(self, sql, params):
+        connection = self.pool.getconn()
+        try:
+            with connection, connection.cursor() as cursor:
+                cursor.execute(self.translate(sql), params)
+                return self.fetch_rows(cursor)
+        finally:
+            self.pool.putconn(connection)
+
+    def _write_batch(self, groups):
+        connection = self.pool.getconn()
+        try:
+            results = []
+            with connection, connection.cursor() as cursor:
+                for statements in groups:
+                    group_results = []
+                    for sql, params in statements:
+                        cursor.execute(self.translate(sql), params)
+                        group_results.append(self.fetch_rows(cursor))
+                    results.append(group_results)
+            return results
+        finally:
+            self.pool.putconn(connection)
+
+    # Fast multi-row insert used by the SQLite -> Postgres migration
+    def bulk_insert(self, sql, rows, page_size=1000):
+        from psycopg2.extras import execute_values
+
+        connection = self.pool.getconn()
+        try:
+            with connection, connection.cursor() as cursor:
+                execute_values(cursor, sql, rows, page_size=page_size)
+        finally:
+            self.pool.putconn(connection)
+
+    def close(self):
+        super().close()
+        self.pool.closeall()
+
+# Tables of the user database, in SQL accepted by both backends
+# (BIGINT because Telegram ids don't fit in a 32-bit Postgres INTEGER)
+DATABASE_SCHEMA = [
+    # Create the necessary table for storing wallets if it doesn't exist
+    # (original layout; later revisions are applied by run_migrations)
+    '''CREATE TABLE IF NOT EXISTS user_wallets (
+                    user_id BIGINT,
                     wallet_address TEXT,
                     first_xai_transaction_date TEXT,
                     PRIMARY KEY (user_id, wallet_address)
-                 )''')
-conn.commit()
-
-# Initialize Stellar server
-server = Server("https://horizon.stellar.org")
+                 )''',
+    # Pending wallet onboarding scans, kept in the database so they survive a restart
+    '''CREATE TABLE IF NOT EXISTS wallet_jobs (
+                    user_id BIGINT,
+                    chat_id BIGINT,
+                    wallet_address TEXT,
+                    created_at BIGINT,
+                    PRIMARY KEY (user_id, wallet_address)
+                 )''',
+    # Latest balances of registered wallets from the XAI holder snapshot
+    '''CREATE TABLE IF NOT EXISTS wallet_balances (
+                    wallet_address TEXT PRIMARY KEY,
+                    balances TEXT,
+                    snapshot_at BIGINT
+                 )''',
+    # Weekly dividends of every registered wallet, per asset (see record_weekly_dividends)
+    '''CREATE TABLE IF NOT EXISTS dividend_ledger (
+                    wallet_address TEXT,
+                    week_start BIGINT,
+                    asset TEXT,
+                    weeks INTEGER,
+                    xai_balance DOUBLE PRECISION,
+                    tier TEXT,
+                    amount DOUBLE PRECISION,
+                    PRIMARY KEY (wallet_address, week_start, asset)
+                 )''',
+    # Running totals of the ledger, read by /withdraw
+    '''CREATE TABLE IF NOT EXISTS dividend_totals (
+                    wallet_address TEXT,
+                    asset TEXT,
+                    total DOUBLE PRECISION,
+                    weeks INTEGER,
+                    last_week BIGINT,
+                    PRIMARY KEY (wallet_address, asset)
+                 )''',
+    # How far the Horizon streams were read (see follow_horizon_stream)
+    '''CREATE TABLE IF NOT EXISTS stream_cursors (
+                    stream TEXT PRIMARY KEY,
+                    cursor TEXT
+                 )''',
+    # Per-user settings: tier change notifications on (1) or off (0), quiet hours (UTC)
+    '''CREATE TABLE IF NOT EXISTS user_settings (
+                    user_id BIGINT PRIMARY KEY,
+                    notify INTEGER,
+                    quiet_start INTEGER,
+                    quiet_end INTEGER
+                 )''',
+    # Last tier seen for every registered wallet (see sweep_tier_changes)
+    '''CREATE TABLE IF NOT EXISTS wallet_tiers (
+                    wallet_address TEXT PRIMARY KEY,
+                    tier TEXT,
+                    changed_at BIGINT
+                 )''',
+    # Tier change notifications waiting to be sent (e.g. during quiet hours)
+    '''CREATE TABLE IF NOT EXISTS tier_notifications (
+                    user_id BIGINT,
+                    wallet_address TEXT,
+                    old_tier TEXT,
+                    new_tier TEXT,
+                    xai_balance DOUBLE PRECISION,
+                    created_at BIGINT,
+                    PRIMARY KEY (user_id, wallet_address)
+                 )''',
+    # Change log of user_wallets, polled by every process to keep its WalletRegistry current
+    '''CREATE TABLE IF NOT EXISTS wallet_changes (
+                    seq BIGINT PRIMARY KEY,
+                    user_id BIGINT,
+                    wallet_address TEXT,
+                    changed_at BIGINT
+                 )''',
+    # Named counters (wallet_changes.seq)
+    '''CREATE TABLE IF NOT EXISTS counters (
+                    name TEXT PRIMARY KEY,
+                    value BIGINT
+                 )''',
+    # Leases for work that must run in one process only (see LeaderLease)
+    '''CREATE TABLE IF NOT EXISTS leases (
+                    name TEXT PRIMARY KEY,
+                    holder TEXT,
+                    expires_at BIGINT
+                 )''',
+    # Schema revisions applied by run_migrations
+    '''CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY
+                 )''',
+]
+
+# Function to convert a first XAI transaction date stored in the old display format
+# ("%Y-%m-%d\n%H:%M:%S UTC") to epoch seconds. Returns None for anything else
+# (e.g. scan errors that used to be stored in place of a date).
+def parse_display_date(value):
+    try:
+        return int(datetime.strptime(value, "%Y-%m-%d\n%H:%M:%S UTC").replace(tzinfo=timezone.utc).timestamp())
+    except (TypeError, ValueError):
+        return None
+
+# Schema revision 1: store the first XAI transaction as an integer epoch
+# (first_xai_transaction_at) instead of a display string, and index wallet_address
+# for lookups across users. Existing rows are converted in place.
+def migration_epoch_timestamps(database):
+    rows = database._fetchall(
+        'SELECT user_id, wallet_address, first_xai_transaction_date FROM user_wallets WHERE first_xai_transaction_date IS NOT NULL', ()
+    )
+    statements = [('ALTER TABLE user_wallets ADD COLUMN first_xai_transaction_at BIGINT', ())]
+    statements += [
+        ('UPDATE user_wallets SET first_xai_transaction_at = ? WHERE user_id = ? AND wallet_address = ?',
+         (parse_display_date(first_xai_date), user_id, wallet_address))
+        for user_id, wallet_address, first_xai_date in rows
+        if parse_display_date(first_xai_date) is not None
+    ]
+    statements += [
+        ('ALTER TABLE user_wallets DROP COLUMN first_xai_transaction_date', ()),
+        ('CREATE INDEX IF NOT EXISTS idx_user_wallets_wallet_address ON user_wallets (wallet_address)', ()),
+    ]
+    return statements
+
+# Schema revision 2: keep the order in which a user added their wallets (added_seq, from the
+# wallet_positions counter). Existing wallets keep the address order they were listed in.
+def migration_wallet_order(database):
+    rows = database._fetchall('SELECT user_id, wallet_address FROM user_wallets ORDER BY user_id, wallet_address', ())
+    statements = [('ALTER TABLE user_wallets ADD COLUMN added_seq BIGINT', ())]
+    statements += [
+        ('UPDATE user_wallets SET added_seq = ? WHERE user_id = ? AND wallet_address = ?', (seq, user_id, wallet_address))
+        for seq, (user_id, wallet_address) in enumerate(rows, start=1)
+    ]
+    statements.append(("INSERT INTO counters (name, value) VALUES ('wallet_positions', ?)", (len(rows),)))
+    return statements
+
+# Schema revisions in order; each returns the statements that bring the database to that version
+MIGRATIONS = [
+    migration_epoch_timestamps,
+    migration_wallet_order,
+]
+
+# Function to bring a database up to the latest schema revision. Each revision is applied in
+# one transaction together with its schema_migrations row, so it is never half done.
+def run_migrations(database):
+    applied = {row[0] for row in database._fetchall('SELECT version FROM schema_migrations', ())}
+    for version, migration in enumerate(MIGRATIONS, start=1):
+        if version in applied:
+            continue
+        statements = migration(database)
+        statements.append(('INSERT INTO schema_migrations (version) VALUES (?)', (version,)))
+        database._write_batch([statements])
+        print(f"Applied schema revision {version} ({migration.__name__})")
+    return database
+
+# Tables copied by the SQLite -> Postgres migration, with their columns. Not copied: leases
+# (held by running processes, they expire on their own) and schema_migrations (the Postgres
+# database records its own revisions).
+MIGRATED_TABLES = {
+    "user_wallets": ["user_id", "wallet_address", "first_xai_transaction_at", "added_seq"],
+    "wallet_jobs": ["user_id", "chat_id", "wallet_address", "created_at"],
+    "wallet_balances": ["wallet_address", "balances", "snapshot_at"],
+    "dividend_ledger": ["wallet_address", "week_start", "asset", "weeks", "xai_balance", "tier", "amount"],
+    "dividend_totals": ["wallet_address", "asset", "total", "weeks", "last_week"],
+    "user_settings": ["user_id", "notify", "quiet_start", "quiet_end"],
+    "wallet_tiers": ["wallet_address", "tier", "changed_at"],
+    "tier_notifications": ["user_id", "wallet_address", "old_tier", "new_tier", "xai_balance", "created_at"],
+    "stream_cursors": ["stream", "cursor"],
+    "wallet_changes": ["seq", "user_id", "wallet_address", "changed_at"],
+    "counters": ["name", "value"],
+}
+# Conflict handling of the copy per table (default: keep the row already in Postgres). The
+# counters were created by Postgres' own migrations, so they move up to the copied value.
+MIGRATION_CONFLICT_CLAUSES = {
+    "counters": "ON CONFLICT (name) DO UPDATE SET value = GREATEST(counters.value, excluded.value)",
+}
+
+# Function to open the user database with the configured storage backend
+def open_database():
+    if STORAGE_BACKEND == "postgres":
+        return run_migrations(PostgresDatabase(DATABASE_URL, schema=DATABASE_SCHEMA))
+    if STORAGE_BACKEND == "sqlite":
+        return run_migrations(SQLiteDatabase(DATABASE_PATH, schema=DATABASE_SCHEMA))
+    raise ValueError(f"Unknown STORAGE_BACKEND {STORAGE_BACKEND!r}, expected 'sqlite' or 'postgres'")
+
+# Initialize the user database
+db = open_database()
+
+# Initialize the persistent Horizon page cache (always a local SQLite file). Account
+# history is append-only, so a full page read in ascending order never changes once it exists.
+page_cache_db = SQLiteDatabase(PAGE_CACHE_PATH, schema=[
+    '''CREATE TABLE IF NOT EXISTS horizon_pages (
+                    path TEXT,
+                    cursor TEXT,
+                    sort_order TEXT,
+                    page_limit INTEGER,
+                    records BLOB,
+                    PRIMARY KEY (path, cursor, sort_order, page_limit)
+                 )''',
+    # Where an interrupted history scan resumes: the paging token after the last page scanned
+    '''CREATE TABLE IF NOT EXISTS scan_cursors (
+                    path TEXT PRIMARY KEY,
+                    cursor TEXT
+                 )''',
+])
+
+# One-shot copy of an existing SQLite user database into Postgres (DATABASE_URL).
+# The SQLite file is first brought to the latest schema revision in place.
+# Rows already present in Postgres are left alone, so the command can be re-run.
+def migrate_sqlite_to_postgres(sqlite_path, batch_size=5000):
+    if not DATABASE_URL:
+        raise SystemExit("DATABASE_URL must point at the Postgres database to migrate into")
+
+    run_migrations(SQLiteDatabase(sqlite_path, schema=DATABASE_SCHEMA)).close()
+    source = sqlite3.connect(sqlite_path)
+    target = db if isinstance(db, PostgresDatabase) else run_migrations(PostgresDatabase(DATABASE_URL, schema=DATABASE_SCHEMA))
+    try:
+        existing_tables = {row[0] for row in source.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        for table, columns in MIGRATED_TABLES.items():
+            if table not in existing_tables:
+                continue
+            column_list = ", ".join(columns)
+            rows = source.execute(f"SELECT {column_list} FROM {table}")
+            copied = 0
+            while True:
+                batch = rows.fetchmany(batch_size)
+                if not batch:
+                    break
+                conflict_clause = MIGRATION_CONFLICT_CLAUSES.get(table, "ON CONFLICT DO NOTHING")
+                target.bulk_insert(f"INSERT INTO {table} ({column_list}) VALUES %s {conflict_clause}", batch)
+                copied += len(batch)
+            print(f"Copied {copied} rows of {table} (rows already in Postgres were skipped)")
+    finally:
+        source.close()
+        target.close()
+
+# Stellar Horizon endpoint
+HORIZON_URL = os.environ.get("HORIZON_URL", "https://horizon.stellar.org")
+
+# Shared SSL context and aiohttp session for all Horizon requests
+ssl_context = ssl.create_default_context(cafile=certifi.where())
+http_session = None
+
+# Concurrency caps for per-wallet work (Horizon calls) in the dividends and withdraw handlers
+WALLET_CONCURRENCY_PER_USER = int(os.environ.get("WALLET_CONCURRENCY_PER_USER", "5"))
+WALLET_CONCURRENCY_GLOBAL = int(os.environ.get("WALLET_CONCURRENCY_GLOBAL", "20"))
+global_wallet_semaphore = asyncio.Semaphore(WALLET_CONCURRENCY_GLOBAL)
+user_wallet_semaphores = {}  # user_id -> [asyncio.Semaphore, number of fan-outs using it]
+
+# Account cache settings: how long a Horizon account response is reused, and how many are kept
+ACCOUNT_CACHE_TTL = float(os.environ.get("ACCOUNT_CACHE_TTL", "30"))
+ACCOUNT_CACHE_SIZE = int(os.environ.get("ACCOUNT_CACHE_SIZE", "10000"))
+
+# Horizon request budget shared by everything in this process (requests per second, and how
+# many may be sent at once after a quiet period), and how failed requests are retried:
+# 429 and 5xx responses are retried up to HORIZON_MAX_RETRIES times with jittered
+# exponential backoff (or after Retry-After, when Horizon sends it)
+HORIZON_RATE_LIMIT = float(os.environ.get("HORIZON_RATE_LIMIT", "10"))
+HORIZON_BURST = int(os.environ.get("HORIZON_BURST", "20"))
+HORIZON_MAX_RETRIES = int(os.environ.get("HORIZON_MAX_RETRIES", "5"))
+HORIZON_BACKOFF_BASE = 0.5
+HORIZON_BACKOFF_MAX = 30
+
+# History scanner settings: Horizon's maximum page size and a safety cap on pages per stream
+HORIZON_PAGE_LIMIT = 200
+SCAN_MAX_PAGES = int(os.environ.get("SCAN_MAX_PAGES", "1000"))
+
+# XAI holder snapshot: how often it is refreshed, and how old it may get before
+# the handlers fall back to a live Horizon lookup (seconds)
+HOLDER_SNAPSHOT_INTERVAL = int(os.environ.get("HOLDER_SNAPSHOT_INTERVAL", "300"))
+HOLDER_SNAPSHOT_MAX_AGE = int(os.environ.get("HOLDER_SNAPSHOT_MAX_AGE", "900"))
+
+# Token prices: how often they are refreshed from Horizon, and after how long (seconds)
+# without a successful refresh the prices are flagged as outdated in the replies
+PRICE_REFRESH_INTERVAL = int(os.environ.get("PRICE_REFRESH_INTERVAL", "60"))
+PRICE_MAX_AGE = int(os.environ.get("PRICE_MAX_AGE", "900"))
+
+# Number of background workers scanning newly added wallets
+WALLET_SCAN_WORKERS = int(os.environ.get("WALLET_SCAN_WORKERS", "3"))
+# Delay (seconds) before a scan that failed because Horizon was busy or unreachable is retried
+WALLET_SCAN_RETRY_DELAY = int(os.environ.get("WALLET_SCAN_RETRY_DELAY", "60"))
+# Scan jobs older than WALLET_JOB_STALE_AFTER (seconds) are re-queued by the leader, checked
+# every WALLET_JOB_SWEEP_INTERVAL: the process that took them (e.g. a shard worker) may have
+# restarted before finishing the scan
+WALLET_JOB_STALE_AFTER = int(os.environ.get("WALLET_JOB_STALE_AFTER", "300"))
+WALLET_JOB_SWEEP_INTERVAL = 60
+
+# Queue of wallet addresses waiting for a scan, plus the addresses already queued or
+# being scanned (so several users adding the same address share one scan)
+wallet_scan_queue = asyncio.Queue()
+pending_wallet_scans = set()
+background_tasks = []
+
+# Number of updates processed at the same time (updates of one user still run in order)
+UPDATE_CONCURRENCY = int(os.environ.get("UPDATE_CONCURRENCY", "32"))
+# Queueing delay (seconds) above which an update is logged as slow
+SLOW_UPDATE_DELAY = float(os.environ.get("SLOW_UPDATE_DELAY", "2"))
+# Seconds the updates already queued get to finish on shutdown before they are cancelled
+UPDATE_SHUTDOWN_TIMEOUT = 10
+
+# Telegram bot token and Bot API endpoint (TELEGRAM_API_URL can point at a local Bot API server)
+BOT_TOKEN = os.environ.get("BOT_TOKEN")
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org/bot")
+
+# Webhook mode: when WEBHOOK_URL (the public https URL of this app) is set, updates are
+# received on an embedded HTTP server listening on PORT instead of by long polling.
+# Telegram sends WEBHOOK_SECRET with every update; it must be set with WEBHOOK_URL (the same
+# value on every instance behind a load balancer), see check_bot_settings.
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", "40"))
+PORT = int(os.environ.get("PORT", "8443"))
 
 # Example assets
 xai_asset = Asset("XAI", "GDW4UCJVOUIRLXVY4FWSXQJBCIA3QZPFMVRL3KMAIMTCXASWGBJFRXAI")
@@ -40,17 +565,403 @@ tbc_asset = Asset("TBC", "GA5I7GQNVWGC6ETTA4XUNG6FHNEJ4HEOD363VRMT7SCOAUXQMJBGOT
 nlink_asset = Asset("NLINK", "GBX743B3DQKLE5XUN5Z56GOIVMMXRKQJTIRQSVIY3AH3JJQA53EMLINK")
 starlink_asset = Asset("STARLINK", "GCKUU7BDNL7A4D7JABYE5WSHRXBPQJTKJYAAPEPNYJSV7CHRD5SSLINK")
 hyper_asset = Asset("HYPER", "GCIELJ7SU5DNTLRZLXEANRZ2Q7TBP4FDXAV52NQQWSBFCKSMDNZRHYPR")
+tesla_asset = Asset("TESLA", "GBDJ47CSXL4XKEVLCJ6C3OJE23GTX2Q2SCOBXJFDWB2DPU3C4A5ELONX")
+xelon_asset = Asset("XELON", "GDPK4GJW4VOYBMDNYNMWMRCEQFDESBNGLBTTI5VZ5LRSJBPVZTTELONX")
+
+#WALLET REGISTRY
+# How often (seconds) each process applies the wallet changes made by other processes, and
+# how long (seconds) the change log is kept
+WALLET_REGISTRY_POLL_INTERVAL = float(os.environ.get("WALLET_REGISTRY_POLL_INTERVAL", "2"))
+WALLET_CHANGES_TTL = 3600
+
+# A registered wallet address, shared by all users who registered it
+class RegisteredWallet:
+    __slots__ = ("address", "first_xai_at", "users")
+
+    def __init__(self, address, first_xai_at):
+        self.address = sys.intern(address)
+        self.first_xai_at = first_xai_at  # epoch seconds, or None
+        self.users = 0  # number of users who registered the address
+
+# In-memory copy of user_wallets, so handlers look up a user's wallets without a database
+# round trip. Loaded at startup; additions and removals are written to the database first
+# and then applied here (write-through). Every write also appends to wallet_changes, which
+# the other processes (shard workers, other instances) poll to refresh the users involved.
+class WalletRegistry:
+    def __init__(self):
+        self.wallets = {}  # address -> RegisteredWallet
+        self.users = {}  # user_id -> tuple of RegisteredWallet, in the order they were added
+        self.last_change = 0  # last wallet_changes.seq applied
+
+    # Function to load every user's wallets from the database
+    async def load(self):
+        await db.execute("INSERT INTO counters (name, value) VALUES ('wallet_changes', 0) ON CONFLICT DO NOTHING")
+        # Read the position in the change log first: changes made while loading are replayed
+        row = await db.fetchone("SELECT value FROM counters WHERE name = 'wallet_changes'")
+        self.last_change = row[0]
+        rows = await db.fetchall('SELECT user_id, wallet_address, first_xai_transaction_at FROM user_wallets ORDER BY added_seq')
+        self.wallets = {}
+        self.users = {}
+        self.apply_rows({user_id for user_id, wallet_address, first_xai_at in rows}, rows)
+        print(f"Loaded {len(self.wallets)} wallets of {len(self.users)} users")
+
+    # Function to get a user's wallets (a tuple of RegisteredWallet, in the order they were added)
+    def get_wallets(self, user_id):
+        return self.users.get(user_id, ())
+
+    # Function to get the first XAI transaction known for an address (None if unknown)
+    def get_first_xai_at(self, wallet_address):
+        wallet = self.wallets.get(wallet_address)
+        return wallet.first_xai_at if wallet else None
+
+    # Function to replace the wallets of user_ids with rows of (user_id, wallet_address, first_xai_at),
+    # keeping the order of the rows (an address listed twice for a user counts once, at its
+    # first place, keeping the known first XAI transaction)
+    def apply_rows(self, user_ids, rows):
+        user_rows = {user_id: {} for user_id in user_ids}
+        for user_id, wallet_address, first_xai_at in rows:
+            wallet_rows = user_rows[user_id]
+            if wallet_rows.get(wallet_address) is None:
+                wallet_rows[wallet_address] = first_xai_at
+
+        for user_id, wallet_rows in user_rows.items():
+            for wallet in self.users.pop(user_id, ()):
+                wallet.users -= 1
+                if not wallet.users:
+                    del self.wallets[wallet.address]
+            wallets = []
+            for wallet_address, first_xai_at in wallet_rows.items():
+                wallet = self.wallets.get(wallet_address)
+                if wallet is None:
+                    wallet = self.wallets[wallet_address] = RegisteredWallet(wallet_address, first_xai_at)
+                elif wallet.first_xai_at is None:
+                    wallet.first_xai_at = first_xai_at
+                wallet.users += 1
+                wallets.append(wallet)
+            if wallets:
+                self.users[user_id] = tuple(wallets)
+
+    # Statements appending a change of user_id's wallets (or, with user_id None, of the
+    # address' first XAI transaction) to the change log, in the writer's transaction
+    @staticmethod
+    def change_statements(user_id, wallet_address):
+        return [
+            ("UPDATE counters SET value = value + 1 WHERE name = 'wallet_changes'", ()),
+            ("INSERT INTO wallet_changes (seq, user_id, wallet_address, changed_at) "
+             "SELECT value, ?, ?, ? FROM counters WHERE name = 'wallet_changes'",
+             (user_id, wallet_address, int(time.time()))),
+        ]
+
+    # Function to register wallets, rows of (user_id, wallet_address, first_xai_at). New wallets
+    # go after the user's other wallets; a wallet added again keeps its place.
+    async def add(self, rows):
+        if not rows:
+            return
+        statements = []
+        for user_id, wallet_address, first_xai_at in rows:
+            statements.append(("UPDATE counters SET value = value + 1 WHERE name = 'wallet_positions'", ()))
+            statements.append((
+                'INSERT INTO user_wallets (user_id, wallet_address, first_xai_transaction_at, added_seq) '
+                "SELECT ?, ?, ?, value FROM counters WHERE name = 'wallet_positions' "
+                'ON CONFLICT (user_id, wallet_address) DO UPDATE SET first_xai_transaction_at = '
+                'COALESCE(user_wallets.first_xai_transaction_at, excluded.first_xai_transaction_at)',
+                (user_id, wallet_address, first_xai_at)
+            ))
+            statements.extend(self.change_statements(user_id, wallet_address))
+        await db.execute_many(statements)
+
+        user_ids = {user_id for user_id, wallet_address, first_xai_at in rows}
+        current = [
+            (user_id, wallet.address, wallet.first_xai_at)
+            for user_id in user_ids for wallet in self.get_wallets(user_id)
+        ]
+        self.apply_rows(user_ids, current + list(rows))
+
+    # Function to remove a wallet from a user
+    async def remove(self, user_id, wallet_address):
+        await db.execute_many([
+            ('DELETE FROM user_wallets WHERE user_id = ? AND wallet_address = ?', (user_id, wallet_address)),
+            *self.change_statements(user_id, wallet_address),
+        ])
+        self.apply_rows({user_id}, [
+            (user_id, wallet.address, wallet.first_xai_at)
+            for wallet in self.get_wallets(user_id) if wallet.address != wallet_address
+        ])
+
+    # Function to record the first XAI transaction of addresses that don't have one yet
+    async def set_first_xai_at(self, wallet_addresses, first_xai_at):
+        statements = []
+        for wallet_address in wallet_addresses:
+            statements.append((
+                'UPDATE user_wallets SET first_xai_transaction_at = ? WHERE wallet_address = ? AND first_xai_transaction_at IS NULL',
+                (first_xai_at, wallet_address)
+            ))
+            statements.extend(self.change_statements(None, wallet_address))
+        await db.execute_many(statements)
+
+        for wallet_address in wallet_addresses:
+            wallet = self.wallets.get(wallet_address)
+            if wallet is not None and wallet.first_xai_at is None:
+                wallet.first_xai_at = first_xai_at
+
+    # Function to apply the changes other processes logged since the last poll
+    # (this process' own changes come back too, reloading them is harmless)
+    async def poll_changes(self):
+        changes = await db.fetchall(
+            'SELECT seq, user_id, wallet_address FROM wallet_changes WHERE seq > ? ORDER BY seq', (self.last_change,)
+        )
+        if not changes:
+            return 0
+
+        user_ids = sorted({user_id for seq, user_id, wallet_address in changes if user_id is not None})
+        if user_ids:
+            placeholders = ", ".join("?" * len(user_ids))
+            rows = await db.fetchall(
+                f'SELECT user_id, wallet_address, first_xai_transaction_at FROM user_wallets WHERE user_id IN ({placeholders}) ORDER BY added_seq',
+                user_ids
+            )
+            self.apply_rows(user_ids, rows)
+
+        wallet_addresses = sorted({wallet_address for seq, user_id, wallet_address in changes if user_id is None})
+        if wallet_addresses:
+            placeholders = ", ".join("?" * len(wallet_addresses))
+            rows = await db.fetchall(
+                f'SELECT wallet_address, MIN(first_xai_transaction_at) FROM user_wallets '
+                f'WHERE wallet_address IN ({placeholders}) GROUP BY wallet_address',
+                wallet_addresses
+            )
+            for wallet_address, first_xai_at in rows:
+                wallet = self.wallets.get(wallet_address)
+                if wallet is not None:
+                    wallet.first_xai_at = first_xai_at
 
-# Function to add wallet to the database
-def add_wallet_to_db(user_id, wallet_address, first_xai_transaction_date):
-    cursor.execute('INSERT OR IGNORE INTO user_wallets (user_id, wallet_address, first_xai_transaction_date) VALUES (?, ?, ?)', 
-                   (user_id, wallet_address, first_xai_transaction_date))
-    conn.commit()
+        self.last_change = changes[-1][0]
+        return len(changes)
 
-# Function to get wallets from the database
-def get_wallets_from_db(user_id):
-    cursor.execute('SELECT wallet_address FROM user_wallets WHERE user_id = ?', (user_id,))
-    return [row[0] for row in cursor.fetchall()]
+wallet_registry = WalletRegistry()
+
+# Function to apply other processes' wallet changes; the leader also trims the change log
+async def wallet_registry_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        await wallet_registry.poll_changes()
+        if leader_lease.is_leader:
+            await db.execute('DELETE FROM wallet_changes WHERE changed_at < ?', (int(time.time()) - WALLET_CHANGES_TTL,))
+    except Exception as e:
+        print(f"Wallet registry refresh failed: {e}")
+
+# Function to get a user's wallet addresses (from the registry, no database access)
+def get_user_wallets(user_id):
+    return [wallet.address for wallet in wallet_registry.get_wallets(user_id)]
+
+# Function to get everything the dividends handler needs for a user's wallets, with the
+# balances in one query: (wallet_address, first_xai_transaction_at, snapshot balances JSON, snapshot_at)
+async def get_user_wallet_rows(user_id):
+    wallets = wallet_registry.get_wallets(user_id)
+    if not wallets:
+        return []
+    placeholders = ", ".join("?" * len(wallets))
+    rows = await db.fetchall(
+        f'SELECT wallet_address, balances, snapshot_at FROM wallet_balances WHERE wallet_address IN ({placeholders})',
+        [wallet.address for wallet in wallets]
+    )
+    snapshots = {wallet_address: (balances, snapshot_at) for wallet_address, balances, snapshot_at in rows}
+    return [(wallet.address, wallet.first_xai_at, *snapshots.get(wallet.address, (None, None))) for wallet in wallets]
+
+# Function to get the shared aiohttp session (created lazily on the running event loop)
+def get_http_session():
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(ssl=ssl_context, limit=50),
+            timeout=aiohttp.ClientTimeout(total=10),
+        )
+    return http_session
+
+# Function to close the shared aiohttp session when the bot shuts down
+async def close_http_session(application):
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+    http_session = None
+
+# Request priorities: what a user is waiting on goes before background scans and jobs
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+# Process-wide token bucket for Horizon requests. Requests wait for a token in priority
+# order (FIFO within a priority), so background scans never hold up a user's tap for
+# longer than one token. After a 429 every request pauses until Horizon's Retry-After.
+class HorizonGovernor:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.waiters = []  # heap of (priority, sequence number, future)
+        self.sequence = 0
+        self.timer = None
+        self.requests = 0
+        self.retries = 0
+
+    # Wait for permission to send one request
+    async def acquire(self, priority):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, self.sequence, future))
+        self.sequence += 1
+        self._dispatch()
+        await future
+        self.requests += 1
+
+    # Stop all requests for a while (Horizon asked us to back off)
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self._dispatch()
+
+    def _on_timer(self):
+        self.timer = None
+        self._dispatch()
+
+    def _dispatch(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+        while self.waiters and self.tokens >= 1 and now >= self.paused_until:
+            priority, sequence, future = heapq.heappop(self.waiters)
+            # Skip waiters that were cancelled while queued
+            if future.done():
+                continue
+            self.tokens -= 1
+            future.set_result(None)
+
+        if self.waiters and self.timer is None:
+            delay = max((1 - self.tokens) / self.rate, self.paused_until - now, 0)
+            self.timer = asyncio.get_running_loop().call_later(delay, self._on_timer)
+
+    def stats(self):
+        return {"requests": self.requests, "retries": self.retries, "waiting": len(self.waiters), "tokens": self.tokens}
+
+horizon_governor = HorizonGovernor(HORIZON_RATE_LIMIT, HORIZON_BURST)
+
+# Function to get how long to wait before retrying a failed request
+def get_retry_delay(response, attempt):
+    retry_after = response.headers.get("Retry-After")
+    if retry_after:
+        try:
+            return min(float(retry_after), HORIZON_BACKOFF_MAX)
+        except ValueError:
+            pass
+    # Full jitter, so many callers that failed together don't retry together
+    return random.uniform(0, min(HORIZON_BACKOFF_MAX, HORIZON_BACKOFF_BASE * 2 ** attempt))
+
+# Function to GET a Horizon endpoint as JSON, within the request budget and with retries
+# of 429 and 5xx responses. Raises aiohttp.ClientResponseError once retries are exhausted.
+async def horizon_get(path, params=None, priority=PRIORITY_BACKGROUND):
+    session = get_http_session()
+    for attempt in range(HORIZON_MAX_RETRIES + 1):
+        await horizon_governor.acquire(priority)
+        async with session.get(f"{HORIZON_URL}{path}", params=params) as response:
+            if (response.status == 429 or response.status >= 500) and attempt < HORIZON_MAX_RETRIES:
+                delay = get_retry_delay(response, attempt)
+                if response.status == 429:
+                    horizon_governor.pause(delay)
+                horizon_governor.retries += 1
+            else:
+                response.raise_for_status()
+                return await response.json()
+        await asyncio.sleep(delay)
+
+# Check if a Horizon failure is temporary (rate limited, server error or unreachable)
+def is_transient_horizon_error(error):
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status == 429 or error.status >= 500
+    return isinstance(error, (aiohttp.ClientConnectionError, asyncio.TimeoutError))
+
+# Function to fetch account data from Horizon without blocking the event loop
+async def fetch_account(wallet_address):
+    return await horizon_get(f"/accounts/{wallet_address}", priority=PRIORITY_INTERACTIVE)
+
+# In-process TTL cache for Horizon account data with LRU eviction.
+# Concurrent misses for the same wallet share one in-flight request.
+class AccountCache:
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()  # wallet_address -> (expires_at, account)
+        self.in_flight = {}  # wallet_address -> asyncio.Task
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def get(self, wallet_address, fetch):
+        entry = self.entries.get(wallet_address)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self.entries.move_to_end(wallet_address)
+                self.hits += 1
+                return entry[1]
+            del self.entries[wallet_address]
+
+        self.misses += 1
+        task = self.in_flight.get(wallet_address)
+        if task is None:
+            task = asyncio.create_task(self._load(wallet_address, fetch))
+            self.in_flight[wallet_address] = task
+        else:
+            self.coalesced += 1
+        # Shield the shared request so one cancelled caller doesn't cancel it for the others
+        return await asyncio.shield(task)
+
+    async def _load(self, wallet_address, fetch):
+        try:
+            account = await fetch(wallet_address)
+            self.entries[wallet_address] = (time.monotonic() + self.ttl, account)
+            self.entries.move_to_end(wallet_address)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+            return account
+        finally:
+            self.in_flight.pop(wallet_address, None)
+
+    def invalidate(self, wallet_address):
+        self.entries.pop(wallet_address, None)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "size": len(self.entries),
+        }
+
+account_cache = AccountCache(ACCOUNT_CACHE_TTL, ACCOUNT_CACHE_SIZE)
+
+# Function to get account data through the shared cache (use this instead of fetch_account)
+async def get_account(wallet_address):
+    return await account_cache.get(wallet_address, fetch_account)
+
+# Function to run a per-wallet coroutine for all of a user's wallets (addresses or rows) concurrently.
+# Results come back in the original wallet order; an exception raised for one wallet
+# is returned in its slot instead of cancelling the others.
+async def run_for_wallets(user_id, wallets, wallet_func):
+    entry = user_wallet_semaphores.get(user_id)
+    if entry is None:
+        entry = user_wallet_semaphores[user_id] = [asyncio.Semaphore(WALLET_CONCURRENCY_PER_USER), 0]
+    user_semaphore = entry[0]
+    entry[1] += 1
+
+    async def run_one(wallet):
+        async with user_semaphore, global_wallet_semaphore:
+            return await wallet_func(wallet)
+
+    try:
+        return await asyncio.gather(*(run_one(wallet) for wallet in wallets), return_exceptions=True)
+    finally:
+        # Drop the semaphore once no fan-out of this user uses it, so the dict only holds active users
+        entry[1] -= 1
+        if entry[1] == 0:
+            del user_wallet_semaphores[user_id]
 
 # Function to get the custom keyboard
 def get_custom_keyboard():
@@ -90,7 +1001,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # Wallet button handler (updated with Remove button)
 async def handle_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
-    wallets = get_wallets_from_db(user_id)
+    wallets = get_user_wallets(user_id)
     if not wallets:
         await update.message.reply_text(
             "*❌There is no wallet recorded for your account.*\n✅Please send your Stellar PUBLIC KEY to add it.", parse_mode="Markdown")
@@ -107,11 +1018,6 @@ async def handle_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "*👝Here are your wallets:*", parse_mode="Markdown", reply_markup=reply_markup)
         await update.message.reply_text(
             "*✅To add another wallet, please send your Stellar PUBLIC KEY.*", parse_mode="Markdown")
-            
-            # Function to remove wallet from the database
-def remove_wallet_from_db(user_id, wallet_address):
-    cursor.execute('DELETE FROM user_wallets WHERE user_id = ? AND wallet_address = ?', (user_id, wallet_address))
-    conn.commit()
 
 # Handler for removing a wallet
 async def handle_remove_wallet_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -121,7 +1027,7 @@ async def handle_remove_wallet_click(update: Update, context: ContextTypes.DEFAU
     if data.startswith("remove_"):
         wallet_address = data.split("_", 1)[1]
         user_id = query.from_user.id  # Use query.from_user to get the user ID
-        remove_wallet_from_db(user_id, wallet_address)
+        await wallet_registry.remove(user_id, wallet_address)
         
         # Notify the user that the wallet was removed
         await query.edit_message_text(f"❌ Wallet {wallet_address} has been removed.")
@@ -129,109 +1035,680 @@ async def handle_remove_wallet_click(update: Update, context: ContextTypes.DEFAU
         # Show the updated wallet list (this time we need to pass `query` instead of `update`)
         await handle_wallet(query, context)
 
-# Add a timeout to the fetch call
-from concurrent.futures import ThreadPoolExecutor
+#FIRST TRANS
+# Function to read a cached Horizon page, returns None if the page isn't cached
+async def get_cached_page(path, cursor, order, limit):
+    row = await page_cache_db.fetchone(
+        'SELECT records FROM horizon_pages WHERE path = ? AND cursor = ? AND sort_order = ? AND page_limit = ?',
+        (path, cursor or "", order, limit)
+    )
+    return json.loads(zlib.decompress(row[0])) if row else None
 
-executor = ThreadPoolExecutor(max_workers=3)
+# Function to store a full Horizon page in the cache
+async def store_cached_page(path, cursor, order, limit, records):
+    await page_cache_db.execute(
+        'INSERT OR IGNORE INTO horizon_pages (path, cursor, sort_order, page_limit, records) VALUES (?, ?, ?, ?, ?)',
+        (path, cursor or "", order, limit, zlib.compress(json.dumps(records).encode()))
+    )
 
-#FIRST TRANS
+# Function to fetch one page of records from a Horizon collection endpoint.
+# Full ascending pages are served from / saved to the page cache; only the
+# last, still growing page of a history goes to the network every time.
+# Pass cache=False for collections that aren't append-only history.
+async def fetch_horizon_records(path, cursor=None, order="asc", limit=HORIZON_PAGE_LIMIT, query=None, cache=True):
+    cache = cache and order == "asc"
+    if cache:
+        records = await get_cached_page(path, cursor, order, limit)
+        if records is not None:
+            return records
+
+    params = dict(query or {})
+    params.update({"order": order, "limit": str(limit)})
+    if cursor:
+        params["cursor"] = cursor
+    page = await horizon_get(path, params)
+    records = page.get('_embedded', {}).get('records', [])
+
+    if cache and len(records) == limit:
+        await store_cached_page(path, cursor, order, limit, records)
+    return records
+
+# Async generator over the pages of a Horizon collection in ascending order, starting after
+# cursor if given. The request for the next page is started before the current page is
+# handed to the caller, so parsing overlaps with the network round trip.
+async def iter_horizon_pages(path, max_pages=SCAN_MAX_PAGES, query=None, cache=True, cursor=None):
+    next_page = asyncio.create_task(fetch_horizon_records(path, cursor=cursor, query=query, cache=cache))
+    try:
+        for _ in range(max_pages):
+            records = await next_page
+            next_page = None
+            if not records:
+                return
+            # A short page is the end of the history, don't ask for another one
+            if len(records) == HORIZON_PAGE_LIMIT:
+                next_page = asyncio.create_task(
+                    fetch_horizon_records(path, cursor=records[-1]['paging_token'], query=query, cache=cache)
+                )
+            yield records
+            if next_page is None:
+                return
+    finally:
+        if next_page is not None:
+            next_page.cancel()
+
+# Check if a payment record moved XAI (either as the delivered or the source asset)
+def is_xai_payment(record):
+    return (
+        (record.get('asset_code') == 'XAI' and record.get('asset_issuer') == xai_asset.issuer) or
+        (record.get('source_asset_code') == 'XAI' and record.get('source_asset_issuer') == xai_asset.issuer)
+    )
+
+# Check if a trade record has XAI on either side
+def is_xai_trade(record):
+    return (
+        (record.get('base_asset_code') == 'XAI' and record.get('base_asset_issuer') == xai_asset.issuer) or
+        (record.get('counter_asset_code') == 'XAI' and record.get('counter_asset_issuer') == xai_asset.issuer)
+    )
+
+# Scan one history stream for its first XAI record and return its timestamp.
+# found_times is shared between the streams scanned in parallel: once another
+# stream has found an earlier match, this one stops as soon as it passes it.
+# Progress is saved after every page, so a scan interrupted by a Horizon failure
+# continues where it stopped instead of starting over.
+async def scan_first_xai_record(path, is_match, time_field, found_times):
+    row = await page_cache_db.fetchone('SELECT cursor FROM scan_cursors WHERE path = ?', (path,))
+    result = None
+    async with aclosing(iter_horizon_pages(path, cursor=row[0] if row else None)) as pages:
+        async for records in pages:
+            for record in records:
+                record_time = record[time_field]
+                if found_times and record_time >= min(found_times):
+                    break
+                if is_match(record):
+                    found_times.append(record_time)
+                    result = record_time
+                    break
+            else:
+                # Nothing in this page: a later scan can skip it
+                await page_cache_db.execute(
+                    'INSERT INTO scan_cursors (path, cursor) VALUES (?, ?) ON CONFLICT (path) DO UPDATE SET cursor = excluded.cursor',
+                    (path, records[-1]['paging_token'])
+                )
+                continue
+            break
+
+    await page_cache_db.execute('DELETE FROM scan_cursors WHERE path = ?', (path,))
+    return result
+
+# Function to find the timestamp of the first XAI payment or trade of a wallet.
+# Only payments and trades are scanned (in parallel), not the full operations
+# history, so offer management and other noise doesn't have to be paged through.
+# Returns Horizon's ISO timestamp, or None if the wallet never touched XAI.
+async def find_first_xai_transaction(wallet_address):
+    found_times = []
+    results = await asyncio.gather(
+        scan_first_xai_record(f"/accounts/{wallet_address}/payments", is_xai_payment, 'created_at', found_times),
+        scan_first_xai_record(f"/accounts/{wallet_address}/trades", is_xai_trade, 'ledger_close_time', found_times),
+    )
+    matches = [result for result in results if result]
+    return min(matches) if matches else None
+
+# Function to convert a Horizon ISO timestamp to epoch seconds
+def parse_horizon_time(value):
+    return int(datetime.strptime(value, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc).timestamp())
+
+# Function to format an epoch timestamp for display
+def format_transaction_time(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%d\n%H:%M:%S UTC")
+
+# Function to scan a wallet for its first XAI transaction.
+# Returns (epoch seconds or None, text for the user: the formatted date, an error or None)
 async def get_first_xai_transaction_date(wallet_address):
     try:
-        ssl_context = ssl.create_default_context(cafile=certifi.where())
-        cursor = None
-        max_iterations = 5000  # Increase the number of iterations to cover more records if needed
-        iteration = 0
-        batch_size = 90  # Adjust this to make smaller requests for faster processing
-        
-        async with aiohttp.ClientSession() as session:
-            while iteration < max_iterations:
-                # Create URL for operations, paginated with cursor, requesting smaller batches
-                url = f"https://horizon.stellar.org/accounts/{wallet_address}/operations?order=asc&limit={batch_size}"
-                if cursor:
-                    url += f"&cursor={cursor}"
-
-                async with session.get(url, ssl=ssl_context, timeout=10) as response:
-                    if response.status != 200:
-                        return f"Error fetching transaction history: Status Code {response.status}"
-
-                    operations = await response.json()
-                    records = operations.get('_embedded', {}).get('records', [])
-                    if not records:
-                        return "No transactions found."
-
-                    # Search for the first XAI-related buy/sell offer or payment
-                    for record in records:
-                        if record['type'] in ['manage_buy_offer', 'manage_sell_offer', 'create_passive_sell_offer', 'payment', 'path_payment_strict_receive', 'path_payment_strict_send']:
-                            if (
-                                ('asset_code' in record and record['asset_code'] == 'XAI' and record.get('asset_issuer') == xai_asset.issuer) or
-                                ('selling_asset_code' in record and record['selling_asset_code'] == 'XAI' and record.get('selling_asset_issuer') == xai_asset.issuer) or
-                                ('buying_asset_code' in record and record['buying_asset_code'] == 'XAI' and record.get('buying_asset_issuer') == xai_asset.issuer)
-                            ):
-                                # Format the date to the desired output
-                                transaction_date = record['created_at']
-                                formatted_date = datetime.strptime(transaction_date, "%Y-%m-%dT%H:%M:%SZ").strftime("%Y-%m-%d\n%H:%M:%S UTC")
-                                return formatted_date
-
-                    # Prepare for next iteration if there are more records
-                    cursor = records[-1]['paging_token']
-                    iteration += 1
-
-            # If no XAI transaction was found within the limited iterations
-            return "No XAI transactions found in recent history."
-                
-    except aiohttp.ClientError as e:
-        return f"Error: Unable to connect to Horizon API. {e}"
-    except asyncio.TimeoutError:
-        return "Error: Request timed out. Please try again later."
-    except Exception as e:
-        return f"Error fetching transaction history: {e}"
+        transaction_date = await find_first_xai_transaction(wallet_address)
+        if transaction_date is None:
+            return None, None
 
-    return None
+        first_xai_at = parse_horizon_time(transaction_date)
+        return first_xai_at, format_transaction_time(first_xai_at)
+
+    except Exception as e:
+        # Horizon being busy or unreachable says nothing about the wallet: the scan is retried
+        if is_transient_horizon_error(e):
+            raise
+        if isinstance(e, aiohttp.ClientResponseError):
+            return None, f"Error fetching transaction history: Status Code {e.status}"
+        return None, f"Error fetching transaction history: {e}"
     
 # Properly escape special characters in MarkdownV2
 def escape_markdown_v2(text):
     # Escape all special characters for MarkdownV2
     return re.sub(r'([_*\[\]()~`>#+\-=|{}.!\\])', r'\\\1', text)
 
+#OUTBOUND MESSAGES
+# Telegram's limit on the length of one message
+TELEGRAM_MESSAGE_LIMIT = 4096
+# Send rates enforced by the rate limiter: messages per second for the whole bot (split between
+# the shard workers when WORKER_PROCESSES > 1), messages per minute per group, and messages per TELEGRAM_CHAT_PERIOD seconds per private chat.
+# A request answered with RetryAfter is retried up to TELEGRAM_MAX_RETRIES times.
+TELEGRAM_GLOBAL_RATE = int(os.environ.get("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_GROUP_RATE = int(os.environ.get("TELEGRAM_GROUP_RATE", "20"))
+TELEGRAM_CHAT_RATE = int(os.environ.get("TELEGRAM_CHAT_RATE", "3"))
+TELEGRAM_CHAT_PERIOD = int(os.environ.get("TELEGRAM_CHAT_PERIOD", "3"))
+TELEGRAM_MAX_RETRIES = int(os.environ.get("TELEGRAM_MAX_RETRIES", "3"))
+# Number of private chats whose send rate is tracked (least recently used ones are dropped)
+TELEGRAM_CHAT_LIMITERS = 10000
+
+# Rate limiter for everything the bot sends. AIORateLimiter queues requests to stay under the
+# global and per-group limits and retries on RetryAfter; this adds a limit per private chat,
+# so a user who taps quickly gets paced instead of flood-banned.
+class ChatRateLimiter(AIORateLimiter):
+    def __init__(self, chat_max_rate, chat_time_period, **kwargs):
+        super().__init__(**kwargs)
+        self.chat_max_rate = chat_max_rate
+        self.chat_time_period = chat_time_period
+        self.chat_limiters = OrderedDict()  # chat_id -> AsyncLimiter
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if not isinstance(chat_id, int) or chat_id < 0:
+            return await super().process_request(callback, args, kwargs, endpoint, data, rate_limit_args)
+
+        limiter = self.chat_limiters.get(chat_id)
+        if limiter is None:
+            limiter = self.chat_limiters[chat_id] = AsyncLimiter(self.chat_max_rate, self.chat_time_period)
+            if len(self.chat_limiters) > TELEGRAM_CHAT_LIMITERS:
+                self.chat_limiters.popitem(last=False)
+        else:
+            self.chat_limiters.move_to_end(chat_id)
+
+        async with limiter:
+            return await super().process_request(callback, args, kwargs, endpoint, data, rate_limit_args)
+
+# Function to get the length of a text the way Telegram counts it (UTF-16 code units, so most emoji count twice)
+def message_length(text):
+    return len(text.encode("utf-16-le")) // 2
+
+# Opening and closing HTML tags
+HTML_TAG = re.compile(r"<(/?)([a-zA-Z-]+)[^>]*>")
+
+# Function to get the HTML tags left open at the end of a text, as [(name, opening tag)]
+def get_open_html_tags(text):
+    open_tags = []
+    for match in HTML_TAG.finditer(text):
+        if not match.group(1):
+            open_tags.append((match.group(2), match.group(0)))
+        elif open_tags and open_tags[-1][0] == match.group(2):
+            open_tags.pop()
+    return open_tags
+
+# Function to move a cut with no whitespace to use back to before an unclosed tag or entity
+def hard_cut(line, max_cut):
+    cut = max_cut
+    while True:
+        tag_start = line.rfind("<", 0, cut)
+        entity_start = line.rfind("&", 0, cut)
+        if tag_start > line.rfind(">", 0, cut):
+            new_cut = tag_start
+        elif entity_start > line.rfind(";", 0, cut):
+            new_cut = entity_start
+        else:
+            return cut
+        if new_cut <= 0:
+            return max_cut  # a tag or entity longer than a piece cannot be kept whole
+        cut = new_cut
+
+# Function to split one line that is too long for a message. Cuts at whitespace outside of
+# tags; with HTML, tags open at a cut are closed and reopened in the next piece, and a cut
+# without whitespace is moved back out of any tag or entity (e.g. &amp;) it would split.
+def split_long_line(line, limit, parse_mode):
+    pieces = []
+    reserve = 100 if parse_mode == "HTML" else 0  # room for closing tags
+    while message_length(line) > limit:
+        # Cut in characters, leaving room for characters that count twice
+        max_cut = limit - reserve
+        if message_length(line[:max_cut]) > max_cut:
+            max_cut //= 2
+        cut = line.rfind(" ", 0, max_cut)
+        while cut > 0 and line.rfind("<", 0, cut) > line.rfind(">", 0, cut):
+            cut = line.rfind(" ", 0, cut)
+        if cut <= 0:
+            cut = hard_cut(line, max_cut) if parse_mode == "HTML" else max_cut
+        piece, line = line[:cut], line[cut:].lstrip()
+        if parse_mode == "HTML":
+            open_tags = get_open_html_tags(piece)
+            piece += "".join(f"</{name}>" for name, tag in reversed(open_tags))
+            line = "".join(tag for name, tag in open_tags) + line
+        pieces.append(piece)
+    pieces.append(line)
+    return pieces
+
+# Function to pack message blocks (e.g. one per wallet) into as few messages as possible.
+# Blocks are kept whole when they fit; longer blocks are split between lines.
+def pack_message_blocks(blocks, parse_mode=None, separator="\n\n", limit=TELEGRAM_MESSAGE_LIMIT):
+    pieces = []
+    for block in blocks:
+        if message_length(block) <= limit:
+            pieces.append((block, separator))
+            continue
+        for line in block.split("\n"):
+            pieces.extend((piece, "\n") for piece in split_long_line(line, limit, parse_mode))
+        pieces[-1] = (pieces[-1][0], separator)
+
+    messages = []
+    current = ""
+    current_separator = ""
+    for piece, piece_separator in pieces:
+        if current and message_length(current) + len(current_separator) + message_length(piece) <= limit:
+            current += current_separator + piece
+        else:
+            if current:
+                messages.append(current)
+            current = piece
+        current_separator = piece_separator
+    if current:
+        messages.append(current)
+    return messages
+
+# Function to reply with message blocks, coalesced into as few messages as possible
+async def reply_blocks(message, blocks, parse_mode=None):
+    for text in pack_message_blocks(blocks, parse_mode):
+        await message.reply_text(text, parse_mode=parse_mode)
+
 #AD WALLET
-# Function to add a wallet and fetch the first XAI transaction date
+# Function to add a wallet: the history scan runs as a background job and the
+# user gets the first XAI transaction date in a follow-up message
 async def add_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
     wallet_address = update.message.text.strip()
 
-    if wallet_address.startswith("G") and len(wallet_address) == 56:
-        # Send an immediate message to notify the user that the fetching process has started
-        await update.message.reply_text("⏳ Fetching your wallet info... Please wait.")
+    # A pasted list of addresses is imported in one go
+    if len(re.split(r"[\s,;]+", wallet_address)) > 1:
+        await start_wallet_import(update, context, wallet_address)
+        return
 
-        # Fetch the first XAI transaction date in the same flow
-        first_xai_date = await get_first_xai_transaction_date(wallet_address)
-        
-        # After fetching, continue with adding the wallet to the database
-        if first_xai_date:
-            # Store the wallet and first XAI transaction date in the database
-            add_wallet_to_db(user_id, wallet_address, first_xai_date)
-            
-            # Properly escape special characters in the wallet address for HTML mode
-            escaped_wallet_address = wallet_address.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    if wallet_address in get_user_wallets(user_id):
+        await update.message.reply_text("👝 This wallet is already in your wallets.")
+    elif is_valid_wallet_address(wallet_address):
+        await enqueue_wallet_scan(user_id, update.message.chat_id, wallet_address)
 
-            await update.message.reply_text(
-                f"✅ Wallet <code>{escaped_wallet_address}</code> added successfully!\n📅 First XAI transaction on: {first_xai_date}",
-                parse_mode="HTML"
-            )
-        else:
-            # If no XAI transactions are found, handle that case
-            escaped_wallet_address = wallet_address.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
-            await update.message.reply_text(
-                f"✅ Wallet <code>{escaped_wallet_address}</code> added successfully!\n⚠️ No XAI transactions found.",
-                parse_mode="HTML"
-            )
+        # Acknowledge right away, the result is pushed when the scan finishes
+        await update.message.reply_text("⏳ Fetching your wallet info... You will get a message when it's ready.")
     else:
         # If the wallet address is invalid, send an error message
         await update.message.reply_text(
             "❌ Invalid wallet address.\nPlease send a valid Stellar wallet address starting with 'G'.",
             parse_mode="HTML"
         )
-            
+
+#WALLET SCAN JOBS
+# Function to record a wallet scan job and queue the address if it isn't queued yet
+async def enqueue_wallet_scan(user_id, chat_id, wallet_address):
+    await db.execute(
+        'INSERT INTO wallet_jobs (user_id, chat_id, wallet_address, created_at) VALUES (?, ?, ?, ?) '
+        'ON CONFLICT (user_id, wallet_address) DO UPDATE SET chat_id = excluded.chat_id, created_at = excluded.created_at',
+        (user_id, chat_id, wallet_address, int(time.time()))
+    )
+    queue_wallet_scan(wallet_address)
+
+def queue_wallet_scan(wallet_address):
+    if wallet_address not in pending_wallet_scans:
+        pending_wallet_scans.add(wallet_address)
+        wallet_scan_queue.put_nowait(wallet_address)
+
+# Function to take all jobs waiting on a wallet address out of the database
+async def pop_wallet_jobs(wallet_address):
+    return await db.execute('DELETE FROM wallet_jobs WHERE wallet_address = ? RETURNING user_id, chat_id', (wallet_address,))
+
+# Function to build the message sent when a wallet scan has finished
+def format_wallet_added_message(wallet_address, first_xai_date):
+    # Properly escape special characters in the wallet address for HTML mode
+    escaped_wallet_address = wallet_address.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    if first_xai_date:
+        return f"✅ Wallet <code>{escaped_wallet_address}</code> added successfully!\n📅 First XAI transaction on: {first_xai_date}"
+    # If no XAI transactions are found, handle that case
+    return f"✅ Wallet <code>{escaped_wallet_address}</code> added successfully!\n⚠️ No XAI transactions found."
+
+# Background worker: scans queued wallets, stores them for every user waiting on
+# the address and pushes the result to their chats
+async def wallet_scan_worker(application):
+    while True:
+        wallet_address = await wallet_scan_queue.get()
+        try:
+            # A wallet another user registered already has its first XAI transaction (kept
+            # current by the Horizon streams), only unknown wallets need a history scan
+            first_xai_at = wallet_registry.get_first_xai_at(wallet_address)
+            if first_xai_at is not None:
+                first_xai_date = format_transaction_time(first_xai_at)
+            else:
+                first_xai_at, first_xai_date = await get_first_xai_transaction_date(wallet_address)
+
+            # Discard the address before taking its jobs: a job added from now on queues a
+            # new scan (served from the page cache) instead of being lost
+            pending_wallet_scans.discard(wallet_address)
+            jobs = await pop_wallet_jobs(wallet_address)
+            await wallet_registry.add([(user_id, wallet_address, first_xai_at) for user_id, chat_id in jobs])
+
+            message = format_wallet_added_message(wallet_address, first_xai_date)
+            for user_id, chat_id in jobs:
+                try:
+                    await application.bot.send_message(chat_id, message, parse_mode="HTML")
+                except Exception as e:
+                    print(f"Could not notify chat {chat_id} about wallet {wallet_address}: {e}")
+        except Exception as e:
+            if is_transient_horizon_error(e):
+                # Try again later; the scan resumes from its saved cursor
+                print(f"Wallet scan for {wallet_address} interrupted ({e!r}), retrying in {WALLET_SCAN_RETRY_DELAY}s")
+                asyncio.get_running_loop().call_later(WALLET_SCAN_RETRY_DELAY, wallet_scan_queue.put_nowait, wallet_address)
+            else:
+                # Leave the jobs in the database, the leader re-queues them once they are stale
+                pending_wallet_scans.discard(wallet_address)
+                print(f"Wallet scan failed for {wallet_address}: {e}")
+        finally:
+            wallet_scan_queue.task_done()
+
+#BULK IMPORT
+# Most addresses accepted by one import, largest file accepted (bytes), number of wallets
+# scanned at the same time and minimum time (seconds) between two edits of the progress message
+BULK_IMPORT_LIMIT = int(os.environ.get("BULK_IMPORT_LIMIT", "300"))
+BULK_IMPORT_MAX_FILE_SIZE = 64 * 1024
+BULK_IMPORT_CONCURRENCY = int(os.environ.get("BULK_IMPORT_CONCURRENCY", "8"))
+BULK_IMPORT_PROGRESS_INTERVAL = 3
+
+# Function to check a Stellar public key locally (version byte and CRC16 checksum), so typos
+# are rejected without a Horizon request
+def is_valid_wallet_address(wallet_address):
+    return StrKey.is_valid_ed25519_public_key(wallet_address)
+
+# Function to split a pasted list or uploaded file into addresses (separated by whitespace,
+# commas or semicolons), in order and without duplicates. Returns (valid, invalid).
+def parse_wallet_list(text):
+    valid, invalid = [], []
+    seen = set()
+    for entry in re.split(r"[\s,;]+", text):
+        entry = entry.strip("\"'")
+        if not entry or entry in seen:
+            continue
+        seen.add(entry)
+        (valid if is_valid_wallet_address(entry) else invalid).append(entry)
+    return valid, invalid
+
+# Progress message of an import, edited in place at most every BULK_IMPORT_PROGRESS_INTERVAL seconds
+class ImportProgress:
+    def __init__(self, message, total):
+        self.message = message
+        self.total = total
+        self.done = 0
+        self.edited_at = time.monotonic()
+
+    def text(self):
+        return f"⏳ Importing {self.total} wallets... {self.done}/{self.total} scanned"
+
+    async def advance(self):
+        self.done += 1
+        if time.monotonic() - self.edited_at < BULK_IMPORT_PROGRESS_INTERVAL:
+            return
+        self.edited_at = time.monotonic()
+        try:
+            await self.message.edit_text(self.text())
+        except TelegramError as e:
+            print(f"Could not update import progress: {e}")
+
+# Function to import wallets for a user: addresses the user doesn't have yet are scanned
+# BULK_IMPORT_CONCURRENCY at a time (addresses already known to the bot need no scan) and
+# stored in one batch at the end.
+# Returns (added rows, number already registered, addresses whose scan failed).
+async def import_wallets(user_id, wallet_addresses, progress):
+    registered = set(get_user_wallets(user_id))
+    new_addresses = [wallet_address for wallet_address in wallet_addresses if wallet_address not in registered]
+    semaphore = asyncio.Semaphore(BULK_IMPORT_CONCURRENCY)
+
+    async def scan(wallet_address):
+        try:
+            first_xai_at = wallet_registry.get_first_xai_at(wallet_address)
+            if first_xai_at is None:
+                async with semaphore:
+                    first_xai_at, first_xai_date = await get_first_xai_transaction_date(wallet_address)
+            return first_xai_at
+        finally:
+            await progress.advance()
+
+    results = await asyncio.gather(*(scan(wallet_address) for wallet_address in new_addresses), return_exceptions=True)
+    rows = []
+    failed = []
+    for wallet_address, result in zip(new_addresses, results):
+        if isinstance(result, Exception):
+            print(f"Import scan failed for {wallet_address}: {result!r}")
+            failed.append(wallet_address)
+        else:
+            rows.append((user_id, wallet_address, result))
+    await wallet_registry.add(rows)
+    return rows, len(wallet_addresses) - len(new_addresses), failed
+
+# Function to run an import in the background and report the result
+async def run_wallet_import(message, progress, valid, invalid):
+    try:
+        rows, already_registered, failed = await import_wallets(message.from_user.id, valid, progress)
+    except Exception as e:
+        print(f"Wallet import failed: {e}")
+        await progress.message.edit_text("❌ The import failed, please try again later.")
+        return
+
+    summary = f"✅ Imported {len(rows)} of {len(valid)} wallets."
+    if already_registered:
+        summary += f"\n👝 Already in your wallets: {already_registered}"
+    await progress.message.edit_text(summary)
+
+    blocks = []
+    if invalid:
+        blocks.append("❌ <b>Not valid Stellar addresses (skipped):</b>")
+        blocks.extend(f"<code>{html.escape(entry)}</code>" for entry in invalid)
+    if failed:
+        blocks.append("⚠️ <b>Stellar network busy, please send these again later:</b>")
+        blocks.extend(f"<code>{wallet_address}</code>" for wallet_address in failed)
+    if blocks:
+        for text in pack_message_blocks(blocks, "HTML", separator="\n"):
+            await message.reply_text(text, parse_mode="HTML")
+
+# Function to start importing a list of addresses sent as text
+async def start_wallet_import(update: Update, context: ContextTypes.DEFAULT_TYPE, text):
+    valid, invalid = parse_wallet_list(text)
+    if not valid and not invalid:
+        await update.message.reply_text(
+            "📋 Send /import followed by your Stellar PUBLIC KEYS (one per line), or upload them as a text file."
+        )
+        return
+    if len(valid) > BULK_IMPORT_LIMIT:
+        await update.message.reply_text(f"❌ Please import at most {BULK_IMPORT_LIMIT} wallets at a time.")
+        return
+    if not valid:
+        await update.message.reply_text("❌ None of these are valid Stellar wallet addresses.")
+        return
+
+    progress_message = await update.message.reply_text(f"⏳ Importing {len(valid)} wallets...")
+    progress = ImportProgress(progress_message, len(valid))
+    # Scans can take minutes: run them outside the update so the user's other buttons keep working
+    context.application.create_task(run_wallet_import(update.message, progress, valid, invalid))
+
+# Bulk import handler: /import with the addresses in the message, or an uploaded text file
+async def handle_import(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    document = update.message.document
+    if document is None:
+        await start_wallet_import(update, context, " ".join(context.args or []))
+        return
+
+    if document.file_size and document.file_size > BULK_IMPORT_MAX_FILE_SIZE:
+        await update.message.reply_text("❌ This file is too large for a wallet list.")
+        return
+    file = await document.get_file()
+    text = (await file.download_as_bytearray()).decode("utf-8", errors="replace")
+    await start_wallet_import(update, context, text)
+
+#HOLDER SNAPSHOT
+# Function to take a snapshot of the balances of every registered wallet that holds XAI.
+# Horizon lists all accounts with an XAI trustline 200 per page, so the whole holder set
+# costs a few dozen requests instead of one request per wallet.
+async def take_holder_snapshot():
+    rows = await db.fetchall('SELECT DISTINCT wallet_address FROM user_wallets')
+    registered_wallets = {row[0] for row in rows}
+    if not registered_wallets:
+        return 0
+
+    snapshot = {}
+    query = {"asset": f"{xai_asset.code}:{xai_asset.issuer}"}
+    async with aclosing(iter_horizon_pages("/accounts", query=query, cache=False)) as pages:
+        async for records in pages:
+            for record in records:
+                if record['account_id'] in registered_wallets:
+                    snapshot[record['account_id']] = record.get('balances', [])
+
+    # Registered wallets missing from the holder set have no XAI trustline, i.e. no XAI balance
+    snapshot_at = int(time.time())
+    await db.executemany(
+        'INSERT INTO wallet_balances (wallet_address, balances, snapshot_at) VALUES (?, ?, ?) '
+        'ON CONFLICT (wallet_address) DO UPDATE SET balances = excluded.balances, snapshot_at = excluded.snapshot_at',
+        [(wallet_address, json.dumps(snapshot.get(wallet_address, [])), snapshot_at) for wallet_address in registered_wallets]
+    )
+    return len(snapshot)
+
+# Scheduled job wrapper for take_holder_snapshot
+async def holder_snapshot_job(context: ContextTypes.DEFAULT_TYPE):
+    if not leader_lease.is_leader:
+        return
+    try:
+        await take_holder_snapshot()
+    except Exception as e:
+        print(f"XAI holder snapshot failed: {e}")
+
+# Function to get the balances of a wallet, from the holder snapshot when it is recent
+# enough and from Horizon otherwise. Returns (balances, snapshot time or None if live).
+async def get_wallet_balances(wallet_address):
+    row = await db.fetchone('SELECT balances, snapshot_at FROM wallet_balances WHERE wallet_address = ?', (wallet_address,))
+    return await resolve_wallet_balances(wallet_address, *(row or (None, None)))
+
+# Same as get_wallet_balances, for a snapshot row that was already loaded (balances JSON, snapshot_at)
+async def resolve_wallet_balances(wallet_address, balances, snapshot_at):
+    if balances is not None and time.time() - snapshot_at <= HOLDER_SNAPSHOT_MAX_AGE:
+        return json.loads(balances), snapshot_at
+
+    account = await get_account(wallet_address)
+    return account.get("balances", []), None
+
+# Function to describe how old a snapshot balance is (empty for live balances)
+def format_balance_age(snapshot_at):
+    if snapshot_at is None:
+        return ""
+    minutes = int(time.time() - snapshot_at) // 60
+    if minutes < 1:
+        return "🕒 <i>Balance updated just now</i>\n"
+    return f"🕒 <i>Balance updated {minutes} min ago</i>\n"
+
+#LEADER ELECTION
+# How long a lease is valid, and how often its holder renews it
+LEADER_LEASE_TTL = int(os.environ.get("LEADER_LEASE_TTL", "30"))
+LEADER_LEASE_RENEW = int(os.environ.get("LEADER_LEASE_RENEW", "10"))
+
+# Lease row in the shared database. When several bot processes run (shard workers or
+# several dynos), only the lease holder runs the background jobs, so holder snapshots and
+# re-queued wallet scans don't run twice. An expired lease is taken over by the next process
+# that renews; a holder that can't renew in time stops considering itself the leader.
+class LeaderLease:
+    def __init__(self, name, holder):
+        self.name = name
+        self.holder = holder
+        self.valid_until = 0.0  # time.monotonic() until which we hold the lease
+
+    @property
+    def is_leader(self):
+        return time.monotonic() < self.valid_until
+
+    # Take or extend the lease. Returns True if this process just became the leader.
+    async def renew(self):
+        was_leader = self.is_leader
+        renewed_at = time.monotonic()
+        now = int(time.time())
+        rows = await db.execute(
+            'INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?) '
+            'ON CONFLICT (name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at '
+            'WHERE leases.holder = excluded.holder OR leases.expires_at < ? '
+            'RETURNING holder',
+            (self.name, self.holder, now + LEADER_LEASE_TTL, now)
+        )
+        self.valid_until = renewed_at + LEADER_LEASE_TTL if rows else 0.0
+        return bool(rows) and not was_leader
+
+    # Give the lease up so another process can take over without waiting for it to expire
+    async def release(self):
+        if self.is_leader:
+            self.valid_until = 0.0
+            await db.execute('DELETE FROM leases WHERE name = ? AND holder = ?', (self.name, self.holder))
+
+leader_lease = LeaderLease("background-jobs", f"{socket.gethostname()}:{os.getpid()}")
+
+# Function to re-queue the wallet scans left over from a previous run (or, with older_than,
+# the ones waiting since before that time)
+async def requeue_wallet_jobs(older_than=None):
+    if older_than is None:
+        rows = await db.fetchall('SELECT DISTINCT wallet_address FROM wallet_jobs')
+    else:
+        rows = await db.fetchall('SELECT DISTINCT wallet_address FROM wallet_jobs WHERE created_at < ?', (older_than,))
+    for (wallet_address,) in rows:
+        queue_wallet_scan(wallet_address)
+
+# Scheduled job: the leader re-queues scans that have been waiting too long, in case the
+# process that took them restarted. A scan still running elsewhere only runs twice, the
+# second one finds no jobs left to answer.
+async def stale_wallet_jobs_job(context: ContextTypes.DEFAULT_TYPE):
+    if not leader_lease.is_leader:
+        return
+    try:
+        await requeue_wallet_jobs(int(time.time()) - WALLET_JOB_STALE_AFTER)
+    except Exception as e:
+        print(f"Re-queueing stale wallet scans failed: {e}")
+
+# Function to renew the leader lease; a new leader picks up pending scans and takes a snapshot
+async def leader_election_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        if await leader_lease.renew():
+            print(f"{leader_lease.holder} is now running the background jobs")
+            await requeue_wallet_jobs()
+            context.job_queue.run_once(holder_snapshot_job, 0)
+    except Exception as e:
+        print(f"Leader lease renewal failed: {e}")
+
+# Function to start the background workers and jobs
+async def start_background_tasks(application):
+    await wallet_registry.load()
+    for _ in range(WALLET_SCAN_WORKERS):
+        background_tasks.append(asyncio.create_task(wallet_scan_worker(application)))
+    if HORIZON_STREAMING:
+        start_horizon_streams()
+
+    application.job_queue.run_repeating(leader_election_job, interval=LEADER_LEASE_RENEW, first=0)
+    application.job_queue.run_repeating(wallet_registry_job, interval=WALLET_REGISTRY_POLL_INTERVAL, first=WALLET_REGISTRY_POLL_INTERVAL)
+    application.job_queue.run_repeating(price_refresh_job, interval=PRICE_REFRESH_INTERVAL, first=0)
+    application.job_queue.run_repeating(stale_wallet_jobs_job, interval=WALLET_JOB_SWEEP_INTERVAL, first=WALLET_JOB_SWEEP_INTERVAL)
+    if STATS_LOG_INTERVAL:
+        application.job_queue.run_repeating(stats_log_job, interval=STATS_LOG_INTERVAL, first=STATS_LOG_INTERVAL)
+    application.job_queue.run_repeating(holder_snapshot_job, interval=HOLDER_SNAPSHOT_INTERVAL, first=HOLDER_SNAPSHOT_INTERVAL)
+    application.job_queue.run_repeating(dividend_ledger_job, interval=DIVIDEND_LEDGER_INTERVAL, first=60)
+    # First sweep once the first holder snapshot is in
+    application.job_queue.run_repeating(tier_notification_job, interval=TIER_SWEEP_INTERVAL, first=HOLDER_SNAPSHOT_INTERVAL + 60)
+    if PAYOUT_REPORT_DIR:
+        # Mondays (0 = Sunday) shortly after the new dividend week starts
+        application.job_queue.run_daily(payout_report_job, time=clock_time(0, 30, tzinfo=timezone.utc), days=(1,))
+
+# Function to stop the background workers and release the HTTP session on shutdown
+async def stop_background_tasks(application):
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    await close_http_session(application)
+    await leader_lease.release()
+    db.close()
+    page_cache_db.close()
+
 # Correct the wallet click handler to show the right balance for XAI
 # Correct the wallet click handler to show the right balance for XAI
 async def handle_wallet_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -242,14 +1719,10 @@ async def handle_wallet_click(update: Update, context: ContextTypes.DEFAULT_TYPE
     if data.startswith("wallet_"):
         wallet_address = data.split("_", 1)[1]
         try:
-            # Fetch account data from Stellar network
-            account = server.accounts().account_id(wallet_address).call()
+            # Get the balances from the holder snapshot (or the Stellar network)
+            balances, snapshot_at = await get_wallet_balances(wallet_address)
 
-            # Debug: Check account structure
-            print(f"Account data for wallet {wallet_address}: {account}")
-
-            # Check if 'balances' exists in the response and is a list
-            balances = account.get("balances", [])
+            # Check if the balances are a list
             if not isinstance(balances, list):
                 await query.edit_message_text(f"Error: Balances data is not in a list format for {wallet_address}")
                 return
@@ -261,18 +1734,19 @@ async def handle_wallet_click(update: Update, context: ContextTypes.DEFAULT_TYPE
             )
             
             # Calculate the XAI dividend tier and payment
-            xai_tier, weekly_dividends = calculate_payment(float(xai_balance))
-
-            # Format the dividend details
-            dividend_info = format_dividends(weekly_dividends)
+            xai_tier, dividend_info = message_cache.weekly_dividends(float(xai_balance))
 
             # Format the response message
             message = (
                 f"👝 <b>Wallet:</b> <code>{wallet_address}</code>\n"
                 f"📊 <b>XAi Balance:</b> {xai_balance} XAi\n"
                 f"🌐 <b>XAi Dividend Tier:</b> {xai_tier}\n"
+                f"{format_balance_age(snapshot_at)}"
                 f"🪙 <b>Weekly Dividends:</b>\n{dividend_info}"
             )
+            price_note = format_price_age()
+            if price_note:
+                message += f"\n{price_note}"
 
             # Send the formatted response
             await query.edit_message_text(message, parse_mode="HTML")
@@ -281,46 +1755,35 @@ async def handle_wallet_click(update: Update, context: ContextTypes.DEFAULT_TYPE
             # In case of an error, display a friendly message
             await query.edit_message_text(f"Error fetching wallet data: {e}")
 
-# Helper function to format accumulated dividend information based on eligibility and tier
-def format_accumulated_payment_info(accumulated_dividends, tier):
-    # Define the dividend percentages for each tier and token eligibility
-    token_percentage_map = {
-        1: {"xai": 0.035, "tesla": 0.06, "xelon": 0.04, "tbc": None, "nlink": None, "x": None, "starlink": None},
-        2: {"xai": 0.052, "tesla": 0.09, "xelon": 0.06, "tbc": 0.045, "nlink": None, "x": None, "starlink": None},
-        3: {"xai": 0.08, "tesla": 0.13, "xelon": 0.12, "tbc": 0.07, "nlink": 0.02, "x": None, "starlink": None},
-        4: {"xai": 0.105, "tesla": 0.22, "xelon": 0.17, "tbc": 0.09, "nlink": 0.03, "x": 0.0007, "starlink": None},
-        5: {"xai": 0.16, "tesla": 0.42, "xelon": 0.35, "tbc": 0.12, "nlink": 0.06, "x": 0.0025, "starlink": 0.025},
-        # Add other tiers here if applicable
-    }
+#WITHDRAW
+# Function to build the withdraw summary of one wallet from its ledger totals ({asset: (total, weeks)}).
+# Returns (message part, XLM equivalent, sum of accumulated dividends).
+def format_wallet_withdraw_info(wallet_address, totals):
+    if not totals:
+        return f"👝 Wallet: {wallet_address}\n⏳ No dividends recorded for this wallet yet.", 0, 0
+
+    accumulated = [(name, asset, decimals, *totals[asset]) for name, asset, decimals in DIVIDEND_ASSETS if asset in totals]
+    paid = [(name, asset, decimals, total) for name, asset, decimals, total, weeks in accumulated if total > 0]
+    if not paid:
+        return f"👝 Wallet: {wallet_address}\n❌ No dividends accumulated for this wallet yet.", 0, 0
+
+    # Calculate XLM equivalent for each dividend at today's prices
+    xlm_equivalents = [total * get_price(asset) for name, asset, decimals, total in paid]
+    accumulated_payment_info = "\n".join([
+        WITHDRAW_LINE_TEMPLATES[asset].format(total, xlm_value)
+        for (name, asset, decimals, total), xlm_value in zip(paid, xlm_equivalents)
+    ])
 
-    # Retrieve the correct percentages for the given tier
-    percentages = token_percentage_map.get(tier, {})
-
-    # Format the dividend information based on eligibility and percentages for the given tier
-    accumulated_payment_info = ""
-    if percentages.get("xai"):
-        accumulated_payment_info += f"<b>👑 {percentages['xai']*100:.1f}% xAI</b>: {accumulated_dividends[0]:.2f} XAi ({accumulated_dividends[0] * XAI_PRICE:.2f} XLM)\n"
-    if percentages.get("tesla"):
-        accumulated_payment_info += f"<b>© {percentages['tesla']*100:.1f}% TESLA</b>: {accumulated_dividends[1]:.5f} TESLA ({accumulated_dividends[1] * TESLA_PRICE:.2f} XLM)\n"
-    if percentages.get("xelon"):
-        accumulated_payment_info += f"<b>🔥 {percentages['xelon']*100:.1f}% XELON</b>: {accumulated_dividends[2]:.2f} XELON ({accumulated_dividends[2] * XELON_PRICE:.2f} XLM)\n"
-    if percentages.get("tbc"):
-        accumulated_payment_info += f"<b>⚙️ {percentages['tbc']*100:.1f}% TBC</b>: {accumulated_dividends[3]:.5f} TBC ({accumulated_dividends[3] * TBC_PRICE:.2f} XLM)\n"
-    if percentages.get("nlink"):
-        accumulated_payment_info += f"<b>🧠 {percentages['nlink']*100:.1f}% NLINK</b>: {accumulated_dividends[4]:.5f} NLINK ({accumulated_dividends[4] * NLINK_PRICE:.2f} XLM)\n"
-    if percentages.get("x"):
-        accumulated_payment_info += f"<b>✖ {percentages['x']*100:.2f}% X</b>: {accumulated_dividends[5]:.5f} X ({accumulated_dividends[5] * X_PRICE:.2f} XLM)\n"
-    if percentages.get("starlink"):
-        accumulated_payment_info += f"<b>⭐️ {percentages['starlink']*100:.2f}% STARLINK</b>: {accumulated_dividends[6]:.5f} STARLINK ({accumulated_dividends[6] * STARLINK_PRICE:.2f} XLM)\n"
-
-    return accumulated_payment_info
+    weeks = max(weeks for name, asset, decimals, total, weeks in accumulated)
+    message_part = f"👝 Wallet: {wallet_address}\n📊 Accumulated Dividends for {weeks} weeks:\n{accumulated_payment_info}"
+    return message_part, sum(xlm_equivalents), sum(total for name, asset, decimals, total in paid)
 
-#WITHDRAW
 async def handle_withdraw(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
-    wallets = get_wallets_from_db(user_id)
+    # Accumulated dividends come precomputed from the ledger (one query, no Horizon calls)
+    wallet_totals = await get_user_dividend_totals(user_id)
 
-    if not wallets:
+    if not wallet_totals:
         await update.message.reply_text(
             "*❌ Please add a wallet first by clicking on 💼 WALLET.*", parse_mode="Markdown"
         )
@@ -330,288 +1793,94 @@ async def handle_withdraw(update: Update, context: ContextTypes.DEFAULT_TYPE):
     total_xlm_equivalent = 0  # Initialize total XLM equivalent
     message_parts = []
 
-    # Asset prices
-    XAI_PRICE = 3
-    TESLA_PRICE = 1500
-    XELON_PRICE = 0.8
-    TBC_PRICE = 100
-    NLINK_PRICE = 250
-    STARLINK_PRICE = 50
-    HYPER_PRICE = 75
-    X_PRICE = 10
-
-    # Iterate over each wallet
-    for wallet_address in wallets:
-        try:
-            # Fetch the first XAI transaction date from the database
-            cursor.execute('SELECT first_xai_transaction_date FROM user_wallets WHERE user_id = ? AND wallet_address = ?', (user_id, wallet_address))
-            first_xai_date_row = cursor.fetchone()
-
-            if not first_xai_date_row or not first_xai_date_row[0]:
-                message_parts.append(f"👝 Wallet: `{wallet_address}`\n❌ No XAI transactions found in recent history.")
-                continue
-
-            first_xai_date = first_xai_date_row[0]
-
-            # Get the first XAI transaction date and convert it to a datetime object
-            try:
-                first_xai_date_obj = datetime.strptime(first_xai_date, "%Y-%m-%d\n%H:%M:%S UTC")
-            except ValueError as e:
-                message_parts.append(f"Error fetching wallet data for `{wallet_address}`: `{e}`\n")
-                continue
-
-            # Convert naive datetime to timezone-aware in UTC
-            first_xai_date_obj = first_xai_date_obj.replace(tzinfo=timezone.utc)
-
-            # Get the current date in UTC (aware)
-            current_date = datetime.now(timezone.utc)
-
-            # Calculate the number of weeks between the first XAI transaction and today
-            weeks_since_first_transaction = max((current_date - first_xai_date_obj).days // 7, 1)
-
-            # Fetch account details from Stellar network
-            account = server.accounts().account_id(wallet_address).call()
-            balances = account["balances"]
-
-            # Extract XAi balance by checking for the XAI asset
-            xai_balance = next(
-                (b["balance"] for b in balances if b.get("asset_code") == "XAI" and b.get("asset_issuer") == xai_asset.issuer),
-                "0"  # Default to "0" if the asset is not found
-            )
-            xai_balance = float(xai_balance)
-
-            if xai_balance == 0:
-                message_parts.append(f"👝 Wallet: `{wallet_address}`\n❌ No XAi balance in this wallet.")
-                continue
-
-            # Calculate the weekly dividends
-            xai_tier, weekly_dividends = calculate_payment(xai_balance)
-           # print(f"Weekly Dividends for wallet {wallet_address}: {weekly_dividends}")
-
-            # Ensure weekly_dividends is a list of dictionaries
-            if isinstance(weekly_dividends, str):
-               # print(f"Error: weekly_dividends is a string: {weekly_dividends}")
-                continue
-
-            # Accumulate dividends based on the number of weeks since the first transaction
-            accumulated_dividends = [round(value['value'] * weeks_since_first_transaction, 5) for value in weekly_dividends if isinstance(value, dict)]
-           # print(f"Accumulated Dividends for wallet {wallet_address}: {accumulated_dividends}")
-
-            # Ensure that accumulated dividends are not zero
-            if all(dividend == 0 for dividend in accumulated_dividends):
-                print(f"Accumulated dividends are all zero for wallet: {wallet_address}")
-                continue
-
-            # Calculate XLM equivalent for each dividend
-            accumulated_xlm_equivalents = []
-            total_wallet_xlm = 0  # XLM for this specific wallet
-
-            for dividend, accumulated_dividend in zip(weekly_dividends, accumulated_dividends):
-                asset = dividend['asset']
-                if asset == "XAi":
-                    xlm_value = accumulated_dividend * XAI_PRICE
-                elif asset == "TESLA":
-                    xlm_value = accumulated_dividend * TESLA_PRICE
-                elif asset == "XELON":
-                    xlm_value = accumulated_dividend * XELON_PRICE
-                elif asset == "TBC":
-                    xlm_value = accumulated_dividend * TBC_PRICE
-                elif asset == "NLINK":
-                    xlm_value = accumulated_dividend * NLINK_PRICE
-                elif asset == "X":
-                    xlm_value = accumulated_dividend * X_PRICE
-                elif asset == "STARLINK":
-                    xlm_value = accumulated_dividend * STARLINK_PRICE
-                elif asset == "HYPER":
-                    xlm_value = accumulated_dividend * HYPER_PRICE
-                else:
-                    xlm_value = 0  # If we can't identify the asset
-
-                accumulated_xlm_equivalents.append(xlm_value)
-                total_wallet_xlm += xlm_value
-
-            # Summing all accumulated dividends in XLM
-            total_xlm_equivalent += total_wallet_xlm
-           # print(f"Total XLM equivalent for wallet {wallet_address}: {total_wallet_xlm}")
-
-            # Summing all accumulated dividends
-            total_dividends += sum(accumulated_dividends)
-
-            # Create formatted accumulated payment info for display
-            accumulated_payment_info = "\n".join([
-                f"{dividend['name']} {dividend['rate']*100:.1f}%: {accumulated_dividend:.5f} {dividend['asset']} (≈ {xlm_value:.2f} XLM)"
-                for dividend, accumulated_dividend, xlm_value in zip(weekly_dividends, accumulated_dividends, accumulated_xlm_equivalents)
-            ])
+    for wallet_address, totals in wallet_totals:
+        message_part, wallet_xlm, wallet_dividends = format_wallet_withdraw_info(wallet_address, totals)
+        message_parts.append(message_part)
 
-            message_parts.append(f"👝 Wallet: {wallet_address}\n📊 Accumulated Dividends for {weeks_since_first_transaction} weeks:\n{accumulated_payment_info}\n")
+        # Summing all accumulated dividends and their XLM equivalent
+        total_xlm_equivalent += wallet_xlm
+        total_dividends += wallet_dividends
 
-        except Exception as e:
-            message_parts.append(f"Error fetching wallet data for `{wallet_address}`: `{e}`\n")
-           # print(f"Error encountered for wallet {wallet_address}: {e}")
-
-    # Prepare and send the final message
+    # Prepare and send the final message (split over several messages for many wallets)
     if total_dividends > 0:
-        message = (
-            f"💸 <b>Withdrawal option soon available</b>\n\n"
-            f"{'\n'.join(message_parts)}"
-            f"\n💰 <b>Total XLM equivalent from all wallets:</b> {total_xlm_equivalent:.2f} XLM"
-        )
-        await update.message.reply_text(message, parse_mode="HTML")
+        blocks = [
+            "💸 <b>Withdrawal option soon available</b>",
+            *message_parts,
+            f"💰 <b>Total XLM equivalent from all wallets:</b> {total_xlm_equivalent:.2f} XLM",
+        ]
+        price_note = format_price_age()
+        if price_note:
+            blocks.append(price_note)
+        await reply_blocks(update.message, blocks, parse_mode="HTML")
     else:
         await update.message.reply_text(
             "*❌ No accumulated dividends found.*", parse_mode="Markdown"
         )
         
-# Tiers and benefits handler (first part)
+# Tiers and benefits handler, from the pre-rendered tier table
 async def handle_tiers(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    tiers_message_part1 = (
-        "Tier 1 - <b>1-150 xAI</b>\n"
-        "👑 <b>3.5% xAI:</b> 0.04 - 5.25 xAI (0.11 - 15.75 XLM)\n"
-        "© <b>6% TESLA:</b> 0.00012 - 0.02 TESLA (0.18 - 27.00 XLM)\n"
-        "🔥 <b>4% XELON:</b> 0.15 - 22.50 XELON (0.12 - 18.00 XLM)\n\n"
-        
-        "Tier 2 - <b>151-600 xAI</b>\n"
-        "👑 <b>5.2% xAI:</b> 7.85 - 31.20 XAi (23.56 - 93.60 XLM)\n"
-        "© <b>9% TESLA:</b> 0.03 - 0.11 TESLA (40.77 - 162.00 XLM)\n"
-        "🔥 <b>6% XELON:</b> 33.97 - 135.00 XELON (27.18 - 108.00 XLM)\n"
-        "⚙ <b>4.5% TBC:</b> 0.20 - 0.81 TBC (20.38 - 81.00 XLM)\n\n"
-        
-        "Tier 3 - <b>601-1,200 xAI</b>\n"
-        "👑 <b>8% xAI:</b> 48.08 - 96.00 XAi (144.24 - 288.00 XLM)\n"
-        "© <b>13% TESLA:</b> 0.16 - 0.31 TESLA (234.39 - 468.00 XLM)\n"
-        "🔥 <b>12% XELON:</b> 270.45 - 540.00 XELON (216.36 - 432.00 XLM)\n"
-        "⚙ <b>7% TBC:</b> 1.26 - 2.52 TBC (126.21 - 252.00 XLM)\n"
-        "🧠 <b>2% NLINK:</b> 0.14 - 0.29 NLINK (36.06 - 72.00 XLM)\n\n"
-        
-        "Tier 4 - <b>1,201-6,000 xAI</b>\n"
-        "👑 <b>10.5% xAI:</b> 126.11 - 630.00 XAi (378.31 - 1,890.00 XLM)\n"
-        "© <b>22% TESLA:</b> 0.53 - 2.64 TESLA (792.66 - 3,960.00 XLM)\n"
-        "🔥 <b>17% XELON:</b> 765.64 - 3,825.00 XELON (612.51 - 3,060.00 XLM)\n"
-        "⚙ <b>9% TBC:</b> 3.24 - 16.20 TBC (324.27 - 1,620.00 XLM)\n"
-        "🧠 <b>3% NLINK:</b> 0.43 - 2.16 NLINK (108.09 - 540.00 XLM)\n"
-        "✖ <b>0.07% X:</b> 0.25 - 1.26 X (2.52 - 12.60 XLM)\n"
-   )
+    blocks = message_cache.tier_blocks
+    price_note = format_price_age()
+    if price_note:
+        blocks = [*blocks, price_note]
+    await reply_blocks(update.message, blocks, parse_mode="HTML")
+
+# Function to build the dividends message (HTML) for one wallet, from a get_user_wallet_rows row
+async def get_wallet_dividends_message(wallet_row):
+    wallet_address, first_xai_at, snapshot_balances, snapshot_at = wallet_row
+
+    # Get the balances from the holder snapshot (or the Stellar network)
+    balances, snapshot_at = await resolve_wallet_balances(wallet_address, snapshot_balances, snapshot_at)
+
+    # Check if the balances are a list
+    if not isinstance(balances, list):
+        return f"Error: Balances data is not in a list format for {html.escape(wallet_address)}"
+
+    # Extract XAi balance using the correct asset code and issuer
+    xai_balance = next(
+        (b.get("balance") for b in balances if b.get("asset_code") == "XAI" and b.get("asset_issuer") == xai_asset.issuer),
+        "0"  # Default to "0" if XAI asset is not found
+    )
 
-    tiers_message_part2 = (
-        "Tier 5 - <b>6,001-12,000 xAI</b>\n"
-        "👑 <b>16% xAI:</b> 960.16 - 1,920.00 XAi (2,880.48 - 5,760.00 XLM)\n"
-        "© <b>42% TESLA:</b> 5.04 - 10.08 TESLA (7,561.26 - 15,120.00 XLM)\n"
-        "🔥 <b>35% XELON:</b> 7,876.31 - 15,750.00 XELON (6,301.05 - 12,600.00 XLM)\n"
-        "⚙ <b>12% TBC:</b> 21.60 - 43.20 TBC (2,160.36 - 4,320.00 XLM)\n"
-        "🧠 <b>6% NLINK:</b> 4.32 - 8.64 NLINK (1,080.18 - 2,160.00 XLM)\n"
-        "✖ <b>0.25% X:</b> 4.50 - 9.00 X (45.01 - 90.00 XLM)\n"
-        "⭐ <b>2.5% STARLINK:</b> 9.00 - 18.00 STARLINK (450.08 - 900.00 XLM)\n\n"
-        
-        "Tier 6 - <b>12,001-28,000 xAI</b>\n"
-        "👑 <b>28% xAI:</b> 3,360.28 - 7,840.00 XAi (10,080.84 - 23,520.00 XLM)\n"
-        "© <b>65% TESLA:</b> 15.60 - 36.40 TESLA (23,401.95 - 54,600.00 XLM)\n"
-        "🔥 <b>52% XELON:</b> 23,401.95 - 54,600.00 XELON (18,721.56 - 43,680.00 XLM)\n"
-        "⚙ <b>22% TBC:</b> 79.21 - 184.80 TBC (7,920.66 - 18,480.00 XLM)\n"
-        "🧠 <b>12% NLINK:</b> 17.28 - 40.32 NLINK (4,320.36 - 10,080.00 XLM)\n"
-        "✖ <b>0.7% X:</b> 25.20 - 58.80 X (252.02 - 588.00 XLM)\n"
-        "⭐ <b>5% STARLINK:</b> 36.00 - 84.00 STARLINK (1,800.15 - 4,200.00 XLM)\n"
-        "🆎 <b>6% HYPER:</b> 28.80 - 67.20 HYPER (2,160.18 - 5,040.00 XLM)\n\n"
-
-        "Tier 7 - <b>28,001-60,000 xAI</b>\n"
-        "👑 <b>55% xAI:</b> 15,400.55 - 30,000.00 XAi (46,201.65 - 90,000.00 XLM)\n"
-        "© <b>105% TESLA:</b> 58.80 - 114.00 TESLA (88,203.15 - 171,000.00 XLM)\n"
-        "🔥 <b>90% XELON:</b> 94,503.37 - 183,750.00 XELON (75,602.70 - 147,000.00 XLM)\n"
-        "⚙ <b>32% TBC:</b> 268.81 - 525.00 TBC (26,880.96 - 52,500.00 XLM)\n"
-        "🧠 <b>18% NLINK:</b> 60.48 - 117.00 NLINK (15,120.54 - 29,250.00 XLM)\n"
-        "✖ <b>1.2% X:</b> 100.80 - 195.00 X (1,008.04 - 1,950.00 XLM)\n"
-        "⭐ <b>7% STARLINK:</b> 117.60 - 225.00 STARLINK (5,880.21 - 11,250.00 XLM)\n"
-        "🆎 <b>9% HYPER:</b> 100.80 - 216.00 HYPER (7,560.27 - 16,200.00 XLM)\n\n"
-        
-        "Tier 8 - <b>60,001-120,000 xAI</b>\n"
-        "👑 <b>110% xAI:</b> 66,001.10 - 132,000.00 XAi (198,003.30 - 396,000.00 XLM)\n"
-        "© <b>215% TESLA:</b> 258.00 - 516.00 TESLA (387,006.45 - 774,000.00 XLM)\n"
-        "🔥 <b>150% XELON:</b> 337,505.62 - 675,000.00 XELON (270,004.50 - 540,000.00 XLM)\n"
-        "⚙ <b>55% TBC:</b> 990.02 - 1,980.00 TBC (99,001.65 - 198,000.00 XLM)\n"
-        "🧠 <b>25% NLINK:</b> 180.00 - 360.00 NLINK (45,000.75 - 90,000.00 XLM)\n"
-        "✖ <b>2.5% X:</b> 450.01 - 900.00 X (4,500.07 - 9,000.00 XLM)\n"
-        "⭐ <b>10% STARLINK:</b> 360.01 - 720.00 STARLINK (18,000.30 - 36,000.00 XLM)\n"
-        "🆎 <b>12% HYPER:</b> 288.00 - 576.00 HYPER (21,600.36 - 43,200.00 XLM)\n\n"
-        
-        "Tier 9 - <b>120,001-300,000 xAI</b>\n"
-        "👑 <b>370% xAI:</b> 444,003.70 - 1,110,000.00 XAi (1,332,011.10 - 3,330,000.00 XLM)\n"
-        "© <b>515% TESLA:</b> 1,236.01 - 3,090.00 TESLA (1,854,015.45 - 4,635,000.00 XLM)\n"
-        "🔥 <b>220% XELON:</b> 990,008.25 - 2,475,000.00 XELON (792,006.60 - 1,980,000.00 XLM)\n"
-        "⚙ <b>115% TBC:</b> 4,140.03 - 10,350.00 TBC (414,003.45 - 1,035,000.00 XLM)\n"
-        "🧠 <b>35% NLINK:</b> 504.00 - 1,260.00 NLINK (126,001.05 - 315,000.00 XLM)\n"
-        "✖ <b>5.5% X:</b> 1,980.02 - 4,950.00 X (19,800.17 - 49,500.00 XLM)\n"
-        "⭐ <b>15% STARLINK:</b> 1,080.01 - 2,700.00 STARLINK (54,000.45 - 135,000.00 XLM)\n"
-        "🆎 <b>18% HYPER:</b> 864.01 - 2,160.00 HYPER (64,800.54 - 162,000.00 XLM)\n\n"
-
-        "Tier 10 - <b>300,001+ xAI</b>\n"
-        "👑 <b>1050% xAI:</b> 3,150,010.50+ XAi (9,450,031.50+ XLM)\n"
-        "© <b>2100% TESLA:</b> 12,600.04+ TESLA (18,900,063.00+ XLM)\n"
-        "🔥 <b>275% XELON:</b> 3,093,760.31+ XELON (2,475,008.25+ XLM)\n"
-        "⚙ <b>320% TBC:</b> 28,800.10+ TBC (2,880,009.60+ XLM)\n"
-        "🧠 <b>50% NLINK:</b> 1,800.01+ NLINK (450,001.50+ XLM)\n"
-        "✖ <b>7% X:</b> 6,300.02+ X (63,000.21+ XLM)\n"
-        "⭐ <b>25% STARLINK:</b> 4,500.02+ STARLINK (225,000.75+ XLM)\n"
-        "🆎 <b>30% HYPER:</b> 3,600.01+ HYPER (270,000.90+ XLM)\n"
-   )
+    # Convert the balance to a float for calculations
+    xai_balance = float(xai_balance)
 
-# Send the first message
-    await update.message.reply_text(tiers_message_part1, parse_mode="HTML")
+    # Calculate XAi dividend tier and payments
+    xai_tier, dividends_info = message_cache.weekly_dividends(xai_balance)
 
-    # Send the second message after the first
-    await update.message.reply_text(tiers_message_part2, parse_mode="HTML")
+    # Format the message
+    message = (
+        f"👝 <b>Wallet:</b> {wallet_address}\n"
+        f"📊 <b>XAi Balance:</b> {xai_balance:.2f} XAi\n"
+        f"🌐 <b>XAi Dividend Tier:</b> {xai_tier}\n"
+        f"{format_balance_age(snapshot_at)}"
+        f"🪙 <b>Weekly Dividends:</b>\n{dividends_info}"
+    )
+    return message
 
 # Correct the dividend fetching logic
 async def handle_dividends(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
-    # Retrieve wallets from the database instead of using user_wallets
-    wallets = get_wallets_from_db(user_id)
+    # Retrieve wallets (and their snapshot balances) from the database in one query
+    wallet_rows = await get_user_wallet_rows(user_id)
     
-    if not wallets:
+    if not wallet_rows:
         await update.message.reply_text(
             "*❌ Please add a wallet first by clicking on 💼 WALLET.*", parse_mode="Markdown"
         )
         return
 
-    for wallet_address in wallets:
-        try:
-            # Fetch account details from the Stellar network
-            account = server.accounts().account_id(wallet_address).call()
-
-            # Check if 'balances' exists in the response and is a list
-            balances = account.get("balances", [])
-            if not isinstance(balances, list):
-                await update.message.reply_text(f"Error: Balances data is not in a list format for {wallet_address}")
-                continue
-
-            # Extract XAi balance using the correct asset code and issuer
-            xai_balance = next(
-                (b.get("balance") for b in balances if b.get("asset_code") == "XAI" and b.get("asset_issuer") == xai_asset.issuer),
-                "0"  # Default to "0" if XAI asset is not found
-            )
-
-            # Convert the balance to a float for calculations
-            xai_balance = float(xai_balance)
-            
-            # Calculate XAi dividend tier and payments
-            xai_tier, weekly_dividends = calculate_payment(xai_balance)
-            
-            # Format the dividends properly for display
-            dividends_info = "\n".join([
-                f"{dividend['name']} {dividend['rate']*100:.1f}%: {dividend['value']:.2f} {dividend['asset']}"
-                for dividend in weekly_dividends
-            ])
-
-            # Format the message
-            message = (
-                f"👝 <b>Wallet:</b> {wallet_address}\n"
-                f"📊 <b>XAi Balance:</b> {xai_balance:.2f} XAi\n"
-                f"🌐 <b>XAi Dividend Tier:</b> {xai_tier}\n"
-                f"🪙 <b>Weekly Dividends:</b>\n{dividends_info}"
-            )
-
-            await update.message.reply_text(message, parse_mode="HTML")
-        
-        except Exception as e:
-            await update.message.reply_text(f"Error fetching wallet data for `{wallet_address}`: `{e}`", parse_mode="Markdown")
+    # Fetch all wallets concurrently, then reply in wallet order with as few messages as possible
+    results = await run_for_wallets(user_id, wallet_rows, get_wallet_dividends_message)
+    blocks = [
+        f"Error fetching wallet data for <code>{html.escape(wallet_address)}</code>: <code>{html.escape(str(result))}</code>"
+        if isinstance(result, Exception) else result
+        for (wallet_address, *_), result in zip(wallet_rows, results)
+    ]
+    price_note = format_price_age()
+    if price_note:
+        blocks.append(price_note)
+    await reply_blocks(update.message, blocks, parse_mode="HTML")
 
 # Telegram Channel handler
 async def handle_telegram_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -632,157 +1901,1152 @@ async def handle_lobstr(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode="Markdown"
     )
 
-# Token prices (assuming these are still accurate, adjust as needed)
-XAI_PRICE = 3  # 1 XAI = 3 XLM
-TESLA_PRICE = 1500  # 1 TESLA = 1500 XLM
-XELON_PRICE = 0.8  # 1 XELON = 0.8 XLM
-TBC_PRICE = 100  # 1 TBC = 100 XLM
-NLINK_PRICE = 250  # 1 NLINK = 250 XLM
-STARLINK_PRICE = 50  # 1 STARLINK = 50 XLM
-HYPER_PRICE = 75  # 1 HYPER = 75 XLM
-X_PRICE = 10  # 1 X = 10 XLM
+#PRICES
+# Assets priced in XLM, keyed by the asset name used in the dividend tables
+PRICE_ASSETS = {
+    "XAi": xai_asset,
+    "TESLA": tesla_asset,
+    "XELON": xelon_asset,
+    "TBC": tbc_asset,
+    "NLINK": nlink_asset,
+    "X": x_asset,
+    "STARLINK": starlink_asset,
+    "HYPER": hyper_asset,
+}
+
+# Prices used until the first successful refresh (1 XAI = 3 XLM, 1 TESLA = 1500 XLM, ...)
+DEFAULT_PRICES = {
+    "XAi": 3,
+    "TESLA": 1500,
+    "XELON": 0.8,
+    "TBC": 100,
+    "NLINK": 250,
+    "X": 10,
+    "STARLINK": 50,
+    "HYPER": 75,
+}
+
+# Function to build the Horizon query parameters describing an asset, e.g. selling_asset_code
+def asset_query(prefix, asset):
+    return {
+        f"{prefix}_asset_type": asset.type,
+        f"{prefix}_asset_code": asset.code,
+        f"{prefix}_asset_issuer": asset.issuer,
+    }
+
+# Function to get the XLM price of an asset from Horizon: the middle of the best bid and
+# ask of the ASSET/XLM order book, or the last hourly trade close if the book is one-sided
+# or empty. Returns None if neither is available.
+async def fetch_xlm_price(asset):
+    params = {**asset_query("selling", asset), "buying_asset_type": "native", "limit": "1"}
+    order_book = await horizon_get("/order_book", params)
+
+    bids = order_book.get("bids", [])
+    asks = order_book.get("asks", [])
+    if bids and asks:
+        return (float(bids[0]["price"]) + float(asks[0]["price"])) / 2
+
+    params = {
+        **asset_query("base", asset),
+        "counter_asset_type": "native",
+        "resolution": "3600000",
+        "order": "desc",
+        "limit": "1",
+    }
+    aggregations = await horizon_get("/trade_aggregations", params)
+    records = aggregations.get("_embedded", {}).get("records", [])
+    if records:
+        return float(records[0]["close"])
+    return None
+
+# In-memory snapshot of token prices, refreshed by price_refresh_job (or a direct refresh()).
+# Reads never wait on Horizon and never start a refresh: they get the last good price.
+# A failed refresh keeps the previous price.
+class PriceService:
+    def __init__(self, assets, default_prices):
+        self.assets = assets
+        self.prices = dict(default_prices)
+        self.updated_at = None  # time.time() of the last refresh that got at least one price
+        self.listeners = []  # called after every refresh that changed prices
+
+    def get(self, asset_name):
+        return self.prices.get(asset_name, 0)
+
+    # Function to get the seconds since the last successful refresh (None before the first one)
+    def age(self):
+        return None if self.updated_at is None else time.time() - self.updated_at
+
+    async def refresh(self):
+        names = list(self.assets)
+        results = await asyncio.gather(
+            *(fetch_xlm_price(self.assets[name]) for name in names), return_exceptions=True
+        )
+        updated = False
+        for name, result in zip(names, results):
+            if isinstance(result, Exception) or not result:
+                print(f"Price refresh failed for {name}, keeping {self.prices.get(name)} XLM: {result}")
+                continue
+            self.prices[name] = result
+            updated = True
+        if updated:
+            self.updated_at = time.time()
+            for listener in self.listeners:
+                listener()
+        return updated
+
+price_service = PriceService(PRICE_ASSETS, DEFAULT_PRICES)
+
+# Function to get the current XLM price of an asset (0 for unknown assets)
+def get_price(asset_name):
+    return price_service.get(asset_name)
+
+# Function to flag prices that are not current (empty while they are): the defaults before
+# the first successful refresh, or the last good prices once refreshes fail for PRICE_MAX_AGE
+def format_price_age():
+    age = price_service.age()
+    if age is None:
+        return "⚠️ <i>Live prices unavailable, XLM values are estimates</i>"
+    if age <= PRICE_MAX_AGE:
+        return ""
+    minutes = int(age) // 60
+    if minutes < 120:
+        return f"⚠️ <i>Prices last updated {minutes} min ago</i>"
+    if minutes < 48 * 60:
+        return f"⚠️ <i>Prices last updated {minutes // 60} h ago</i>"
+    return f"⚠️ <i>Prices last updated {minutes // (24 * 60)} days ago</i>"
+
+# Scheduled job refreshing the token prices
+async def price_refresh_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        await price_service.refresh()
+    except Exception as e:
+        print(f"Price refresh failed: {e}")
+
+#HORIZON STREAMING
+# Follow Horizon's streams (server-sent events) in the leader process and keep the balances
+# and first XAI transaction of registered wallets up to date as activity in the bot's assets
+# arrives. Turn off with HORIZON_STREAMING=0.
+# Trades are followed per asset, one stream of the asset's XLM pair (Horizon only filters
+# /trades by a full pair and returns the pair's trades in both directions; trades against
+# other assets are left to the holder snapshot). Horizon can't filter /payments by asset, so the payments stream carries every payment on the
+# network and each one is parsed on the leader's event loop (see stream_payment_record_us in
+# benchmarks/micro.py); HORIZON_PAYMENTS_STREAM=0 leaves payments to the holder snapshot.
+HORIZON_STREAMING = os.environ.get("HORIZON_STREAMING", "1") == "1"
+HORIZON_PAYMENTS_STREAM = os.environ.get("HORIZON_PAYMENTS_STREAM", "1") == "1"
+# Seconds without any data (Horizon sends keep-alives) after which a stream is reconnected
+STREAM_READ_TIMEOUT = 60
+# How often the stream cursors are saved and wallets with new activity are refreshed (seconds)
+STREAM_CURSOR_SAVE_INTERVAL = 5
+STREAM_BALANCE_REFRESH_INTERVAL = 2
+
+# Assets whose payments and trades are followed: XAI and every asset the bot prices
+STREAM_ASSETS = {(asset.code, asset.issuer) for asset in PRICE_ASSETS.values()}
+
+# Function to get the accounts taking part in a payment (or account creation / merge) or trade record
+def get_record_accounts(record):
+    fields = ("from", "to", "funder", "account", "into", "base_account", "counter_account")
+    return {record[field] for field in fields if record.get(field)}
+
+# Function to get the assets moved by a payment or trade record as (code, issuer) pairs
+def get_record_assets(record):
+    return {
+        (record.get(f"{prefix}asset_code"), record.get(f"{prefix}asset_issuer"))
+        for prefix in ("", "source_", "base_", "counter_")
+    }
+
+# Async generator over the records of a Horizon stream, starting after cursor ("now" for new
+# records only). Ends when Horizon closes the stream.
+async def iter_horizon_stream(path, cursor, query=None):
+    await horizon_governor.acquire(PRIORITY_BACKGROUND)
+    session = get_http_session()
+    async with session.get(
+        f"{HORIZON_URL}{path}",
+        params={**(query or {}), "cursor": cursor},
+        headers={"Accept": "text/event-stream"},
+        timeout=aiohttp.ClientTimeout(total=None, sock_read=STREAM_READ_TIMEOUT),
+    ) as response:
+        response.raise_for_status()
+        data_lines = []
+        async for raw_line in response.content:
+            line = raw_line.decode().rstrip("\r\n")
+            if line.startswith("data:"):
+                data_lines.append(line[5:].strip())
+            elif not line and data_lines:
+                record = json.loads("\n".join(data_lines))
+                data_lines = []
+                # Horizon also sends "hello" and "byebye" strings
+                if isinstance(record, dict):
+                    yield record
+
+# Applies stream records to the registered wallets: wallets with activity get their balances
+# refreshed (batched every STREAM_BALANCE_REFRESH_INTERVAL), and the first XAI record seen for
+# a wallet without a first XAI transaction becomes its first XAI transaction.
+class WalletActivityIndexer:
+    def __init__(self):
+        self.dirty_wallets = set()
+        self.records = 0
+        self.refreshed = 0
+
+    async def handle(self, record, time_field, is_xai_record):
+        self.records += 1
+        if not get_record_assets(record) & STREAM_ASSETS:
+            return
+        wallets = get_record_accounts(record) & wallet_registry.wallets.keys()
+        if not wallets:
+            return
+
+        self.dirty_wallets |= wallets
+        if is_xai_record(record):
+            new_wallets = [wallet_address for wallet_address in wallets if wallet_registry.get_first_xai_at(wallet_address) is None]
+            if new_wallets:
+                await wallet_registry.set_first_xai_at(new_wallets, parse_horizon_time(record[time_field]))
+
+    # Background task: reload the balances of wallets that had activity
+    async def refresh_balances(self):
+        while True:
+            await asyncio.sleep(STREAM_BALANCE_REFRESH_INTERVAL)
+            wallets, self.dirty_wallets = self.dirty_wallets, set()
+            if not wallets:
+                continue
+            try:
+                await self.refresh_wallet_balances(wallets)
+            except Exception as e:
+                # Try these wallets again on the next round
+                print(f"Balance refresh of {len(wallets)} wallets failed: {e}")
+                self.dirty_wallets |= wallets
+
+    async def refresh_wallet_balances(self, wallets):
+        accounts = await asyncio.gather(
+            *(horizon_get(f"/accounts/{wallet_address}") for wallet_address in wallets), return_exceptions=True
+        )
+        snapshot_at = int(time.time())
+        rows = []
+        for wallet_address, account in zip(wallets, accounts):
+            if isinstance(account, Exception):
+                print(f"Balance refresh failed for {wallet_address}: {account}")
+                continue
+            account_cache.invalidate(wallet_address)
+            rows.append((wallet_address, json.dumps(account.get("balances", [])), snapshot_at))
+        await db.executemany(
+            'INSERT INTO wallet_balances (wallet_address, balances, snapshot_at) VALUES (?, ?, ?) '
+            'ON CONFLICT (wallet_address) DO UPDATE SET balances = excluded.balances, snapshot_at = excluded.snapshot_at',
+            rows
+        )
+        self.refreshed += len(rows)
+
+wallet_activity_indexer = WalletActivityIndexer()
+
+# Function to save where a stream was read up to
+async def save_stream_cursor(stream, cursor):
+    await db.execute(
+        'INSERT INTO stream_cursors (stream, cursor) VALUES (?, ?) ON CONFLICT (stream) DO UPDATE SET cursor = excluded.cursor',
+        (stream, cursor)
+    )
+
+# Background task: follow one Horizon stream (path with optional filter query) while this
+# process is the leader. The cursor is saved every few seconds and on disconnect, so a
+# restart (or a new leader) resumes where the stream was left and no activity is missed.
+async def follow_horizon_stream(path, time_field, is_xai_record, query=None):
+    stream = f"{path}?{urlencode(sorted(query.items()))}" if query else path
+    attempt = 0
+    while True:
+        if not leader_lease.is_leader:
+            await asyncio.sleep(LEADER_LEASE_RENEW)
+            continue
+
+        cursor = saved_cursor = None
+        try:
+            row = await db.fetchone('SELECT cursor FROM stream_cursors WHERE stream = ?', (stream,))
+            cursor = saved_cursor = row[0] if row else "now"
+            saved_at = time.monotonic()
+            async with aclosing(iter_horizon_stream(path, cursor, query)) as records:
+                async for record in records:
+                    attempt = 0
+                    await wallet_activity_indexer.handle(record, time_field, is_xai_record)
+                    cursor = record["paging_token"]
+                    if time.monotonic() - saved_at >= STREAM_CURSOR_SAVE_INTERVAL:
+                        await save_stream_cursor(stream, cursor)
+                        saved_cursor, saved_at = cursor, time.monotonic()
+                    if not leader_lease.is_leader:
+                        break
+        except Exception as e:
+            print(f"Horizon stream {stream} interrupted: {e!r}")
+        finally:
+            if cursor != saved_cursor:
+                try:
+                    await save_stream_cursor(stream, cursor)
+                except Exception as e:
+                    print(f"Saving the cursor of Horizon stream {stream} failed: {e!r}")
+
+        # Reconnect right away after a clean close, back off after errors
+        await asyncio.sleep(random.uniform(0, min(HORIZON_BACKOFF_MAX, HORIZON_BACKOFF_BASE * 2 ** attempt)))
+        attempt += 1
+
+# Function to start the stream consumers (they only do work in the leader process)
+def start_horizon_streams():
+    if HORIZON_PAYMENTS_STREAM:
+        background_tasks.append(asyncio.create_task(follow_horizon_stream("/payments", "created_at", is_xai_payment)))
+    for asset in PRICE_ASSETS.values():
+        query = {**asset_query("base", asset), "counter_asset_type": "native"}
+        background_tasks.append(asyncio.create_task(
+            follow_horizon_stream("/trades", "ledger_close_time", is_xai_trade, query=query)
+        ))
+    background_tasks.append(asyncio.create_task(wallet_activity_indexer.refresh_balances()))
+
+# Dividend assets, in the order they are listed for every tier: (display name, asset, decimals)
+DIVIDEND_ASSETS = [
+    ("👑 xAI", "XAi", 2),
+    ("© TESLA", "TESLA", 5),
+    ("🔥 XELON", "XELON", 2),
+    ("⚙ TBC", "TBC", 5),
+    ("🧠 NLINK", "NLINK", 5),
+    ("✖ X", "X", 5),
+    ("⭐ STARLINK", "STARLINK", 5),
+    ("🆎 HYPER", "HYPER", 5),
+]
+
+# Lowest XAI balance that earns dividends, and the upper bound (inclusive) of Tiers 1-9.
+# Anything above the last bound is Tier 10, so there are no gaps between tiers
+# (e.g. 150.5 xAI is Tier 2).
+MIN_TIER_BALANCE = 1
+TIER_UPPER_BOUNDS = [150, 600, 1200, 6000, 12000, 28000, 60000, 120000, 300000]
+
+# Dividend rate per tier, one column per entry of DIVIDEND_ASSETS (0 = not paid in that tier).
+# Row 0 is "No Tier" for balances below MIN_TIER_BALANCE.
+TIER_RATES = [
+    [0, 0, 0, 0, 0, 0, 0, 0],
+    [0.035, 0.06, 0.04, 0, 0, 0, 0, 0],                 # Tier 1: 1-150 xAI
+    [0.052, 0.09, 0.06, 0.045, 0, 0, 0, 0],             # Tier 2: 151-600 xAI
+    [0.08, 0.13, 0.12, 0.07, 0.02, 0, 0, 0],            # Tier 3: 601-1,200 xAI
+    [0.105, 0.22, 0.17, 0.09, 0.03, 0.0007, 0, 0],      # Tier 4: 1,201-6,000 xAI
+    [0.16, 0.42, 0.35, 0.12, 0.06, 0.0025, 0.025, 0],   # Tier 5: 6,001-12,000 xAI
+    [0.28, 0.65, 0.52, 0.22, 0.12, 0.007, 0.05, 0.06],  # Tier 6: 12,001-28,000 xAI
+    [0.55, 1.05, 0.9, 0.32, 0.18, 0.012, 0.07, 0.09],   # Tier 7: 28,001-60,000 xAI
+    [1.1, 2.15, 1.5, 0.55, 0.25, 0.025, 0.1, 0.12],     # Tier 8: 60,001-120,000 xAI
+    [3.7, 5.15, 2.2, 1.15, 0.35, 0.055, 0.15, 0.18],    # Tier 9: 120,001-300,000 xAI
+    [10.5, 21, 2.75, 3.2, 0.5, 0.07, 0.25, 0.3],        # Tier 10: 300,001+ xAI
+]
+TIER_NAMES = ["No Tier"] + [f"Tier {tier}" for tier in range(1, len(TIER_RATES))]
+
+# Same tables as NumPy arrays for the batch API
+TIER_UPPER_BOUNDS_ARRAY = np.array(TIER_UPPER_BOUNDS, dtype=float)
+TIER_RATES_MATRIX = np.array(TIER_RATES, dtype=float)
+
+# Per-tier list of (asset column, display name, rate, asset, decimals) for the assets paid in that tier
+TIER_DIVIDEND_ROWS = [
+    [
+        (column, name, rate, asset, decimals)
+        for column, ((name, asset, decimals), rate) in enumerate(zip(DIVIDEND_ASSETS, rates))
+        if rate
+    ]
+    for rates in TIER_RATES
+]
+
+# Function to get the number each asset's dividend is divided by, in DIVIDEND_ASSETS order
+# (xAI is paid in xAI, the other assets are converted with their XLM price)
+def get_dividend_divisors():
+    return [1] + [get_price(asset) for name, asset, decimals in DIVIDEND_ASSETS[1:]]
+
+# Function to get the tier number (0 = no tier, 1-10) for an xAI balance with a binary search
+def get_tier(xai_balance):
+    if xai_balance < MIN_TIER_BALANCE:
+        return 0
+    return bisect_left(TIER_UPPER_BOUNDS, xai_balance) + 1
 
 def calculate_payment(xai_balance: float) -> tuple:
     """Calculates dividends and assigns tier based on xAI balance."""
-    
-    # Tier 1: 1-150 xAI
-    if 1 <= xai_balance <= 150:
-        dividend_data = [
-            {"name": "👑 xAI", "rate": 0.035, "value": round(xai_balance * 0.035, 2), "asset": "XAi"},
-            {"name": "© TESLA", "rate": 0.06, "value": round(xai_balance * 0.06 / TESLA_PRICE, 5), "asset": "TESLA"},
-            {"name": "🔥 XELON", "rate": 0.04, "value": round(xai_balance * 0.04 / XELON_PRICE, 2), "asset": "XELON"}
-        ]
-        return 'Tier 1', dividend_data
-    
-    # Tier 2: 151-600 xAI
-    elif 151 <= xai_balance <= 600:
-        dividend_data = [
-            {"name": "👑 xAI", "rate": 0.052, "value": round(xai_balance * 0.052, 2), "asset": "XAi"},
-            {"name": "© TESLA", "rate": 0.09, "value": round(xai_balance * 0.09 / TESLA_PRICE, 5), "asset": "TESLA"},
-            {"name": "🔥 XELON", "rate": 0.06, "value": round(xai_balance * 0.06 / XELON_PRICE, 2), "asset": "XELON"},
-            {"name": "⚙ TBC", "rate": 0.045, "value": round(xai_balance * 0.045 / TBC_PRICE, 5), "asset": "TBC"}
-        ]
-        return 'Tier 2', dividend_data
-
-    # Tier 3: 601-1,200 xAI
-    elif 601 <= xai_balance <= 1200:
-        dividend_data = [
-            {"name": "👑 xAI", "rate": 0.08, "value": round(xai_balance * 0.08, 2), "asset": "XAi"},
-            {"name": "© TESLA", "rate": 0.13, "value": round(xai_balance * 0.13 / TESLA_PRICE, 5), "asset": "TESLA"},
-            {"name": "🔥 XELON", "rate": 0.12, "value": round(xai_balance * 0.12 / XELON_PRICE, 2), "asset": "XELON"},
-            {"name": "⚙ TBC", "rate": 0.07, "value": round(xai_balance * 0.07 / TBC_PRICE, 5), "asset": "TBC"},
-            {"name": "🧠 NLINK", "rate": 0.02, "value": round(xai_balance * 0.02 / NLINK_PRICE, 5), "asset": "NLINK"}
-        ]
-        return 'Tier 3', dividend_data
-
-    # Tier 4: 1,201-6,000 xAI
-    elif 1201 <= xai_balance <= 6000:
-        dividend_data = [
-            {"name": "👑 xAI", "rate": 0.105, "value": round(xai_balance * 0.105, 2), "asset": "XAi"},
-            {"name": "© TESLA", "rate": 0.22, "value": round(xai_balance * 0.22 / TESLA_PRICE, 5), "asset": "TESLA"},
-            {"name": "🔥 XELON", "rate": 0.17, "value": round(xai_balance * 0.17 / XELON_PRICE, 2), "asset": "XELON"},
-            {"name": "⚙ TBC", "rate": 0.09, "value": round(xai_balance * 0.09 / TBC_PRICE, 5), "asset": "TBC"},
-            {"name": "🧠 NLINK", "rate": 0.03, "value": round(xai_balance * 0.03 / NLINK_PRICE, 5), "asset": "NLINK"},
-            {"name": "✖ X", "rate": 0.0007, "value": round(xai_balance * 0.0007 / X_PRICE, 5), "asset": "X"}
-        ]
-        return 'Tier 4', dividend_data
-
-    # Tier 5: 6,001-12,000 xAI
-    elif 6001 <= xai_balance <= 12000:
-        dividend_data = [
-            {"name": "👑 xAI", "rate": 0.16, "value": round(xai_balance * 0.16, 2), "asset": "XAi"},
-            {"name": "© TESLA", "rate": 0.42, "value": round(xai_balance * 0.42 / TESLA_PRICE, 5), "asset": "TESLA"},
-            {"name": "🔥 XELON", "rate": 0.35, "value": round(xai_balance * 0.35 / XELON_PRICE, 2), "asset": "XELON"},
-            {"name": "⚙ TBC", "rate": 0.12, "value": round(xai_balance * 0.12 / TBC_PRICE, 5), "asset": "TBC"},
-            {"name": "🧠 NLINK", "rate": 0.06, "value": round(xai_balance * 0.06 / NLINK_PRICE, 5), "asset": "NLINK"},
-            {"name": "✖ X", "rate": 0.0025, "value": round(xai_balance * 0.0025 / X_PRICE, 5), "asset": "X"},
-            {"name": "⭐ STARLINK", "rate": 0.025, "value": round(xai_balance * 0.025 / STARLINK_PRICE, 5), "asset": "STARLINK"}
-        ]
-        return 'Tier 5', dividend_data
-
-    # Tier 6: 12,001-28,000 xAI
-    elif 12001 <= xai_balance <= 28000:
-        dividend_data = [
-            {"name": "👑 xAI", "rate": 0.28, "value": round(xai_balance * 0.28, 2), "asset": "XAi"},
-            {"name": "© TESLA", "rate": 0.65, "value": round(xai_balance * 0.65 / TESLA_PRICE, 5), "asset": "TESLA"},
-            {"name": "🔥 XELON", "rate": 0.52, "value": round(xai_balance * 0.52 / XELON_PRICE, 2), "asset": "XELON"},
-            {"name": "⚙ TBC", "rate": 0.22, "value": round(xai_balance * 0.22 / TBC_PRICE, 5), "asset": "TBC"},
-            {"name": "🧠 NLINK", "rate": 0.12, "value": round(xai_balance * 0.12 / NLINK_PRICE, 5), "asset": "NLINK"},
-            {"name": "✖ X", "rate": 0.007, "value": round(xai_balance * 0.007 / X_PRICE, 5), "asset": "X"},
-            {"name": "⭐ STARLINK", "rate": 0.05, "value": round(xai_balance * 0.05 / STARLINK_PRICE, 5), "asset": "STARLINK"},
-            {"name": "🆎 HYPER", "rate": 0.06, "value": round(xai_balance * 0.06 / HYPER_PRICE, 5), "asset": "HYPER"}
-        ]
-        return 'Tier 6', dividend_data
-
-    # Tier 7: 28,001-60,000 xAI
-    elif 28001 <= xai_balance <= 60000:
-        dividend_data = [
-            {"name": "👑 xAI", "rate": 0.55, "value": round(xai_balance * 0.55, 2), "asset": "XAi"},
-            {"name": "© TESLA", "rate": 1.05, "value": round(xai_balance * 1.05 / TESLA_PRICE, 5), "asset": "TESLA"},
-            {"name": "🔥 XELON", "rate": 0.9, "value": round(xai_balance * 0.9 / XELON_PRICE, 2), "asset": "XELON"},
-            {"name": "⚙ TBC", "rate": 0.32, "value": round(xai_balance * 0.32 / TBC_PRICE, 5), "asset": "TBC"},
-            {"name": "🧠 NLINK", "rate": 0.18, "value": round(xai_balance * 0.18 / NLINK_PRICE, 5), "asset": "NLINK"},
-            {"name": "✖ X", "rate": 0.012, "value": round(xai_balance * 0.012 / X_PRICE, 5), "asset": "X"},
-            {"name": "⭐ STARLINK", "rate": 0.07, "value": round(xai_balance * 0.07 / STARLINK_PRICE, 5), "asset": "STARLINK"},
-            {"name": "🆎 HYPER", "rate": 0.09, "value": round(xai_balance * 0.09 / HYPER_PRICE, 5), "asset": "HYPER"}
-        ]
-        return 'Tier 7', dividend_data
-
-    # Tier 8: 60,001-120,000 xAI
-    elif 60001 <= xai_balance <= 120000:
-        dividend_data = [
-            {"name": "👑 xAI", "rate": 1.1, "value": round(xai_balance * 1.1, 2), "asset": "XAi"},
-            {"name": "© TESLA", "rate": 2.15, "value": round(xai_balance * 2.15 / TESLA_PRICE, 5), "asset": "TESLA"},
-            {"name": "🔥 XELON", "rate": 1.5, "value": round(xai_balance * 1.5 / XELON_PRICE, 2), "asset": "XELON"},
-            {"name": "⚙ TBC", "rate": 0.55, "value": round(xai_balance * 0.55 / TBC_PRICE, 5), "asset": "TBC"},
-            {"name": "🧠 NLINK", "rate": 0.25, "value": round(xai_balance * 0.25 / NLINK_PRICE, 5), "asset": "NLINK"},
-            {"name": "✖ X", "rate": 0.025, "value": round(xai_balance * 0.025 / X_PRICE, 5), "asset": "X"},
-            {"name": "⭐ STARLINK", "rate": 0.1, "value": round(xai_balance * 0.1 / STARLINK_PRICE, 5), "asset": "STARLINK"},
-            {"name": "🆎 HYPER", "rate": 0.12, "value": round(xai_balance * 0.12 / HYPER_PRICE, 5), "asset": "HYPER"}
-        ]
-        return 'Tier 8', dividend_data
-
-    # Tier 9: 120,001-300,000 xAI
-    elif 120001 <= xai_balance <= 300000:
-        dividend_data = [
-            {"name": "👑 xAI", "rate": 3.7, "value": round(xai_balance * 3.7, 2), "asset": "XAi"},
-            {"name": "© TESLA", "rate": 5.15, "value": round(xai_balance * 5.15 / TESLA_PRICE, 5), "asset": "TESLA"},
-            {"name": "🔥 XELON", "rate": 2.2, "value": round(xai_balance * 2.2 / XELON_PRICE, 2), "asset": "XELON"},
-            {"name": "⚙ TBC", "rate": 1.15, "value": round(xai_balance * 1.15 / TBC_PRICE, 5), "asset": "TBC"},
-            {"name": "🧠 NLINK", "rate": 0.35, "value": round(xai_balance * 0.35 / NLINK_PRICE, 5), "asset": "NLINK"},
-            {"name": "✖ X", "rate": 0.055, "value": round(xai_balance * 0.055 / X_PRICE, 5), "asset": "X"},
-            {"name": "⭐ STARLINK", "rate": 0.15, "value": round(xai_balance * 0.15 / STARLINK_PRICE, 5), "asset": "STARLINK"},
-            {"name": "🆎 HYPER", "rate": 0.18, "value": round(xai_balance * 0.18 / HYPER_PRICE, 5), "asset": "HYPER"}
+    tier = get_tier(xai_balance)
+    divisors = get_dividend_divisors()
+    dividend_data = [
+        {"name": name, "rate": rate, "value": round(xai_balance * rate / divisors[column], decimals), "asset": asset}
+        for column, name, rate, asset, decimals in TIER_DIVIDEND_ROWS[tier]
+    ]
+    return TIER_NAMES[tier], dividend_data
+
+def calculate_payments_batch(xai_balances):
+    """Vectorized calculate_payment for many balances at once.
+
+    Returns (tiers, dividends): the tier number of every balance (0 = no tier) and a
+    len(balances) x len(DIVIDEND_ASSETS) matrix of unrounded weekly dividends.
+    """
+    xai_balances = np.asarray(xai_balances, dtype=float)
+    tiers = np.searchsorted(TIER_UPPER_BOUNDS_ARRAY, xai_balances, side="left") + 1
+    tiers[xai_balances < MIN_TIER_BALANCE] = 0
+    divisors = np.array(get_dividend_divisors(), dtype=float)
+    dividends = xai_balances[:, None] * TIER_RATES_MATRIX[tiers] / divisors
+    return tiers, dividends
+
+#MESSAGE TEMPLATES
+# Weekly dividend lines of every tier, with a {} per amount (they only depend on the tier table)
+WEEKLY_DIVIDEND_TEMPLATES = [
+    "\n".join(f"{name} {rate*100:.1f}%: {{:.2f}} {asset}" for column, name, rate, asset, decimals in rows)
+    for rows in TIER_DIVIDEND_ROWS
+]
+# Withdraw line of every dividend asset, filled with the accumulated amount and its XLM value
+WITHDRAW_LINE_TEMPLATES = {
+    asset: f"{name}: {{:.5f}} {asset} (≈ {{:.2f}} XLM)" for name, asset, decimals in DIVIDEND_ASSETS
+}
+
+# Function to get the xAI range of a tier for display, e.g. "151-600 xAI" or "300,001+ xAI"
+def format_tier_range(tier):
+    lower = MIN_TIER_BALANCE if tier == 1 else TIER_UPPER_BOUNDS[tier - 2] + 1
+    if tier > len(TIER_UPPER_BOUNDS):
+        return f"{lower:,}+ xAI"
+    return f"{lower:,}-{TIER_UPPER_BOUNDS[tier - 1]:,} xAI"
+
+# Function to render the tier table entry of one tier: for every asset paid in the tier, the
+# weekly dividend at the bottom and top of the tier's range and its XLM value
+def render_tier_block(tier, divisors):
+    lower = MIN_TIER_BALANCE if tier == 1 else TIER_UPPER_BOUNDS[tier - 2] + 1
+    upper = TIER_UPPER_BOUNDS[tier - 1] if tier <= len(TIER_UPPER_BOUNDS) else None
+    lines = [f"Tier {tier} - <b>{format_tier_range(tier)}</b>"]
+    for column, name, rate, asset, decimals in TIER_DIVIDEND_ROWS[tier]:
+        price = get_price(asset)
+        low = lower * rate / divisors[column]
+        if upper is None:
+            amounts = f"{low:,.{decimals}f}+ {asset} ({low * price:,.2f}+ XLM)"
+        else:
+            high = upper * rate / divisors[column]
+            amounts = f"{low:,.{decimals}f} - {high:,.{decimals}f} {asset} ({low * price:,.2f} - {high * price:,.2f} XLM)"
+        emoji, label = name.split(" ", 1)
+        lines.append(f"{emoji} <b>{rate*100:g}% {label}:</b> {amounts}")
+    return "\n".join(lines)
+
+# Tier and dividend messages pre-rendered from the tier table and the current prices.
+# Rendered at startup and again after every price refresh, so a request only fills its
+# numbers into a cached template.
+class MessageCache:
+    def __init__(self):
+        self.render()
+
+    def render(self):
+        divisors = np.array(get_dividend_divisors(), dtype=float)
+        # Weekly dividend per xAI held, for the assets paid in each tier
+        self.dividend_factors = [
+            np.array([rate / divisors[column] for column, name, rate, asset, decimals in rows])
+            for rows in TIER_DIVIDEND_ROWS
         ]
-        return 'Tier 9', dividend_data
+        self.tier_blocks = [render_tier_block(tier, divisors) for tier in range(1, len(TIER_RATES))]
+
+    # Function to get the tier name and the weekly dividend lines for an xAI balance
+    def weekly_dividends(self, xai_balance):
+        tier = get_tier(xai_balance)
+        return TIER_NAMES[tier], WEEKLY_DIVIDEND_TEMPLATES[tier].format(*(xai_balance * self.dividend_factors[tier]))
+
+message_cache = MessageCache()
+price_service.listeners.append(message_cache.render)
+
+#DIVIDEND LEDGER
+# Dividend weeks start on Monday 00:00 UTC (the epoch was a Thursday)
+WEEK_SECONDS = 7 * 24 * 3600
+WEEK_OFFSET = 4 * 24 * 3600
+# How often the ledger job checks for wallets that have no entry for the current week yet
+DIVIDEND_LEDGER_INTERVAL = int(os.environ.get("DIVIDEND_LEDGER_INTERVAL", "3600"))
+
+# Function to get the start (epoch seconds) of the dividend week containing a timestamp
+def get_week_start(timestamp):
+    return (int(timestamp) - WEEK_OFFSET) // WEEK_SECONDS * WEEK_SECONDS + WEEK_OFFSET
+
+# Function to get the XAI balance from a list of Horizon balances
+def get_xai_balance(balances):
+    return float(next(
+        (b.get("balance") for b in balances if b.get("asset_code") == "XAI" and b.get("asset_issuer") == xai_asset.issuer),
+        "0"
+    ))
+
+# Function to append this week's dividends of every registered wallet that isn't in the ledger
+# for this week yet, from the holder snapshot. Each wallet's ledger rows and running totals
+# are written in one transaction, and only once per week.
+# A wallet's first entry also carries the weeks since its first XAI transaction (at the current
+# balance), which is what /withdraw used to estimate, so accumulated totals carry over.
+async def record_weekly_dividends(now=None):
+    now = now or time.time()
+    week_start = get_week_start(now)
+    rows = await db.fetchall(
+        '''SELECT w.wallet_address, MIN(w.first_xai_transaction_at), MAX(t.last_week), b.balances, b.snapshot_at
+           FROM user_wallets w
+           LEFT JOIN dividend_totals t ON t.wallet_address = w.wallet_address AND t.asset = ?
+           LEFT JOIN wallet_balances b ON b.wallet_address = w.wallet_address
+           GROUP BY w.wallet_address, b.balances, b.snapshot_at
+           HAVING MAX(t.last_week) IS NULL OR MAX(t.last_week) < ?''',
+        (DIVIDEND_ASSETS[0][1], week_start)
+    )
+    # Wallets without a recent snapshot are picked up on a later run
+    rows = [row for row in rows if row[3] is not None and now - row[4] <= HOLDER_SNAPSHOT_MAX_AGE]
+    if not rows:
+        return 0
+
+    xai_balances = [get_xai_balance(json.loads(balances)) for wallet_address, first_at, last_week, balances, snapshot_at in rows]
+    tiers, dividends = calculate_payments_batch(xai_balances)
+
+    for (wallet_address, first_at, last_week, balances, snapshot_at), xai_balance, tier, weekly_dividends in zip(rows, xai_balances, tiers, dividends):
+        # Weeks missed since the last entry (downtime, stale snapshots) are paid at this balance
+        weeks = 1
+        if last_week is not None:
+            weeks = (week_start - last_week) // WEEK_SECONDS
+        elif first_at:
+            weeks = max((week_start - get_week_start(first_at)) // WEEK_SECONDS, 1)
+
+        statements = []
+        for (name, asset, decimals), weekly_dividend in zip(DIVIDEND_ASSETS, weekly_dividends):
+            amount = float(weekly_dividend) * weeks
+            statements.append((
+                'INSERT INTO dividend_ledger (wallet_address, week_start, asset, weeks, xai_balance, tier, amount) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT DO NOTHING',
+                (wallet_address, week_start, asset, weeks, xai_balance, TIER_NAMES[tier], amount)
+            ))
+            statements.append((
+                'INSERT INTO dividend_totals (wallet_address, asset, total, weeks, last_week) VALUES (?, ?, ?, ?, ?) '
+                'ON CONFLICT (wallet_address, asset) DO UPDATE SET total = dividend_totals.total + excluded.total, '
+                'weeks = dividend_totals.weeks + excluded.weeks, last_week = excluded.last_week '
+                'WHERE dividend_totals.last_week < excluded.last_week',
+                (wallet_address, asset, amount, weeks, week_start)
+            ))
+        await db.execute_many(statements)
+    return len(rows)
+
+# Function to run the ledger from the JobQueue (in the leader process only)
+async def dividend_ledger_job(context: ContextTypes.DEFAULT_TYPE):
+    if not leader_lease.is_leader:
+        return
+    try:
+        recorded = await record_weekly_dividends()
+        if recorded:
+            print(f"Recorded weekly dividends of {recorded} wallets")
+    except Exception as e:
+        print(f"Dividend ledger update failed: {e}")
 
-    # Tier 10: 300,001+ xAI
-    else:
-        dividend_data = [
-            {"name": "👑 xAI", "rate": 10.5, "value": round(xai_balance * 10.5, 2), "asset": "XAi"},
-            {"name": "© TESLA", "rate": 21, "value": round(xai_balance * 21 / TESLA_PRICE, 5), "asset": "TESLA"},
-            {"name": "🔥 XELON", "rate": 2.75, "value": round(xai_balance * 2.75 / XELON_PRICE, 2), "asset": "XELON"},
-            {"name": "⚙ TBC", "rate": 3.2, "value": round(xai_balance * 3.2 / TBC_PRICE, 5), "asset": "TBC"},
-            {"name": "🧠 NLINK", "rate": 0.5, "value": round(xai_balance * 0.5 / NLINK_PRICE, 5), "asset": "NLINK"},
-            {"name": "✖ X", "rate": 0.07, "value": round(xai_balance * 0.07 / X_PRICE, 5), "asset": "X"},
-            {"name": "⭐ STARLINK", "rate": 0.25, "value": round(xai_balance * 0.25 / STARLINK_PRICE, 5), "asset": "STARLINK"},
-            {"name": "🆎 HYPER", "rate": 0.3, "value": round(xai_balance * 0.3 / HYPER_PRICE, 5), "asset": "HYPER"}
+# Function to read the accumulated dividends of all of a user's wallets.
+# Returns [(wallet_address, {asset: (total, weeks)})] in wallet order.
+async def get_user_dividend_totals(user_id):
+    wallets = OrderedDict((wallet.address, {}) for wallet in wallet_registry.get_wallets(user_id))
+    if not wallets:
+        return []
+    placeholders = ", ".join("?" * len(wallets))
+    rows = await db.fetchall(
+        f'SELECT wallet_address, asset, total, weeks FROM dividend_totals WHERE wallet_address IN ({placeholders})',
+        list(wallets)
+    )
+    for wallet_address, asset, total, weeks in rows:
+        wallets[wallet_address][asset] = (total, weeks)
+    return list(wallets.items())
+
+#PAYOUT REPORT
+# Directory the weekly payout report job writes to (the job is off when unset)
+PAYOUT_REPORT_DIR = os.environ.get("PAYOUT_REPORT_DIR")
+
+# Function to compute this week's payout of every registered wallet and write it as CSV:
+# one row per wallet (balance, tier, amount per asset rounded to the asset's decimals,
+# XLM equivalent) and a final TOTAL row. Balances come from one pass over the XAI holder
+# list, dividends from one vectorized pass over the tier table.
+# Returns (number of wallets, {asset: total}).
+async def write_payout_report(path, refresh_snapshot=True):
+    if refresh_snapshot:
+        await take_holder_snapshot()
+    await price_service.refresh()
+
+    rows = await db.fetchall(
+        '''SELECT w.wallet_address, COUNT(w.user_id), b.balances
+           FROM user_wallets w
+           LEFT JOIN wallet_balances b ON b.wallet_address = w.wallet_address
+           GROUP BY w.wallet_address, b.balances
+           ORDER BY w.wallet_address'''
+    )
+    missing = sum(1 for wallet_address, users, balances in rows if balances is None)
+    if missing:
+        print(f"{missing} wallets have no snapshot balance and are paid as 0 XAI")
+
+    xai_balances = np.array([get_xai_balance(json.loads(balances)) if balances else 0.0 for wallet_address, users, balances in rows])
+    tiers, dividends = calculate_payments_batch(xai_balances)
+
+    # Round every amount to its asset's decimals; totals are what is actually paid
+    scale = np.array([10.0 ** decimals for name, asset, decimals in DIVIDEND_ASSETS])
+    payouts = np.round(dividends * scale) / scale
+    prices = np.array([get_price(asset) for name, asset, decimals in DIVIDEND_ASSETS])
+    xlm_equivalents = payouts @ prices
+    totals = payouts.sum(axis=0)
+
+    assets = [asset for name, asset, decimals in DIVIDEND_ASSETS]
+    formats = [f"{{:.{decimals}f}}" for name, asset, decimals in DIVIDEND_ASSETS]
+    with open(path, "w", newline="") as report:
+        writer = csv.writer(report)
+        writer.writerow(["wallet_address", "users", "xai_balance", "tier", *assets, "xlm_equivalent"])
+        for (wallet_address, users, balances), xai_balance, tier, payout, xlm_value in zip(rows, xai_balances, tiers, payouts, xlm_equivalents):
+            writer.writerow([
+                wallet_address, users, f"{xai_balance:.7f}", TIER_NAMES[tier],
+                *(fmt.format(amount) for fmt, amount in zip(formats, payout)), f"{xlm_value:.2f}"
+            ])
+        writer.writerow([
+            "TOTAL", sum(users for wallet_address, users, balances in rows), f"{xai_balances.sum():.7f}", "",
+            *(fmt.format(amount) for fmt, amount in zip(formats, totals)), f"{xlm_equivalents.sum():.2f}"
+        ])
+
+    return len(rows), dict(zip(assets, totals.tolist()))
+
+# Function to write the payout report into PAYOUT_REPORT_DIR (weekly, in the leader process only)
+async def payout_report_job(context: ContextTypes.DEFAULT_TYPE):
+    if not leader_lease.is_leader:
+        return
+    path = os.path.join(PAYOUT_REPORT_DIR, f"payouts-{datetime.now(timezone.utc):%Y-%m-%d}.csv")
+    try:
+        wallets, totals = await write_payout_report(path)
+        print(f"Wrote payout report for {wallets} wallets to {path}")
+    except Exception as e:
+        print(f"Payout report failed: {e}")
+
+# Function to run the payout report from the command line
+def run_payout_report(path, refresh_snapshot):
+    async def run():
+        try:
+            return await write_payout_report(path, refresh_snapshot)
+        finally:
+            await close_http_session(None)
+
+    wallets, totals = asyncio.run(run())
+    db.close()
+    page_cache_db.close()
+    print(f"Wrote payout report for {wallets} wallets to {path}")
+    for asset, total in totals.items():
+        print(f"  {asset}: {total}")
+
+#TIER NOTIFICATIONS
+# How often (seconds) the leader compares every registered wallet's tier with the last one seen
+# and notifies the users of wallets whose tier changed
+TIER_SWEEP_INTERVAL = int(os.environ.get("TIER_SWEEP_INTERVAL", "900"))
+
+# Function to read a user's notification settings: (notify, quiet_start, quiet_end), hours in UTC
+async def get_user_settings(user_id):
+    row = await db.fetchone('SELECT notify, quiet_start, quiet_end FROM user_settings WHERE user_id = ?', (user_id,))
+    return tuple(row) if row else (1, None, None)
+
+# Function to check whether an hour (UTC) falls in quiet hours, which may wrap around midnight
+def is_quiet_hour(hour, quiet_start, quiet_end):
+    if quiet_start is None or quiet_start == quiet_end:
+        return False
+    if quiet_start < quiet_end:
+        return quiet_start <= hour < quiet_end
+    return hour >= quiet_start or hour < quiet_end
+
+# Function to compare the tier of every registered wallet (from the holder snapshot, in one
+# vectorized pass) with the last stored tier, and queue a notification for each user of a
+# wallet whose tier changed. A wallet's first sweep only records its tier.
+# Returns the number of wallets whose tier changed.
+async def sweep_tier_changes():
+    rows = await db.fetchall(
+        '''SELECT b.wallet_address, b.balances, b.snapshot_at, t.tier
+           FROM wallet_balances b
+           LEFT JOIN wallet_tiers t ON t.wallet_address = b.wallet_address'''
+    )
+    now = int(time.time())
+    rows = [row for row in rows if row[0] in wallet_registry.wallets and now - row[2] <= HOLDER_SNAPSHOT_MAX_AGE]
+    if not rows:
+        return 0
+
+    xai_balances = [get_xai_balance(json.loads(balances)) for wallet_address, balances, snapshot_at, last_tier in rows]
+    tiers, dividends = calculate_payments_batch(xai_balances)
+
+    statements = []
+    changed = {}
+    for (wallet_address, balances, snapshot_at, last_tier), xai_balance, tier in zip(rows, xai_balances, tiers):
+        tier_name = TIER_NAMES[tier]
+        if tier_name == last_tier:
+            continue
+        statements.append((
+            'INSERT INTO wallet_tiers (wallet_address, tier, changed_at) VALUES (?, ?, ?) '
+            'ON CONFLICT (wallet_address) DO UPDATE SET tier = excluded.tier, changed_at = excluded.changed_at',
+            (wallet_address, tier_name, now)
+        ))
+        if last_tier is not None:
+            changed[wallet_address] = (last_tier, tier_name, xai_balance)
+
+    if changed:
+        opted_out = {row[0] for row in await db.fetchall('SELECT user_id FROM user_settings WHERE notify = 0')}
+        for user_id, wallets in wallet_registry.users.items():
+            if user_id in opted_out:
+                continue
+            for wallet in wallets:
+                if wallet.address in changed:
+                    last_tier, tier_name, xai_balance = changed[wallet.address]
+                    # A notification still waiting (quiet hours) keeps the tier the user last saw
+                    statements.append((
+                        'INSERT INTO tier_notifications (user_id, wallet_address, old_tier, new_tier, xai_balance, created_at) '
+                        'VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (user_id, wallet_address) DO UPDATE SET '
+                        'new_tier = excluded.new_tier, xai_balance = excluded.xai_balance',
+                        (user_id, wallet.address, last_tier, tier_name, xai_balance, now)
+                    ))
+    await db.execute_many(statements)
+    return len(changed)
+
+# Function to build a tier change notification for one wallet
+def format_tier_change(wallet_address, old_tier, new_tier, xai_balance):
+    arrow = "📈" if TIER_NAMES.index(new_tier) > TIER_NAMES.index(old_tier) else "📉"
+    return (
+        f"{arrow} <b>Your XAi dividend tier changed</b>\n"
+        f"👝 Wallet: <code>{wallet_address}</code>\n"
+        f"🌐 {old_tier} → <b>{new_tier}</b>\n"
+        f"📊 XAi Balance: {xai_balance:.2f} XAi"
+    )
+
+# Function to send the queued tier notifications, one message per user (more if they don't fit).
+# Users in their quiet hours get theirs on a later sweep; users who opted out get none.
+# Bot users talk to the bot in private chats, whose chat id is the user id.
+async def send_tier_notifications(bot):
+    rows = await db.fetchall(
+        '''SELECT n.user_id, n.wallet_address, n.old_tier, n.new_tier, n.xai_balance, s.notify, s.quiet_start, s.quiet_end
+           FROM tier_notifications n
+           LEFT JOIN user_settings s ON s.user_id = n.user_id
+           ORDER BY n.user_id, n.wallet_address'''
+    )
+    hour = datetime.now(timezone.utc).hour
+    user_rows = OrderedDict()
+    for row in rows:
+        user_rows.setdefault(row[0], []).append(row)
+
+    sent = 0
+    for user_id, notifications in user_rows.items():
+        notify, quiet_start, quiet_end = notifications[0][5:]
+        if notify != 0 and is_quiet_hour(hour, quiet_start, quiet_end):
+            continue
+        # Tiers that went back to what the user last saw need no message
+        blocks = [
+            format_tier_change(wallet_address, old_tier, new_tier, xai_balance)
+            for user_id, wallet_address, old_tier, new_tier, xai_balance, *settings in notifications
+            if notify != 0 and old_tier != new_tier
         ]
-        return 'Tier 10', dividend_data
+        if blocks:
+            blocks.append("🔕 Turn these off with /notify off")
+            try:
+                for text in pack_message_blocks(blocks, "HTML"):
+                    await bot.send_message(user_id, text, parse_mode="HTML")
+                sent += 1
+            except TelegramError as e:
+                print(f"Could not send tier notification to {user_id}: {e}")
+        # Only delete what was read: a newer change queued meanwhile stays for the next sweep
+        await db.executemany(
+            'DELETE FROM tier_notifications WHERE user_id = ? AND wallet_address = ? AND new_tier = ?',
+            [(user_id, wallet_address, new_tier) for user_id, wallet_address, old_tier, new_tier, *rest in notifications]
+        )
+    return sent
 
-def format_dividends(dividend_data):
-    formatted_dividends = "\n".join([
-        f"{dividend['name']} {dividend['rate']*100:.1f}%: {dividend['value']:.2f} {dividend['asset']}"
-        for dividend in dividend_data
-    ])
-    return formatted_dividends
+# Function to run the tier sweep from the JobQueue (in the leader process only)
+async def tier_notification_job(context: ContextTypes.DEFAULT_TYPE):
+    if not leader_lease.is_leader:
+        return
+    try:
+        changed = await sweep_tier_changes()
+        sent = await send_tier_notifications(context.bot)
+        if changed or sent:
+            print(f"Tier sweep: {changed} wallets changed tier, notified {sent} users")
+    except Exception as e:
+        print(f"Tier sweep failed: {e}")
 
-def main():
-    application = ApplicationBuilder().token("7053305969:AAGEO15sSkMXQGZoKi-3NodCMr_OuYr-opw").build()
+# Usage of /notify
+NOTIFY_USAGE = (
+    "/notify on or /notify off: tier change notifications\n"
+    "/notify quiet 22 7: no notifications from 22:00 to 07:00 UTC\n"
+    "/notify quiet off: no quiet hours"
+)
+
+# Function to show and change a user's tier notification settings
+async def handle_notify(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.message.from_user.id
+    args = [arg.lower() for arg in context.args or []]
+    notify, quiet_start, quiet_end = await get_user_settings(user_id)
+
+    if args in (["on"], ["off"]):
+        notify = 1 if args[0] == "on" else 0
+    elif args == ["quiet", "off"]:
+        quiet_start = quiet_end = None
+    elif len(args) == 3 and args[0] == "quiet" and all(arg.isdigit() and int(arg) < 24 for arg in args[1:]):
+        quiet_start, quiet_end = int(args[1]), int(args[2])
+    elif args:
+        await update.message.reply_text(NOTIFY_USAGE)
+        return
+
+    if args:
+        await db.execute(
+            'INSERT INTO user_settings (user_id, notify, quiet_start, quiet_end) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT (user_id) DO UPDATE SET notify = excluded.notify, quiet_start = excluded.quiet_start, quiet_end = excluded.quiet_end',
+            (user_id, notify, quiet_start, quiet_end)
+        )
+
+    quiet_hours = f"{quiet_start:02d}:00-{quiet_end:02d}:00 UTC" if quiet_start is not None else "none"
+    await update.message.reply_text(
+        f"🔔 Tier change notifications: {'on' if notify else 'off'}\n🌙 Quiet hours: {quiet_hours}\n\n{NOTIFY_USAGE}"
+    )
+
+#UPDATE PROCESSING
+# Update queue that remembers when each update was put on it, to measure queueing delay
+class TimestampedUpdateQueue(asyncio.Queue):
+    def __init__(self):
+        super().__init__()
+        self.enqueued_at = {}  # id(update) -> time.monotonic() of the put
+
+    def put_nowait(self, item):
+        self.enqueued_at[id(item)] = time.monotonic()
+        super().put_nowait(item)
+
+    def pop_enqueued_at(self, item):
+        return self.enqueued_at.pop(id(item), None)
+
+# Rolling window of per-update queueing delays
+class UpdateDelayStats:
+    def __init__(self, window=1000):
+        self.delays = deque(maxlen=window)
+        self.count = 0
+
+    def record(self, delay):
+        self.delays.append(delay)
+        self.count += 1
+
+    def percentile(self, p):
+        if not self.delays:
+            return 0.0
+        ordered = sorted(self.delays)
+        return ordered[min(int(len(ordered) * p / 100), len(ordered) - 1)]
+
+    def stats(self):
+        return {"updates": self.count, "p50": self.percentile(50), "p99": self.percentile(99)}
+
+update_delay_stats = UpdateDelayStats()
+
+# How often (seconds) a process logs its statistics (0 turns the log line off)
+STATS_LOG_INTERVAL = int(os.environ.get("STATS_LOG_INTERVAL", "300"))
+
+# Function to get this process' statistics: update queueing delay, account cache and Horizon
+# request budget (served on /health, and logged by stats_log_job)
+def get_process_stats():
+    return {**update_delay_stats.stats(), "account_cache": account_cache.stats(), "horizon": horizon_governor.stats()}
+
+# Scheduled job logging the statistics, the only place they show up in polling mode
+async def stats_log_job(context: ContextTypes.DEFAULT_TYPE):
+    updates = update_delay_stats.stats()
+    cache = account_cache.stats()
+    horizon = horizon_governor.stats()
+    print(
+        f"Stats: {updates['updates']} updates, queueing p50 {updates['p50'] * 1000:.0f} ms / p99 {updates['p99'] * 1000:.0f} ms; "
+        f"account cache {cache['hits']} hits / {cache['misses']} misses / {cache['coalesced']} coalesced, {cache['size']} entries; "
+        f"Horizon {horizon['requests']} requests / {horizon['retries']} retries, {horizon['waiting']} waiting"
+    )
+
+# Application that processes updates concurrently (see UPDATE_CONCURRENCY) while keeping
+# the updates of each user in order, so e.g. a wallet removal and the wallet list refresh
+# can't interleave. Every user with updates in flight has one worker task running their
+# updates from a FIFO queue; only an update that is actually being handled holds one of the
+# UPDATE_CONCURRENCY slots, so a user's backlog never holds up other users.
+# (PTB takes its concurrent_updates slot before calling process_update, which here only
+# queues the update and returns.) PTB doesn't know about the worker tasks, so stop() waits
+# for them before the shutdown closes the database.
+class OrderedApplication(Application):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.user_queues = {}  # user_id -> deque of (update, enqueued_at) waiting for the user's worker
+        self.user_workers = set()
+        self.update_slots = asyncio.Semaphore(UPDATE_CONCURRENCY)
+
+    async def process_update(self, update):
+        enqueued_at = None
+        if isinstance(self.update_queue, TimestampedUpdateQueue):
+            enqueued_at = self.update_queue.pop_enqueued_at(update)
+
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            async with self.update_slots:
+                await self._process_timed_update(update, enqueued_at)
+            return
+
+        pending = self.user_queues.get(user.id)
+        if pending is None:
+            pending = self.user_queues[user.id] = deque()
+            worker = asyncio.create_task(self._run_user_updates(user.id, pending))
+            self.user_workers.add(worker)
+            worker.add_done_callback(self.user_workers.discard)
+        pending.append((update, enqueued_at))
+
+    async def stop(self):
+        await super().stop()
+        # No new updates arrive now: let the workers finish what is queued, up to a point
+        if self.user_workers:
+            done, running = await asyncio.wait(set(self.user_workers), timeout=UPDATE_SHUTDOWN_TIMEOUT)
+            for worker in running:
+                worker.cancel()
+            await asyncio.gather(*running, return_exceptions=True)
+
+    # Worker task: handle a user's queued updates one after the other, then go away
+    async def _run_user_updates(self, user_id, pending):
+        try:
+            while pending:
+                update, enqueued_at = pending.popleft()
+                try:
+                    async with self.update_slots:
+                        await self._process_timed_update(update, enqueued_at)
+                except Exception as e:
+                    print(f"Processing update {getattr(update, 'update_id', None)} failed: {e}")
+        finally:
+            del self.user_queues[user_id]
+
+    async def _process_timed_update(self, update, enqueued_at):
+        if enqueued_at is not None:
+            delay = time.monotonic() - enqueued_at
+            update_delay_stats.record(delay)
+            if delay > SLOW_UPDATE_DELAY:
+                update_id = getattr(update, "update_id", None)
+                print(f"Update {update_id} waited {delay:.2f}s in the queue")
+        await super().process_update(update)
+
+#WEBHOOK
+# Function to build the HTTP app that receives webhook updates. deliver(data) is awaited with
+# the JSON of each update; a request may also carry a list of updates (from the shard front).
+def build_webhook_app(deliver, stats):
+    async def handle_webhook_update(request):
+        # Only Telegram (and the shard front) know the secret token, anything else is rejected
+        secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(secret, WEBHOOK_SECRET):
+            return web.Response(status=403)
+
+        try:
+            data = await request.json()
+        except ValueError as e:
+            print(f"Ignoring malformed webhook update: {e}")
+            return web.Response(status=400)
+
+        # Answer right away, the updates are processed like polled ones
+        for item in (data if isinstance(data, list) else [data]):
+            await deliver(item)
+        return web.Response()
+
+    async def handle_health(request):
+        return web.json_response(stats())
+
+    webhook_app = web.Application()
+    webhook_app.router.add_post(WEBHOOK_PATH, handle_webhook_update)
+    webhook_app.router.add_get("/health", handle_health)
+    return webhook_app
+
+# Function to make a deliver callback that puts updates on the application's update queue
+def application_deliver(application):
+    async def deliver(data):
+        try:
+            update = Update.de_json(data, application.bot)
+        except (TypeError, KeyError, AttributeError) as e:
+            print(f"Ignoring malformed webhook update: {e}")
+            return
+        await application.update_queue.put(update)
+    return deliver
+
+# Function to get an event that is set on SIGINT/SIGTERM
+def stop_on_signals():
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    return stop_event
+
+# Function to run the application behind the embedded HTTP server until SIGINT/SIGTERM, with
+# the same startup and shutdown hooks as run_polling. Shard workers don't register the
+# webhook with Telegram, they get their updates from the front process.
+async def serve_application(application, host, port, register_webhook):
+    stop_event = stop_on_signals()
+    runner = web.AppRunner(build_webhook_app(application_deliver(application), get_process_stats))
+    await runner.setup()
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        await web.TCPSite(runner, host, port).start()
+        if register_webhook:
+            await register_telegram_webhook(application.bot)
+        print(f"Receiving updates on {host}:{port}")
+        await stop_event.wait()
+    finally:
+        await runner.cleanup()
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+# Function to point Telegram at our webhook
+async def register_telegram_webhook(bot):
+    await bot.set_webhook(
+        url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        allowed_updates=Update.ALL_TYPES,
+    )
+
+# Function to run the bot in webhook mode
+async def run_webhook(application):
+    await serve_application(application, "0.0.0.0", PORT, register_webhook=True)
+
+#SHARDING
+# Number of worker processes ("auto": one per CPU core). With more than one, the process
+# started by `python bot.py` becomes a front that receives the updates (by webhook or long
+# polling) and routes each user's updates to the same shard worker, in order. All state is in
+# the shared database; background jobs run in the leader (see LeaderLease).
+WORKER_PROCESSES = os.environ.get("WORKER_PROCESSES", "1")
+WORKER_PROCESSES = (os.cpu_count() or 1) if WORKER_PROCESSES == "auto" else int(WORKER_PROCESSES)
+# Shard worker i listens on 127.0.0.1:SHARD_BASE_PORT + i
+SHARD_BASE_PORT = int(os.environ.get("SHARD_BASE_PORT", "9100"))
+# Most updates forwarded to a shard worker in one request
+SHARD_BATCH_SIZE = 100
+
+# Function to get the id an update is routed by: its sender (or its chat when there is none)
+def update_routing_id(data):
+    for value in data.values():
+        if isinstance(value, dict):
+            sender = value.get("from") or value.get("user") or value.get("chat")
+            if isinstance(sender, dict) and "id" in sender:
+                return sender["id"]
+    return 0
+
+# Routes updates to the shard workers. Each shard has a queue drained by one forwarder, so
+# the updates of a user reach their worker in the order they were received.
+class ShardRouter:
+    def __init__(self, shards):
+        self.queues = [asyncio.Queue() for _ in range(shards)]
+        self.forwarded = [0] * shards
+
+    async def route(self, data):
+        self.queues[update_routing_id(data) % len(self.queues)].put_nowait(data)
+
+    def stats(self):
+        return {"shards": [{"queued": queue.qsize(), "forwarded": forwarded}
+                           for queue, forwarded in zip(self.queues, self.forwarded)]}
+
+    # Wait until everything routed so far was handed to the workers
+    async def drain(self):
+        await asyncio.gather(*(queue.join() for queue in self.queues))
+
+    async def forward(self, shard, session):
+        queue = self.queues[shard]
+        url = f"http://127.0.0.1:{SHARD_BASE_PORT + shard}{WEBHOOK_PATH}"
+        while True:
+            batch = [await queue.get()]
+            while len(batch) < SHARD_BATCH_SIZE and not queue.empty():
+                batch.append(queue.get_nowait())
+
+            # Retry until the worker takes the batch, so a (re)starting worker loses nothing
+            while True:
+                try:
+                    async with session.post(url, json=batch, headers={"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET}) as response:
+                        response.raise_for_status()
+                    break
+                except aiohttp.ClientError:
+                    await asyncio.sleep(0.5)
+
+            self.forwarded[shard] += len(batch)
+            for _ in batch:
+                queue.task_done()
+
+# Function to start a shard worker process
+def start_shard_worker(shard):
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__), "shard-worker", str(shard)])
+
+# Function to restart shard workers that exited
+async def supervise_shard_workers(processes, stop_event):
+    while not stop_event.is_set():
+        await asyncio.sleep(1)
+        for shard, process in enumerate(processes):
+            if process.poll() is not None and not stop_event.is_set():
+                print(f"Shard worker {shard} exited with code {process.returncode}, restarting it")
+                processes[shard] = start_shard_worker(shard)
+
+# Function to long-poll Telegram for updates in the front process
+async def poll_updates(bot, deliver):
+    await bot.delete_webhook()
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=10, read_timeout=15, allowed_updates=Update.ALL_TYPES)
+        except TelegramError as e:
+            print(f"Fetching updates failed: {e}")
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            await deliver(update.to_dict())
+            offset = update.update_id + 1
+
+# Function to run the front process: start the shard workers and route updates to them until SIGINT/SIGTERM
+async def run_front():
+    stop_event = stop_on_signals()
+    router = ShardRouter(WORKER_PROCESSES)
+    processes = [start_shard_worker(shard) for shard in range(WORKER_PROCESSES)]
+    bot = Bot(BOT_TOKEN, base_url=TELEGRAM_API_URL)
+    runner = None
+    receiver = None
+
+    async with aiohttp.ClientSession() as session, bot:
+        forwarders = [asyncio.create_task(router.forward(shard, session)) for shard in range(WORKER_PROCESSES)]
+        supervisor = asyncio.create_task(supervise_shard_workers(processes, stop_event))
+        try:
+            if WEBHOOK_URL:
+                runner = web.AppRunner(build_webhook_app(router.route, router.stats))
+                await runner.setup()
+                await web.TCPSite(runner, "0.0.0.0", PORT).start()
+                await register_telegram_webhook(bot)
+            else:
+                receiver = asyncio.create_task(poll_updates(bot, router.route))
+            print(f"Routing updates to {WORKER_PROCESSES} shard workers")
+            await stop_event.wait()
+        finally:
+            # Stop receiving, hand what was already received to the workers, then stop them
+            if receiver:
+                receiver.cancel()
+            if runner:
+                await runner.cleanup()
+            try:
+                await asyncio.wait_for(router.drain(), 5)
+            except asyncio.TimeoutError:
+                print("Some updates could not be handed to the shard workers before shutdown")
+            stop_event.set()
+            for task in forwarders + [supervisor]:
+                task.cancel()
+            await asyncio.gather(*forwarders, supervisor, *([receiver] if receiver else []), return_exceptions=True)
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.wait()
+
+# Function to run one shard worker: the full bot, fed by the front process
+async def run_shard_worker(application, shard):
+    await serve_application(application, "127.0.0.1", SHARD_BASE_PORT + shard, register_webhook=False)
+
+# Function to create the application with all handlers
+def build_application(sending_processes=1):
+    # Telegram's global limit is per bot, so the processes sending messages (the shard
+    # workers) share it; a share under one message per second becomes one per longer period
+    overall_max_rate, overall_time_period = TELEGRAM_GLOBAL_RATE / sending_processes, 1
+    if overall_max_rate < 1:
+        overall_max_rate, overall_time_period = 1, 1 / overall_max_rate
+
+    application = (
+        ApplicationBuilder()
+        .application_class(OrderedApplication)
+        .update_queue(TimestampedUpdateQueue())
+        .concurrent_updates(UPDATE_CONCURRENCY)
+        .token(BOT_TOKEN)
+        .base_url(TELEGRAM_API_URL)
+        .rate_limiter(ChatRateLimiter(
+            chat_max_rate=TELEGRAM_CHAT_RATE,
+            chat_time_period=TELEGRAM_CHAT_PERIOD,
+            overall_max_rate=overall_max_rate,
+            overall_time_period=overall_time_period,
+            group_max_rate=TELEGRAM_GROUP_RATE,
+            max_retries=TELEGRAM_MAX_RETRIES,
+        ))
+        .post_init(start_background_tasks)
+        .post_shutdown(stop_background_tasks)
+        .build()
+    )
 
     # Command handlers
     application.add_handler(CommandHandler("start", start))
     application.add_handler(MessageHandler(filters.Regex("WITHDRAW"), handle_withdraw))
+    application.add_handler(CommandHandler("import", handle_import))
+    application.add_handler(CommandHandler("notify", handle_notify))
+    application.add_handler(MessageHandler(filters.Document.ALL, handle_import))
 
     # Message handler for text messages
     application.add_handler(
@@ -793,7 +3057,58 @@ def main():
     application.add_handler(CallbackQueryHandler(handle_wallet_click, pattern=r'^wallet_'))
     application.add_handler(CallbackQueryHandler(handle_remove_wallet_click, pattern=r'^remove_'))
 
-    application.run_polling()
+    return application
+
+def main():
+    application = build_application()
+
+    if WEBHOOK_URL:
+        asyncio.run(run_webhook(application))
+    else:
+        application.run_polling()
+
+# Function to check the settings needed to run the bot, exits with a message if one is missing.
+# Shard workers check the secret of the updates the front forwards: without a webhook, a
+# polling front makes one up for its workers.
+def check_bot_settings(shard_worker=False):
+    global WEBHOOK_SECRET
+    if not BOT_TOKEN:
+        sys.exit("BOT_TOKEN is not set")
+    if WEBHOOK_SECRET:
+        return
+    if WEBHOOK_URL or shard_worker:
+        sys.exit("WEBHOOK_SECRET is not set (it is required with WEBHOOK_URL and for shard workers)")
+    WEBHOOK_SECRET = os.environ["WEBHOOK_SECRET"] = secrets.token_hex(32)
+
+# Command line: no arguments runs the bot, subcommands run one-shot maintenance tasks
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="DiviBot")
+    subcommands = parser.add_subparsers(dest="command")
+
+    migrate_parser = subcommands.add_parser("migrate-sqlite", help="copy a SQLite user database into Postgres (DATABASE_URL)")
+    migrate_parser.add_argument("sqlite_path", nargs="?", default=DATABASE_PATH)
+
+    payout_parser = subcommands.add_parser("payout-report", help="write this week's payout of every registered wallet as CSV")
+    payout_parser.add_argument("output", nargs="?", default=f"payouts-{datetime.now(timezone.utc):%Y-%m-%d}.csv")
+    payout_parser.add_argument("--skip-snapshot", action="store_true", help="use the stored holder snapshot instead of taking a new one")
+
+    shard_parser = subcommands.add_parser("shard-worker", help="run one shard worker (started by the front process)")
+    shard_parser.add_argument("shard", type=int)
+
+    return parser.parse_args(argv)
 
 if __name__ == "__main__":
-    main()
+    args = parse_args()
+    if args.command == "migrate-sqlite":
+        migrate_sqlite_to_postgres(args.sqlite_path)
+    elif args.command == "payout-report":
+        run_payout_report(args.output, refresh_snapshot=not args.skip_snapshot)
+    elif args.command == "shard-worker":
+        check_bot_settings(shard_worker=True)
+        asyncio.run(run_shard_worker(build_application(sending_processes=WORKER_PROCESSES), args.shard))
+    elif WORKER_PROCESSES > 1:
+        check_bot_settings()
+        asyncio.run(run_front())
+    else:
+        check_bot_settings()
+        main()